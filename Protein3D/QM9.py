@@ -5,7 +5,7 @@ import dgl
 import numpy as np
 import torch
 
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 
 from scipy.constants import physical_constants
 
@@ -19,6 +19,8 @@ class QM9Dataset(Dataset):
     atom_feature_size = 6 
     input_keys = ['mol_id', 'num_atoms', 'num_bonds', 'x', 'one_hot', 
                   'atomic_numbers', 'edge']
+    node_keys = ['x', 'one_hot', 'atomic_numbers']    # padded to the largest molecule in QM9_data.pt
+    edge_keys = ['edge']                              # padded to the most bonds
     unit_conversion = {'mu': 1.0,
                        'alpha': 1.0,
                        'homo': hartree2eV,
@@ -37,7 +39,7 @@ class QM9Dataset(Dataset):
         """Create a dataset object
 
         Args:
-            file_address: path to data
+            file_address: path to data, QM9_data.pt or a directory written by convert_columnar()
             task: target task ["homo", ...]
             mode: [train/val/test] mode
             transform: data augmentation functions
@@ -62,21 +64,47 @@ class QM9Dataset(Dataset):
 
     
     def load_data(self):
-        # Load dict and select train/valid/test split
-        # print(os.path.abspath(os.curdir)
-        data = torch.load(self.file_address)
-        data = data[self.mode]
-    
-        # Filter out the inputs
-        self.inputs = {key: data[key] for key in self.input_keys}
+        self.columnar = os.path.isdir(self.file_address)
+        if self.columnar:
+            self.load_columnar()
+        else:
+            # Load dict and select train/valid/test split
+            # print(os.path.abspath(os.curdir)
+            data = torch.load(self.file_address)
+            data = data[self.mode]
+        
+            # Filter out the inputs
+            self.inputs = {key: data[key] for key in self.input_keys}
 
-        # Filter out the targets and population stats
-        self.targets = data[self.task]
+            # Filter out the targets and population stats
+            self.targets = data[self.task]
 
         # TODO: use the training stats unlike the other papers
         self.mean = np.mean(self.targets)
         self.std = np.std(self.targets)
 
+        # fully connected templates for every molecule size, built before the
+        # DataLoader workers start so that they all share them
+        sizes = np.unique(self.inputs['num_atoms']).tolist() if self.fully_connected else []
+        self.templates = {n: self._get_adjacency(n) for n in sizes}
+
+
+    def load_columnar(self):
+        """Open the flat arrays of one split, see convert_columnar().
+
+        Atoms and bonds are memory-mapped copy-on-write: workers share the
+        pages through the OS cache and nothing is read before it is used. The
+        per-molecule arrays (offsets, counts, targets) are small and loaded.
+        """
+        split_dir = os.path.join(self.file_address, self.mode)
+        load = lambda name, mmap_mode=None: np.load(os.path.join(split_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        # plain ndarray views of the maps: slicing a np.memmap costs more than the slice itself
+        self.inputs = {key: np.asarray(load(key, 'c' if key in self.node_keys + self.edge_keys else None)) for key in self.input_keys}
+        self.node_offsets = load('node_offsets')
+        self.edge_offsets = load('edge_offsets')
+        self.targets = load(f'target_{self.task}')
+
 
     def get_target(self, idx, normalize=True):
         target = self.targets[idx]
@@ -113,37 +141,44 @@ class QM9Dataset(Dataset):
         src, dst = src.reshape(-1), dst.reshape(-1)
         src, dst = src[src > -1], dst[dst > -1]
             
-        return src, dst
+        return src.astype(IDTYPE), dst.astype(IDTYPE)
 
 
     def get(self, key, idx):
+        # columnar inputs are flat: slice the molecule out by its offsets
+        if self.columnar and key in self.node_keys:
+            return self.inputs[key][self.node_offsets[idx]:self.node_offsets[idx+1]]
+        if self.columnar and key in self.edge_keys:
+            return self.inputs[key][self.edge_offsets[idx]:self.edge_offsets[idx+1]]
         return self.inputs[key][idx]
 
 
     def connect_fully(self, edges, num_atoms):
-        """Convert to a fully connected graph"""
-        # Initialize all edges: no self-edges
-        adjacency = {}
-        for i in range(num_atoms):
-            for j in range(num_atoms):
-                if i != j:
-                    adjacency[(i, j)] = self.num_bonds - 1
+        """Convert to a fully connected graph
 
-        # Add bonded edges
-        for idx in range(edges.shape[0]):
-            adjacency[(edges[idx,0], edges[idx,1])] = edges[idx,2]
-            adjacency[(edges[idx,1], edges[idx,0])] = edges[idx,2]
+        All ordered pairs i != j, row-major, from the template of the molecule
+        size; bonded pairs get their bond type, all others the extra type
+        num_bonds-1.
+        """
+        if num_atoms not in self.templates:
+            self.templates[num_atoms] = self._get_adjacency(num_atoms)
+        src, dst = self.templates[num_atoms]
 
-        # Convert to numpy arrays
-        src = []
-        dst = []
-        w = []
-        for edge, weight in adjacency.items():
-            src.append(edge[0])
-            dst.append(edge[1])
-            w.append(weight)
+        # position of pair (i, j) in the template: row i, diagonal left out
+        i = np.concatenate([edges[:,0], edges[:,1]]).astype(np.int64)
+        j = np.concatenate([edges[:,1], edges[:,0]]).astype(np.int64)
+        pos = i * (num_atoms - 1) + j - (j > i)
+        bond = np.concatenate([edges[:,2], edges[:,2]])
 
-        return np.array(src).astype(IDTYPE), np.array(dst).astype(IDTYPE), np.array(w)
+        # a pair listed twice keeps its last bond type, both directions of a bond interleaved
+        order = np.stack([np.arange(len(edges)), np.arange(len(edges)) + len(edges)], -1).ravel()
+        pos, bond = pos[order][::-1], bond[order][::-1]
+        pos, first = np.unique(pos, return_index=True)
+
+        w = np.full(len(src), self.num_bonds - 1, dtype=np.int64)
+        w[pos] = bond[first]
+
+        return src, dst, w
 
 
     def connect_partially(self, edge):
@@ -158,9 +193,9 @@ class QM9Dataset(Dataset):
     def __getitem__(self, idx):
         # Load node features
         num_atoms = self.get('num_atoms', idx)
-        x = self.get('x', idx)[:num_atoms].astype(DTYPE)
-        one_hot = self.get('one_hot', idx)[:num_atoms].astype(DTYPE)
-        atomic_numbers = self.get('atomic_numbers', idx)[:num_atoms].astype(DTYPE)
+        x = self.get('x', idx)[:num_atoms].astype(DTYPE, copy=False)
+        one_hot = self.get('one_hot', idx)[:num_atoms].astype(DTYPE, copy=False)
+        atomic_numbers = self.get('atomic_numbers', idx)[:num_atoms].astype(DTYPE, copy=False)
 
         # Load edge features
         num_bonds = self.get('num_bonds', idx)
@@ -178,8 +213,12 @@ class QM9Dataset(Dataset):
         # Create nodes
         if self.fully_connected:
             src, dst, w = self.connect_fully(edge, num_atoms)
+            # reverse edges, (j, i) in the row-major template
+            rev = dst.astype(np.int64) * (num_atoms - 1) + src - (src > dst)
         else:
             src, dst, w = self.connect_partially(edge)
+            # reverse edges, the second half
+            rev = (np.arange(len(src)) + len(edge)) % max(len(src), 1)
         w = self.to_one_hot(w, self.num_bonds).astype(DTYPE)
 
         # print(type(src), type(dst))
@@ -203,22 +242,115 @@ class QM9Dataset(Dataset):
         
         w = torch.Tensor(w)
         G.edata['w'] = w[:, :-1]
+        G.edata['rev'] = torch.from_numpy(rev.astype(IDTYPE))
 
         return G, y
 
 
-if __name__ == "__main__":
-    def collate(samples):
-        graphs, y = map(list, zip(*samples))
-        batched_graph = dgl.batch(graphs)
-        return batched_graph, torch.tensor(y)
+def convert_columnar(file_address, out_dir):
+    """Convert QM9_data.pt into flat, unpadded arrays for memory-mapping.
+
+    Every split gets a directory with one .npy file per input key, the
+    per-molecule atoms (x, one_hot, atomic_numbers) and bonds (edge)
+    concatenated without padding, `node_offsets`/`edge_offsets` [M+1] to slice
+    them, and one `target_<task>.npy` per task. Node features are stored as
+    float32.
+
+    Args:
+        file_address (str): path to QM9_data.pt
+        out_dir (str): output directory, passed as file_address to QM9Dataset afterwards
+    """
+    data = torch.load(file_address)
+    for mode, split in data.items():
+        split_dir = os.path.join(out_dir, mode)
+        os.makedirs(split_dir, exist_ok=True)
+        save = lambda name, v: np.save(os.path.join(split_dir, f'{name}.npy'), np.ascontiguousarray(v))
+
+        num_atoms = np.asarray(split['num_atoms']).astype(np.int64)
+        num_bonds = np.asarray(split['num_bonds']).astype(np.int64)
+        save('node_offsets', np.r_[0, np.cumsum(num_atoms)])
+        save('edge_offsets', np.r_[0, np.cumsum(num_bonds)])
+
+        for key in QM9Dataset.input_keys:
+            v = np.asarray(split[key])
+            if key in QM9Dataset.node_keys:
+                v = np.concatenate([v[i,:n] for i, n in enumerate(num_atoms)]).astype(DTYPE)
+            elif key in QM9Dataset.edge_keys:
+                v = np.concatenate([v[i,:n] for i, n in enumerate(num_bonds)])
+            save(key, v)
+
+        # everything else of molecule length is a target
+        for key, v in split.items():
+            if key not in QM9Dataset.input_keys and np.ndim(v) >= 1 and len(v) == len(num_atoms):
+                save(f'target_{key}', np.asarray(v))
+        print(f'{mode} -> {len(num_atoms)} molecules, {num_atoms.sum()} atoms, {num_bonds.sum()} bonds')
 
-    dataset = QM9Dataset('/home/flower/github/Protein3D/Protein3D/QM9_data.pt', "homo", mode='train', fully_connected=False)
-    dataloader = DataLoader(dataset, batch_size=32, shuffle=True, collate_fn=collate)
 
-    for data in dataloader:
-        print("MINIBATCH")
-        print(data)
+if __name__ == "__main__":
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file_address', type=str, nargs='?', default='QM9_data.pt',
+            help="QM9_data.pt")
+    parser.add_argument('--convert', type=str, default=None,
+            help="Write the columnar (memory-mapped) version of file_address to this directory")
+    FLAGS = parser.parse_args()
+
+    if FLAGS.convert:
+        convert_columnar(FLAGS.file_address, FLAGS.convert)
+
+        # startup and per-sample cost of both backings, and equality of the samples
+        timing = {}
+        for name, address in [('torch.load', FLAGS.file_address), ('columnar', FLAGS.convert)]:
+            start = time.time()
+            dataset = QM9Dataset(address, "homo", mode='train')
+            timing[f'{name} startup'] = time.time() - start
+            start = time.time()
+            samples = [dataset[i] for i in range(min(len(dataset), 2000))]
+            timing[f'{name} per sample'] = (time.time() - start) / len(samples)
+            if name == 'torch.load':
+                ref = samples
+        for (G, y), (G_ref, y_ref) in zip(samples, ref):
+            assert np.array_equal(y, y_ref) and all(torch.equal(G.ndata[k], G_ref.ndata[k]) for k in G_ref.ndata)
+            assert all(torch.equal(G.edata[k], G_ref.edata[k]) for k in G_ref.edata)
+        print(', '.join(f'{k}: {v*1e3:.3f} ms' for k, v in timing.items()))
         sys.exit()
 
+    def connect_fully_loop(edges, num_atoms, num_bonds):
+        # reference: the former dict-based QM9Dataset.connect_fully
+        adjacency = {}
+        for i in range(num_atoms):
+            for j in range(num_atoms):
+                if i != j:
+                    adjacency[(i, j)] = num_bonds - 1
+        for idx in range(edges.shape[0]):
+            adjacency[(edges[idx,0], edges[idx,1])] = edges[idx,2]
+            adjacency[(edges[idx,1], edges[idx,0])] = edges[idx,2]
+        src, dst, w = zip(*[(e[0], e[1], v) for e, v in adjacency.items()])
+        return np.array(src).astype(IDTYPE), np.array(dst).astype(IDTYPE), np.array(w)
+
+    # QM9 molecules if available, otherwise random ones of QM9 sizes (<= 29 atoms)
+    if os.path.exists(FLAGS.file_address):
+        dataset = QM9Dataset(FLAGS.file_address, "homo", mode='train', fully_connected=True)
+        samples = [(dataset.get('edge', i)[:dataset.get('num_bonds', i)], dataset.get('num_atoms', i)) for i in range(min(len(dataset), 2000))]
+    else:
+        dataset = QM9Dataset.__new__(QM9Dataset)
+        dataset.num_bonds, dataset.templates = QM9Dataset.num_bonds + 1, {}
+        rng = np.random.RandomState(0)
+        samples = []
+        for n in rng.randint(3, 30, 2000):
+            pairs = np.array([(i, j) for i in range(n) for j in range(i+1, n)])[rng.permutation(n*(n-1)//2)[:n+2]]
+            samples.append((np.concatenate([pairs, rng.randint(0, 4, (len(pairs), 1))], -1), n))
+
+    timing = {}
+    for name, fn in [('loop', lambda e, n: connect_fully_loop(e, n, dataset.num_bonds)), ('vectorized', dataset.connect_fully)]:
+        start = time.time()
+        out = [fn(e, n) for e, n in samples]
+        timing[name] = (time.time() - start) / len(samples)
+        if name == 'loop':
+            ref = out
+        else:
+            assert all(np.array_equal(a, b) for r, o in zip(ref, out) for a, b in zip(r, o))
 
+    print(', '.join(f'{k}: {v*1e6:.1f} us/sample' for k, v in timing.items()) + f' -> {timing["loop"]/timing["vectorized"]:.1f}x')
@@ -0,0 +1,287 @@
+#%%
+"""Per-graph cache of the equivariant basis for evaluation passes.
+
+Without augmentation a chain has bit-identical relative positions every epoch,
+so its basis (get_basis_and_r()) is the same too. BasisCache keeps the basis
+and distances of single graphs, keyed by pdb ID and a hash of the positions,
+and assembles the basis of a batch by concatenating them: only graphs not seen
+before are computed, all in one pass. Any change of the coordinates, e.g. a
+rotation, is a miss.
+
+Up to `max_bytes` are kept on the device of the model. The least recently
+used graphs are evicted, and with a `spill_dir` they are written to disk and
+read back memory-mapped on their next use. Spilled files are reused by later
+runs with the same number of degrees, their names carry the version of the
+file layout they were made with.
+
+With random rotations (training) the chains as loaded are cached and the
+basis of a rotated batch is derived from them: the cached spherical harmonics
+are turned by the Wigner D matrices of the rotations (modules.rotate_sh()),
+which costs a small fraction of computing them, and make the basis in one
+product with the Q_J bank (the distances of get_r() are recomputed, they
+depend on the angles). For this the harmonics are kept with every basis,
+some 10% more memory. Graphs first seen rotated are cached as harmonics only,
+their basis is added when it is needed without a rotation.
+"""
+import os
+import hashlib
+
+import numpy as np
+import torch
+
+from collections import OrderedDict
+
+from equivariant_attention.modules import get_basis, get_r, split_basis, sh_rotation, rotate_sh
+from equivariant_attention.from_se3cnn import utils_steerable
+
+
+class BasisCache(object):
+    """LRU of per-graph bases and distances, with an optional on-disk spill."""
+    spill_version = 2   # layout of the spilled arrays: [basis, harmonics, r], or [harmonics, r]
+
+    def __init__(self, max_degree: int, max_bytes: int=2**30, spill_dir: str=None):
+        """Create an empty cache.
+
+        Args:
+            max_degree (int): degree of the highest feature type, num_degrees-1
+            max_bytes (int, optional): bytes of bases kept in memory. Defaults to 1 GB.
+            spill_dir (str, optional): directory of evicted bases, None to drop them. Defaults to None.
+        """
+        self.max_degree = max_degree
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()      # key -> (basis product [E, total] or None, harmonics [E, (2*max_degree+1)**2], r [E, 1])
+        self.nbytes = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __repr__(self):
+        return (f'BasisCache(size={len(self.entries)}, {self.nbytes/2**20:.0f}/{self.max_bytes/2**20:.0f} MB, hit_rate={self.hit_rate:.2f}, '
+                + ', '.join(f'{k}={v}' for k, v in self.stats.items()) + ')')
+
+    @property
+    def hit_rate(self):
+        """Fraction of graphs served from memory or disk since the last reset_stats()."""
+        hits = self.stats['hits'] + self.stats['disk_hits']
+        return hits / max(hits + self.stats['misses'], 1)
+
+    def reset_stats(self):
+        self.stats = {k: 0 for k in self.stats}
+
+    def keys(self, pdbs, d, num_edges):
+        """Keys of the graphs of a batch: pdb ID and a checksum of the positions as computed, any bit changed is another graph.
+
+        The checksums are integer sums of the bits of d, computed on its device in any order,
+        so only a few numbers per graph are copied to the host.
+        """
+        graph = torch.repeat_interleave(torch.arange(len(num_edges), device=d.device), torch.tensor(num_edges, device=d.device))
+        offsets = torch.cumsum(torch.tensor([0] + num_edges[:-1], device=d.device), 0)
+        position = torch.arange(len(d), device=d.device) - offsets[graph] + 1
+        bits = d.detach().contiguous().view(torch.int32).flatten(1).long()
+        sums = torch.zeros(len(num_edges), 2*bits.shape[1], dtype=torch.int64, device=d.device)
+        sums.index_add_(0, graph, torch.cat([bits, bits * position[:, None]], 1))
+
+        keys = []
+        for pdb, n, checksum in zip(pdbs, num_edges, sums.cpu().numpy()):
+            h = hashlib.blake2b(checksum.tobytes(), digest_size=16)
+            h.update(f'{n},{self.max_degree},{d.dtype}'.encode())
+            keys.append((pdb, h.hexdigest()))
+        return keys
+
+    def spill_file(self, key, basis=True):
+        # entries without the basis spill to their own file, replaced by the full one
+        return os.path.join(self.spill_dir, f'{key[0]}_{key[1]}.v{self.spill_version}{"" if basis else ".sh"}.npy')
+
+    def lookup(self, key, device):
+        if key in self.entries:
+            self.stats['hits'] += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        for basis in [True, False]:
+            if self.spill_dir and os.path.exists(self.spill_file(key, basis)):
+                self.stats['disk_hits'] += 1
+                KYr = torch.from_numpy(np.array(np.load(self.spill_file(key, basis), mmap_mode='r'))).to(device)
+                sh = (2*self.max_degree+1)**2
+                piece = (KYr[:,:-sh-1] if basis else None, KYr[:,-sh-1:-1], KYr[:,-1:])
+                self.insert(key, piece)
+                return piece
+
+        self.stats['misses'] += 1
+        return None
+
+    @staticmethod
+    def piece_bytes(piece):
+        return sum(v.nelement() * v.element_size() for v in piece if v is not None)
+
+    def insert(self, key, piece):
+        if key in self.entries:
+            self.nbytes -= self.piece_bytes(self.entries[key])
+        self.entries[key] = piece
+        self.nbytes += self.piece_bytes(piece)
+        while self.nbytes > self.max_bytes and self.entries:
+            old, piece = self.entries.popitem(last=False)
+            self.nbytes -= self.piece_bytes(piece)
+            self.stats['evictions'] += 1
+            spill_file = self.spill_dir and self.spill_file(old, piece[0] is not None)
+            if spill_file and not os.path.exists(spill_file):
+                # write-then-rename, a concurrent reader never maps a partial file
+                tmp_file = f'{spill_file}.{os.getpid()}.tmp.npy'
+                np.save(tmp_file, torch.cat([v for v in piece if v is not None], -1).cpu().numpy())
+                os.replace(tmp_file, spill_file)
+
+    def get_basis_and_r(self, G, pdbs, rotation=None):
+        """Basis and distances of a batched graph, as equivariant_attention.modules.get_basis_and_r().
+
+        Args:
+            G: batched DGL graph
+            pdbs (list): pdb ID of every graph of the batch
+            rotation (Tensor, optional): rotations [B, 3, 3] of the graphs, x -> x @ Q, as
+                BatchedRandomRotation.sample(); G is not rotated yet. Defaults to None.
+        Returns:
+            dict of equivariant bases, keys are in form '<d_in><d_out>'
+            vector of relative distances, ordered according to edge ordering of G
+        """
+        d = G.edata['d']
+        num_edges = G.batch_num_edges().tolist()
+        assert len(pdbs) == len(num_edges), f'{len(pdbs)} pdb IDs for {len(num_edges)} graphs'
+        offsets = np.r_[0, np.cumsum(num_edges)]
+
+        keys = self.keys(pdbs, d, num_edges)
+        pieces = [self.lookup(key, d.device) for key in keys]
+        missing = [g for g, piece in enumerate(pieces) if piece is None]
+
+        # harmonics of graphs seen for the first time, computed together
+        if missing:
+            edges = torch.cat([torch.arange(offsets[g], offsets[g+1]) for g in missing]).to(d.device)
+            with torch.no_grad():
+                d_missing = d[edges]
+                Y = utils_steerable.precompute_sh_cartesian(d_missing, 2*self.max_degree)
+                r = get_r(d_missing)
+            # copies, not views of the batch: evicting a graph frees its memory, as piece_bytes() counts it
+            start = 0
+            for g in missing:
+                end = start + num_edges[g]
+                pieces[g] = (None, Y[start:end].clone(), r[start:end].clone())
+                start = end
+            if rotation is not None:
+                for g in missing:
+                    self.insert(keys[g], pieces[g])
+
+        if rotation is not None:
+            # Y_J(x @ Q) = D^J Y_J(x); r holds the angles too, from the positions as BatchedRandomRotation turns them
+            if len(missing) < len(pdbs):
+                Y = torch.cat([Y for _, Y, _ in pieces])
+            Y = rotate_sh(Y, sh_rotation(rotation.to(Y), 2*self.max_degree), num_edges)
+            graph = torch.repeat_interleave(torch.arange(len(pdbs), device=d.device), torch.tensor(num_edges, device=d.device))
+            with torch.no_grad():
+                r = get_r(torch.einsum('ni,nij->nj', d, rotation.to(d)[graph]))
+            return get_basis(Y, self.max_degree), r
+
+        if len(missing) < len(pdbs):
+            r = torch.cat([r for _, _, r in pieces])
+
+        # bases of new graphs and of graphs cached as harmonics only, computed together
+        todo = [g for g, (K, _, _) in enumerate(pieces) if K is None]
+        if todo:
+            if todo != missing:
+                Y = torch.cat([pieces[g][1] for g in todo])
+            K = get_basis(Y, self.max_degree, flat=True)
+            start = 0
+            for g in todo:
+                end = start + num_edges[g]
+                pieces[g] = (K[start:end].clone(),) + pieces[g][1:]
+                self.insert(keys[g], pieces[g])
+                start = end
+
+        if len(todo) < len(pdbs):
+            K = torch.cat([K for K, _, _ in pieces])
+        return split_basis(K, self.max_degree), r
+
+
+if __name__ == '__main__':
+    import time
+    import dgl
+    import tempfile
+
+    from equivariant_attention.modules import get_basis_and_r, get_basis_bank
+    from datasets import BatchedRandomRotation
+
+    # a validation split of 64 chains of 100-400 residues, in batches of 8, for 3 epochs
+    rng = np.random.RandomState(0)
+    chains = {}
+    for i in range(64):
+        n = rng.randint(100, 400)
+        x = torch.from_numpy(rng.randn(n, 3).astype(np.float32) * 10)
+        src = rng.randint(0, n, 8*n)
+        dst = (src + rng.randint(1, n, 8*n)) % n
+        src, dst = torch.from_numpy(np.r_[src, dst]), torch.from_numpy(np.r_[dst, src])
+        G = dgl.graph((src, dst), num_nodes=n)
+        G.ndata['x'] = x
+        G.edata['d'] = x[dst] - x[src]
+        chains[f'{i:04d}.A'] = G
+    pdbs = list(chains)
+    batches = [pdbs[i:i+8] for i in range(0, len(pdbs), 8)]
+
+    max_degree = 2
+    total = get_basis_bank(max_degree, 'cpu')[0].shape[1]
+    max_bytes = sum(len(G.edata['d']) for G in chains.values()) * 4 * (total + (2*max_degree+1)**2 + 1)
+    with tempfile.TemporaryDirectory() as spill_dir:
+        for name, spill in [('in memory', None), ('1/4 in memory, spilled', spill_dir)]:
+            cache = BasisCache(max_degree, max_bytes // 4 if spill else max_bytes, spill)
+            for epoch in range(3):
+                cache.reset_stats()
+                t_ref, t_cache = 0., 0.
+                for batch in batches:
+                    G = dgl.batch([chains[pdb] for pdb in batch])
+
+                    start = time.time()
+                    ref, r_ref = get_basis_and_r(G, max_degree)
+                    t_ref += time.time() - start
+
+                    start = time.time()
+                    basis, r = cache.get_basis_and_r(G, batch)
+                    t_cache += time.time() - start
+
+                    assert torch.equal(r, r_ref) and all(torch.allclose(basis[k], ref[k], atol=1e-6) for k in ref)
+                print(f'{name}, epoch {epoch} -> get_basis_and_r: {t_ref*1e3:.0f} ms, cache: {t_cache*1e3:.0f} ms, {cache}')
+
+    # training: bases of randomly rotated batches from the cached ones, against computing them from the rotated graphs
+    rotation = BatchedRandomRotation()
+    for max_degree in [1, 2, 3]:
+        cache = BasisCache(max_degree, max_bytes=2**34)
+        for epoch in range(3):
+            cache.reset_stats()
+            t_ref, t_cache, err = 0., 0., 0.
+            for batch in batches:
+                G = dgl.batch([chains[pdb] for pdb in batch])
+                Q = rotation.sample(G)
+
+                start = time.time()
+                basis, r = cache.get_basis_and_r(G, batch, rotation=Q)
+                t_cache += time.time() - start
+
+                G = rotation(G, Q)
+                start = time.time()
+                ref, r_ref = get_basis_and_r(G, max_degree)
+                t_ref += time.time() - start
+
+                assert torch.equal(r, r_ref)
+                err = max([err] + [(basis[k] - ref[k]).abs().max().item() for k in ref])
+            print(f'rotated, max degree {max_degree}, epoch {epoch} -> get_basis_and_r: {t_ref*1e3:.0f} ms, '
+                  f'cache: {t_cache*1e3:.0f} ms, max abs error {err:.1e}, {cache}')
+            assert err < 1e-4
+
+    # chains cached in training, as harmonics only, then evaluated: from memory and from disk
+    with tempfile.TemporaryDirectory() as spill_dir:
+        for spill in [None, spill_dir]:
+            cache = BasisCache(2, 2**20 if spill else 2**30, spill)
+            G = dgl.batch([chains[pdb] for pdb in batches[0]])
+            cache.get_basis_and_r(G, batches[0], rotation=rotation.sample(G))
+            batch = batches[0][:4] + batches[1][:4]
+            G = dgl.batch([chains[pdb] for pdb in batch])
+            basis, r = cache.get_basis_and_r(G, batch)
+            ref, r_ref = get_basis_and_r(G, 2)
+            assert torch.equal(r, r_ref) and all(torch.allclose(basis[k], ref[k], atol=1e-6) for k in ref)
+            print(f'evaluated after training, {"spilled" if spill else "in memory"} -> {cache}')
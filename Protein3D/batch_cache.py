@@ -0,0 +1,158 @@
+#%%
+"""Pre-collated batch cache for the validation and test splits.
+
+Validation and test loaders visit the same samples in the same order every
+epoch, so their batches are collated once and written to flat arrays: the edge
+lists and every node/edge feature of all batched graphs concatenated, with the
+nodes and edges per graph and the graphs per batch to slice them. Later epochs
+replay a batch with a few memory-mapped slices and one graph construction, no
+parsing, neighbour search or `dgl.batch`.
+
+A cache directory holds one split; `meta.json` records the settings it was
+built with and the size and modification time of the files its batches were
+read from (split file, manifest, graph store index). A cache built with other
+settings, or from files that changed since, is rebuilt. Batches are stored
+un-rotated, rotations (BatchedRandomRotation) are applied after loading.
+"""
+import os
+import json
+import shutil
+
+import dgl
+import numpy as np
+import torch
+
+from torch.utils.data import DataLoader, Dataset
+
+IDTYPE = np.int32
+META = 'meta.json'
+
+
+def load_meta(cache_dir):
+    meta_file = os.path.join(cache_dir, META)
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def write_batch_cache(loader, cache_dir, settings):
+    """Collate every batch of `loader` once and write them to `cache_dir`.
+
+    Args:
+        loader (DataLoader): deterministic loader yielding (batched graph, targets, pdb IDs)
+        cache_dir (str): cache directory, replaced atomically
+        settings (dict): JSON-serializable settings the batches depend on
+    """
+    src, dst, ndata, edata = [], [], {}, {}
+    num_nodes, num_edges, graphs, targets, pdbs = [], [], [0], [], []
+    for G, y, pdb in loader:
+        s, d = G.edges()
+        src.append(s.numpy().astype(IDTYPE))
+        dst.append(d.numpy().astype(IDTYPE))
+        for store, data in [(ndata, G.ndata), (edata, G.edata)]:
+            for key, v in data.items():
+                store.setdefault(key, []).append(v.numpy())
+
+        num_nodes.append(G.batch_num_nodes().numpy())
+        num_edges.append(G.batch_num_edges().numpy())
+        graphs.append(graphs[-1] + len(num_nodes[-1]))
+        targets.append(np.asarray(y))
+        pdbs.append(list(pdb))
+
+    tmp_dir = f'{cache_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    save = lambda name, v: np.save(os.path.join(tmp_dir, f'{name}.npy'), v)
+    save('src', np.concatenate(src))
+    save('dst', np.concatenate(dst))
+    for prefix, store in [('ndata', ndata), ('edata', edata)]:
+        for key, v in store.items():
+            save(f'{prefix}_{key}', np.concatenate(v))
+    save('num_nodes', np.concatenate(num_nodes).astype(np.int64))
+    save('num_edges', np.concatenate(num_edges).astype(np.int64))
+    save('graphs', np.array(graphs, dtype=np.int64))
+    save('targets', np.concatenate(targets))
+
+    meta = {'settings': settings, 'ndata': sorted(ndata), 'edata': sorted(edata), 'pdb': pdbs}
+    with open(os.path.join(tmp_dir, META), 'w') as f:
+        json.dump(meta, f)
+
+    # written completely before it replaces the old cache
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_dir, cache_dir)
+    print(f'Cached {len(pdbs)} batches -> {cache_dir}')
+
+
+class BatchCache(Dataset):
+    """Batches of a cache directory, one item per batch."""
+    def __init__(self, cache_dir):
+        meta = load_meta(cache_dir)
+        load = lambda name, mmap_mode=None: np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        self.pdb = meta['pdb']
+        self.graphs = load('graphs')
+        self.num_nodes = torch.from_numpy(load('num_nodes'))
+        self.num_edges = torch.from_numpy(load('num_edges'))
+        self.node_offsets = np.r_[0, np.cumsum(self.num_nodes.numpy())]
+        self.edge_offsets = np.r_[0, np.cumsum(self.num_edges.numpy())]
+        self.targets = load('targets')
+
+        # plain ndarray views of copy-on-write maps, writable for torch.from_numpy
+        self.src, self.dst = np.asarray(load('src', 'c')), np.asarray(load('dst', 'c'))
+        self.ndata = {key: np.asarray(load(f'ndata_{key}', 'c')) for key in meta['ndata']}
+        self.edata = {key: np.asarray(load(f'edata_{key}', 'c')) for key in meta['edata']}
+
+    def __len__(self):
+        return len(self.pdb)
+
+    def __getitem__(self, b):
+        g0, g1 = self.graphs[b], self.graphs[b+1]
+        n0, n1 = self.node_offsets[g0], self.node_offsets[g1]
+        e0, e1 = self.edge_offsets[g0], self.edge_offsets[g1]
+
+        G = dgl.graph((torch.from_numpy(self.src[e0:e1]), torch.from_numpy(self.dst[e0:e1])), num_nodes=int(n1 - n0))
+        for key, v in self.ndata.items():
+            G.ndata[key] = torch.from_numpy(v[n0:n1])
+        for key, v in self.edata.items():
+            G.edata[key] = torch.from_numpy(v[e0:e1])
+        G.set_batch_num_nodes(self.num_nodes[g0:g1])
+        G.set_batch_num_edges(self.num_edges[g0:g1])
+
+        return G, torch.from_numpy(self.targets[g0:g1]), self.pdb[b]
+
+
+def _replay(batch):
+    return batch
+
+
+def file_stamps(paths):
+    """path -> [size, mtime_ns] of every file in `paths`, None for a missing one."""
+    stamps = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps[path] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+
+def cached_loader(make_loader, cache_dir, settings, files=()):
+    """Loader replaying the batches cached in `cache_dir`.
+
+    Args:
+        make_loader (callable): returns the deterministic loader to cache, only called when the cache is missing or stale
+        cache_dir (str): cache directory of this split
+        settings (dict): JSON-serializable settings the batches depend on
+        files (list, optional): files the batches are read from; the cache is stale once one of them changes size or modification time
+    Returns:
+        DataLoader over BatchCache, yielding the batches of make_loader() in order
+    """
+    settings = json.loads(json.dumps(dict(settings, files=file_stamps(files))))
+    meta = load_meta(cache_dir)
+    if meta is None or meta['settings'] != settings:
+        write_batch_cache(make_loader(), cache_dir, settings)
+
+    # batches are complete: no sampler, no collate, no workers
+    return DataLoader(BatchCache(cache_dir), batch_size=None, shuffle=False, collate_fn=_replay)
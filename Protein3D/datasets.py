@@ -1,14 +1,22 @@
 #%%
 import os
-import requests
+import zlib
+import itertools
+from collections import OrderedDict
 
 import dgl
 import torch
 import numpy as np
 
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 from Bio.PDB import PDBParser
 from Bio.PDB.NeighborSearch import NeighborSearch
+from scipy.spatial import cKDTree
+
+import pdb_io
+import prefetch
+import preflight
+from graph_store import GraphStore, StoreSplit, EDGE_LAYOUT
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -44,16 +52,20 @@ class ProtProcess:
             # print(f"The file has been downloaded...")
             return 1
 
-        page = 'http://files.rcsb.org/view/{}.pdb'.format(pdb_id)
-        req = requests.get(page)
-        if req.status_code == 200:
-            response = req.text
-            if outfile:
-                with open(outfile, 'w') as f:
-                    f.write(response)
-            return 1
-        else:
-            return 0
+        # fallback for entries missed by the bulk prefetch (see prefetch.py)
+        return prefetch.download(pdb_id, outfile)
+
+    @staticmethod
+    def find_structure(pdb_id):
+        """Path of the structure file of an entry, downloading it if missing.
+
+        Any format of pdb_io.FORMATS is accepted (PDB, mmCIF or BinaryCIF, plain or gzip-compressed).
+        """
+        path = pdb_io.find_structure(f'{data_dir}/pdb', pdb_id)
+        if path is None:
+            ProtProcess.download_pdb(pdb_id, f'{data_dir}/pdb/{pdb_id}.pdb')
+            path = pdb_io.find_structure(f'{data_dir}/pdb', pdb_id) or f'{data_dir}/pdb/{pdb_id}.pdb'
+        return path
 
     @staticmethod
     def get_residue_feature(chain):
@@ -96,6 +108,279 @@ class ProtProcess:
 
         return edge
 
+    @staticmethod
+    def get_atom_arrays(chain):
+        """Flatten a chain into atom coordinates and atom -> residue indices.
+
+        Args:
+            chain: Bio.PDB chain
+        Returns:
+            atom coordinates [A, 3], residue index of every atom [A],
+            rank of every residue in Bio.PDB residue order [R], residue sequence numbers [R]
+        """
+        residues = list(chain)
+        res_ids = [r.get_id() for r in residues]
+
+        coo = np.array([a.get_coord() for a in chain.get_atoms()], dtype=np.float64).reshape((-1, 3))
+        atom_res = np.repeat(np.arange(len(residues)), [len(r) for r in residues])
+
+        # Bio.PDB compares residues by their (hetflag, resseq, icode) id
+        res_order = np.empty(len(residues), dtype=np.int64)
+        res_order[sorted(range(len(residues)), key=lambda k: res_ids[k])] = np.arange(len(residues))
+        res_seq = np.array([i[1] for i in res_ids], dtype=np.int64)
+
+        return coo, atom_res, res_order, res_seq
+
+    @staticmethod
+    def connect_partially(dis_cut, coo, atom_res, res_order, res_seq, num_residues):
+        """Build the labelled residue graph for all distance cutoffs in one sweep.
+
+        Two residues are in contact under a cutoff when any pair of their atoms
+        is within it. Bond types and residue numbering follow the original
+        NeighborSearch based construction (get_edge_set): a residue pair takes
+        bond type k+1 of the tightest cutoff dis_cut[k] it satisfies, and
+        sequential neighbours are covalent (bond type 0).
+
+        Args:
+            dis_cut (list): distance cutoffs of the non-covalent bonds
+            coo, atom_res, res_order, res_seq: atom arrays, see get_atom_arrays()
+            num_residues (int): number of residues kept as nodes
+        Returns:
+            edge sources, edge destinations, bond types; every edge (i, j) is
+            followed by its reverse (j, i) at offset num_edges//2
+        """
+        l = num_residues
+        cut_sq = np.asarray(dis_cut, dtype=np.float64) ** 2
+
+        # all atom pairs within the largest cutoff
+        if len(coo):
+            pairs = cKDTree(coo).query_pairs(np.sqrt(cut_sq.max()) + 1e-6, output_type='ndarray')
+        else:
+            pairs = np.zeros((0, 2), dtype=np.int64)
+        a, b = atom_res[pairs[:,0]], atom_res[pairs[:,1]]
+        d_sq = np.sum((coo[pairs[:,0]] - coo[pairs[:,1]])**2, axis=-1)
+        within = d_sq[:,None] <= cut_sq[None,:]
+        keep = (a != b) & within.any(axis=1)
+        a, b, bond = a[keep], b[keep], 1 + within[keep].argmax(axis=1)
+
+        # order each residue pair as Bio.PDB does and map it to sequence numbers
+        swap = res_order[a] > res_order[b]
+        i = res_seq[np.where(swap, b, a)] - 1
+        j = res_seq[np.where(swap, a, b)] - 1
+        keep = (i < j-1) & (j < l) & (i > 0)
+        i, j, bond = i[keep], j[keep], bond[keep]
+
+        # dedupe residue pairs, keeping the tightest cutoff
+        key = i * l + j
+        order = np.lexsort((bond, key))
+        key, first = np.unique(key[order], return_index=True)
+        bond = bond[order][first]
+
+        # add covalent bonds
+        cov = np.arange(1, l)
+        i = np.concatenate([key // l, cov - 1])
+        j = np.concatenate([key % l, cov])
+        bond = np.concatenate([bond, np.zeros(len(cov), dtype=bond.dtype)])
+
+        src = np.concatenate([i, j]).astype(IDTYPE)
+        dst = np.concatenate([j, i]).astype(IDTYPE)
+        w = np.concatenate([bond, bond]).astype(np.int8)
+
+        return src, dst, w
+
+    @staticmethod
+    def get_chain_arrays(parser, pdb, dis_cut, fast_reader: bool=True, index_dir: str=None):
+        """Parse a `pdbid.chain` entry into residue indices, centroids and labelled edges.
+
+        Args:
+            parser: pdb_io.StructureParser instance, or a StructureCache of one
+            pdb (str): pdb ID and chain ID, e.g. '1abc.A'
+            dis_cut (list): distance cutoffs of the non-covalent bonds
+            fast_reader (bool, optional): read the chain with the columnar reader (pdb_io.py),
+                using Bio.PDB only for files it does not handle. Defaults to True.
+            index_dir (str, optional): directory of the chain indices of the columnar reader (pdb_io.chain_index()).
+                Defaults to None (in memory).
+        Returns:
+            residue indices, residue coordinates, edge sources, edge destinations, bond types
+        """
+        # parse protein structure
+        p, c = pdb.split('.')           # pdb ID and chain ID
+        path = ProtProcess.find_structure(p)
+        atoms = pdb_io.read_chain(path, c, index_dir=index_dir) if fast_reader else None
+        if atoms is None:
+            structure = parser.get_structure('a', path)
+            chain = structure[0][c]
+
+        # generate node features
+        try:
+            if atoms is not None:
+                res, x = pdb_io.get_residue_feature(atoms, residue2idx)
+            else:
+                res, x = ProtProcess.get_residue_feature(chain)
+        except:
+            print('error pdb: ', pdb)
+            raise                                   # chains that fail are listed by preflight.py
+        num_residues = res.shape[0]
+
+        # generate edge features
+        atom_arrays = pdb_io.get_atom_arrays(atoms) if atoms is not None else ProtProcess.get_atom_arrays(chain)
+        src, dst, w = ProtProcess.connect_partially(dis_cut, *atom_arrays, num_residues)
+
+        return res, x, src, dst, w
+
+class StructureCache(object):
+    """Process-local LRU of parsed structures.
+
+    ProtFunct samples are `pdbid.chain` and many chains share one entry. The
+    cache stands in for the parser (same get_structure() call), keyed by file
+    path and modification time, so every chain of an entry reuses one parse
+    and a re-downloaded file is parsed again.
+    """
+    def __init__(self, parser, maxsize: int=32):
+        """Wrap a parser with an LRU cache.
+
+        Args:
+            parser: Bio.PDB parser instance
+            maxsize (int, optional): number of structures kept per process. Defaults to 32.
+        """
+        self.parser = parser
+        self.maxsize = maxsize
+        self.structures = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'StructureCache(size={len(self.structures)}/{self.maxsize}, hits={self.hits}, misses={self.misses})'
+
+    def get_structure(self, id, file):
+        key = (file, os.path.getmtime(file))
+        if key in self.structures:
+            self.hits += 1
+            self.structures.move_to_end(key)
+            return self.structures[key]
+
+        self.misses += 1
+        structure = self.parser.get_structure(id, file)
+        self.structures[key] = structure
+        if len(self.structures) > self.maxsize:
+            self.structures.popitem(last=False)
+
+        return structure
+
+class ClassIndex(object):
+    """Inverted index of one split: class -> indices of its samples.
+
+    Stored as the sample indices sorted by class (stable, so in sample order
+    within a class) and the offset of every class, so the samples of a class
+    are one slice and selecting classes costs O(selected samples).
+    """
+    def __init__(self, order, offsets):
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def from_targets(cls, targets, num_class: int=0):
+        targets = np.asarray(targets, dtype=np.int64)
+        offsets = np.r_[0, np.cumsum(np.bincount(targets, minlength=num_class))]
+        return cls(np.argsort(targets, kind='stable'), offsets)
+
+    @classmethod
+    def load(cls, file_path, mode, targets, index_dir: str=None):
+        """Index of split `mode` of `file_path`, built from `targets` or, with an `index_dir`, read from a file there.
+
+        The file is rebuilt when the size or modification time of `file_path` changes.
+        Nothing is written next to the data; if the index directory is not writable
+        the index is only kept in memory.
+        """
+        if not index_dir:
+            return cls.from_targets(targets)
+
+        stat = os.stat(file_path)
+        version = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        index_file = pdb_io.index_path(file_path, index_dir, '.classes.npz')
+
+        arrays = {}
+        try:
+            with np.load(index_file) as f:
+                arrays = dict(f) if np.array_equal(f['version'], version) else {}
+        except (OSError, ValueError, KeyError):
+            pass                                            # no index yet, or an unreadable one
+        if f'{mode}_order' in arrays:
+            return cls(arrays[f'{mode}_order'], arrays[f'{mode}_offsets'])
+
+        index = cls.from_targets(targets)
+        arrays.update({'version': version, f'{mode}_order': index.order, f'{mode}_offsets': index.offsets})
+        tmp_file = f'{index_file}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(index_dir, exist_ok=True)
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_file, index_file)
+        except OSError:
+            pass                                            # keep it in memory
+        return index
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def samples(self, c):
+        """Indices of the samples of class `c`, in sample order."""
+        if c >= len(self.offsets) - 1:
+            return self.order[:0]
+        return self.order[self.offsets[c]:self.offsets[c+1]]
+
+    def select(self, classes):
+        """Indices of the samples of any of `classes`, in sample order, once even if a class is listed twice."""
+        return np.unique(np.concatenate([self.samples(c) for c in classes] + [self.order[:0]]))
+
+class ResidueCrop(object):
+    """Crop chains longer than a residue budget, before the graph is built.
+
+    A crop is either a contiguous segment of the chain or the spatial
+    neighbourhood of one residue (the residues with the nearest centroids),
+    chosen at random. The graph is the subgraph induced by the kept residues,
+    so edges keep their order and every reverse edge stays at its offset.
+    Deterministic crops are seeded by the chain name, for evaluation.
+    """
+    def __init__(self, max_residues: int, spatial: float=0.5, deterministic: bool=False):
+        """Create a crop stage.
+
+        Args:
+            max_residues (int): residue budget per chain
+            spatial (float, optional): probability of a spatial crop instead of a contiguous one. Defaults to 0.5.
+            deterministic (bool, optional): same crop of a chain every time. Defaults to False.
+        """
+        self.max_residues = max_residues
+        self.spatial = spatial
+        self.deterministic = deterministic
+
+    def keep(self, x, pdb):
+        """Indices of the residues kept, sorted."""
+        n, budget = len(x), self.max_residues
+        rng = np.random.RandomState(zlib.crc32(pdb.encode())) if self.deterministic else np.random
+        if rng.random_sample() < self.spatial:
+            d_sq = np.sum((x - x[rng.randint(n)])**2, axis=-1)
+            return np.sort(np.argpartition(d_sq, budget - 1)[:budget])
+        start = rng.randint(n - budget + 1)
+        return np.arange(start, start + budget)
+
+    def __call__(self, res, x, src, dst, w, pdb: str=''):
+        if len(res) <= self.max_residues:
+            return res, x, src, dst, w
+
+        keep = self.keep(x, pdb)
+        new_idx = np.full(len(res), -1, dtype=np.int64)
+        new_idx[keep] = np.arange(len(keep))
+        edges = (new_idx[src] >= 0) & (new_idx[dst] >= 0)
+        return res[keep], x[keep], new_idx[src[edges]].astype(IDTYPE), new_idx[dst[edges]].astype(IDTYPE), w[edges]
+
+    def sizes(self, sizes):
+        """Estimated [N, 2] nodes and edges after cropping, edges scaled with the kept fraction of residues."""
+        sizes = np.array(sizes, dtype=np.int64).reshape(-1, 2)
+        frac = np.minimum(1., self.max_residues / np.maximum(sizes[:,0], 1))
+        return np.stack([np.minimum(sizes[:,0], self.max_residues), np.ceil(sizes[:,1] * frac)], -1).astype(np.int64)
+
 class RandomRotation(object):
     def __init__(self):
         pass
@@ -105,6 +390,36 @@ class RandomRotation(object):
         Q, __ = np.linalg.qr(M)
         return x @ Q
 
+class BatchedRandomRotation(object):
+    """Random rotation of every graph of a DGL batch, applied after collate.
+
+    Per-sample RandomRotation runs a NumPy QR in the worker and rotates the
+    coordinates before the graph is built. Here one rotation per graph is drawn
+    with a single batched QR and `ndata['x']` and `edata['d']` are rotated with
+    one gather-and-multiply each, on the device of the batch, so workers serve
+    un-rotated graphs.
+    """
+    def sample(self, G):
+        """One rotation [B, 3, 3] per graph, applied as x @ Q."""
+        x = G.ndata['x']
+
+        # Haar-distributed rotations: QR with the signs of R fixed, det(Q) flipped to +1
+        Q, R = torch.linalg.qr(torch.randn(len(G.batch_num_nodes()), 3, 3, device=x.device, dtype=x.dtype))
+        Q = Q * torch.sign(torch.diagonal(R, dim1=-2, dim2=-1))[:,None,:]
+        Q[:,:,0] *= torch.det(Q)[:,None]
+        return Q
+
+    def __call__(self, G, Q=None):
+        x = G.ndata['x']
+        num_nodes, num_edges = G.batch_num_nodes(), G.batch_num_edges()
+        if Q is None:
+            Q = self.sample(G)
+
+        graph = torch.arange(len(num_nodes), device=x.device)
+        G.ndata['x'] = torch.einsum('ni,nij->nj', x, Q[torch.repeat_interleave(graph, num_nodes.to(x.device))])
+        G.edata['d'] = torch.einsum('ni,nij->nj', G.edata['d'], Q[torch.repeat_interleave(graph, num_edges.to(x.device))])
+        return G
+
 #%%
 class ProtFunctDataset(Dataset):
     atom_feature_size = len(residue2idx)
@@ -223,13 +538,24 @@ class ProtFunctDataset(Dataset):
 class ProtFunctDatasetMultiClass(Dataset):
     atom_feature_size = len(residue2idx)
 
-    def __init__(self, file_path, mode: str='train', if_transform: bool=True, dis_cut: list=[3.0, 3.5], use_classes: list=None):
+    def __init__(self, file_path, mode: str='train', if_transform: bool=True, dis_cut: list=[3.0, 3.5], use_classes: list=None, store_dir: str=None, cache_size: int=32, fast_reader: bool=True, manifest: str=None, return_arrays: bool=False, max_residues: int=None, crop_spatial: float=0.5, index_dir: str=None):
         """Create a dataset object
 
         Args:
             file_path (str): path to data
             mode (str, optional): {train/test/valid}. Defaults to 'train'.
             if_transform (bool, optional): if applying data augmentation function. Defaults to True.
+            store_dir (str, optional): preprocessed graph store (see graph_store.py); chains missing from it are parsed. Defaults to None.
+            cache_size (int, optional): number of Bio.PDB structures cached per process, 0 to disable; the fast reader keeps
+                the atom sites of its last mmCIF/BinaryCIF file instead (pdb_io.read_atom_site()). Defaults to 32.
+            fast_reader (bool, optional): read chains with the columnar reader of pdb_io.py instead of Bio.PDB. Defaults to True.
+            manifest (str, optional): preflight manifest (see preflight.py); chains that did not parse are left out. Defaults to None.
+            return_arrays (bool, optional): return (res, x, src, dst, w) arrays instead of graphs, for collate_arrays(). Defaults to False.
+            max_residues (int, optional): crop longer chains to this many residues (ResidueCrop), at random for training
+                and deterministically otherwise. Defaults to None (no cropping).
+            crop_spatial (float, optional): probability of a spatial instead of a contiguous crop. Defaults to 0.5.
+            index_dir (str, optional): directory of the class and chain indices of the data files, outside the data tree.
+                Defaults to None (kept in memory).
         """
         self.file_path = file_path
         self.mode = mode
@@ -239,7 +565,14 @@ class ProtFunctDatasetMultiClass(Dataset):
         self.bond2idx = {'covalent':0, 'neighbor<{dis_cut[0]}':1, 'neighbor<{dis_cut[1]}': 2}
 
         self.transform = RandomRotation() if if_transform else None
+        self.crop = ResidueCrop(max_residues, crop_spatial, deterministic=mode != 'train') if max_residues else None
         self.use_classes = use_classes
+        self.store_dir = store_dir
+        self.cache_size = cache_size
+        self.fast_reader = fast_reader
+        self.index_dir = index_dir
+        self.manifest_file = manifest
+        self.return_arrays = return_arrays
         
         self.__load_data()
         self.len = self.inputs.shape[0]
@@ -253,14 +586,19 @@ class ProtFunctDatasetMultiClass(Dataset):
         self.targets = np.array(data['target_list'])
 
         if self.use_classes:
-            self.__use_selected_classes()
+            selected = ClassIndex.load(self.file_path, self.mode, self.targets, self.index_dir).select(self.use_classes)
+            self.inputs = self.inputs[selected]
+            self.targets = self.targets[selected]
 
-        self.parser = PDBParser()
+        self.manifest = preflight.load_manifest(self.manifest_file) if self.manifest_file else None
+        if self.manifest:
+            mask = preflight.usable(self.manifest, self.inputs)
+            print(f'Preflight manifest -> {(~mask).sum()} of {len(mask)} samples left out')
+            self.inputs = self.inputs[mask]
+            self.targets = self.targets[mask]
 
-    def __use_selected_classes(self):
-        mask = np.vstack([self.targets == i for i in self.use_classes]).any(axis=0)
-        self.inputs = self.inputs[mask]
-        self.targets = self.targets[mask]
+        self.parser = StructureCache(pdb_io.StructureParser(), self.cache_size) if self.cache_size else pdb_io.StructureParser()
+        self.store = GraphStore(self.store_dir, self.dis_cut, residue2idx) if self.store_dir else None
 
     def __len__(self):
         return self.len
@@ -270,39 +608,60 @@ class ProtFunctDatasetMultiClass(Dataset):
         one_hot[np.arange(len(data)),data] = 1
         return one_hot
 
+    def sized(self, pdbs):
+        """Boolean mask of the chains `pdbs` whose size is known to size_manifest()."""
+        if self.store is not None:
+            return np.array([pdb in self.store for pdb in pdbs], dtype=bool)
+        assert self.manifest is not None, 'chain sizes need a graph store (store_dir) or a preflight manifest (manifest)'
+        return preflight.usable(self.manifest, pdbs)
+
+    def drop_unsized(self):
+        """Leave out the chains missing from the graph store or the preflight manifest, before size_manifest()."""
+        mask = self.sized(self.inputs)
+        print(f'Chain sizes -> {(~mask).sum()} of {len(mask)} samples left out')
+        self.inputs = self.inputs[mask]
+        self.targets = self.targets[mask]
+        self.len = self.inputs.shape[0]
+
+    def size_manifest(self, pdbs):
+        """[N, 2] number of nodes and edges of the chains `pdbs`, from the graph store or else the preflight manifest."""
+        if self.store is not None:
+            sizes = self.store.size_manifest(pdbs)
+        else:
+            assert self.manifest is not None, 'chain sizes need a graph store (store_dir) or a preflight manifest (manifest)'
+            sizes = preflight.size_manifest(self.manifest, pdbs, self.dis_cut)
+        return self.crop.sizes(sizes) if self.crop else sizes
+
     def __prepare_item__(self, pdb):
 
-        # parse protein structure
-        p, c = pdb.split('.')           # pdb ID and chain ID
-        ProtProcess.download_pdb(p, f'{data_dir}/pdb/{p}.pdb')
-        structure = self.parser.get_structure('a', f'{data_dir}/pdb/{p}.pdb')
-        chain = structure[0][c]
+        # residue indices, coordinates and labelled edges, read from the graph store if possible
+        if self.store is not None and pdb in self.store:
+            res, x, src, dst, w = self.store.get(pdb)
+        else:
+            res, x, src, dst, w = ProtProcess.get_chain_arrays(self.parser, pdb, self.dis_cut, self.fast_reader, self.index_dir)
 
-        # generate node features
-        try:
-            res, x = ProtProcess.get_residue_feature(chain)
-        except:
-            print('error pdb: ', pdb)
-        num_residues = res.shape[0]
-        res = self.to_one_hot(res, len(residue2idx))[...,None]
+        # bound the size of very long chains
+        if self.crop:
+            res, x, src, dst, w = self.crop(res, x, src, dst, w, pdb)
 
         # augmentation on the coordinates(
         if self.transform:
             x = self.transform(x).astype(DTYPE)
 
-        # generate edge features
-        src, dst, w = self.__connect_partially([i for i in chain.get_atoms()], num_residues)
-        w = self.to_one_hot(w, self.num_bonds).astype(DTYPE)
+        # plain arrays are cheaper to send from the workers, the graph is built by collate_arrays()
+        if self.return_arrays:
+            return res.astype(np.int16), x.astype(DTYPE), src.astype(IDTYPE), dst.astype(IDTYPE), w.astype(np.int8)
 
         # create protein representation graph
         G = dgl.DGLGraph((src, dst))
         # add node feature
         x = torch.Tensor(x)
         G.ndata['x'] = x
-        G.ndata['f'] = torch.Tensor(res)
+        G.ndata['f'] = torch.from_numpy(res.astype(np.int16))    # residue indices, one-hot on device (models.expand_features)
         # add edge feature
         G.edata['d'] = x[dst] - x[src]
-        G.edata['w'] = torch.Tensor(w)
+        G.edata['w'] = torch.from_numpy(w.astype(np.int8))      # bond types, one-hot on device
+        G.edata['rev'] = torch.from_numpy(reverse_halves(src, dst))
     
         return G
 
@@ -322,44 +681,39 @@ class ProtFunctDatasetMultiClass(Dataset):
         # x = self.unit_conversion[self.task] * x
         return x
 
-
-    def __connect_partially(self, atom_list, num_residues):
-        # initialize edges satisfy the different distance cutoffs
-        adjacency = {}
-        for c in range(1, self.num_bonds):
-            for i, j in ProtProcess.get_edge_set(self.dis_cut[-c], num_residues, atom_list):
-                adjacency[(i, j)] = self.num_bonds - c
-                adjacency[(j, i)] = self.num_bonds - c
-        
-        # add covalent bonds
-        for i in range(1, num_residues):
-            adjacency[(i-1, i)] = 0
-            adjacency[(i, i-1)] = 0
-
-        # convert to numpy arrays
-        src, dst, w = [], [], []
-        for edge, bond in adjacency.items():
-            src.append(edge[0])
-            dst.append(edge[1])
-            w.append(bond)
-
-        return np.array(src).astype(IDTYPE), np.array(dst).astype(IDTYPE), np.array(w)
     
 #%%
 class ProtFunctDatasetBinary(Dataset):
     atom_feature_size = len(residue2idx)
 
-    def __init__(self, file_path, mode: str='train', class_idx: int=1, if_transform: bool=True, dis_cut: list=[3.0, 3.5]):
+    def __init__(self, file_path, mode: str='train', class_idx: int=1, if_transform: bool=True, dis_cut: list=[3.0, 3.5], store_dir: str=None, cache_size: int=32, fast_reader: bool=True, manifest: str=None, return_arrays: bool=False, max_residues: int=None, crop_spatial: float=0.5, index_dir: str=None):
         """Create a dataset object
 
         Args:
             file_path (str): path to data
             mode (str, optional): {train/test/valid}. Defaults to 'train'.
             if_transform (bool, optional): if applying data augmentation function. Defaults to True.
+            store_dir (str, optional): preprocessed graph store (see graph_store.py); chains missing from it are parsed. Defaults to None.
+            cache_size (int, optional): number of Bio.PDB structures cached per process, 0 to disable; the fast reader keeps
+                the atom sites of its last mmCIF/BinaryCIF file instead (pdb_io.read_atom_site()). Defaults to 32.
+            fast_reader (bool, optional): read chains with the columnar reader of pdb_io.py instead of Bio.PDB. Defaults to True.
+            manifest (str, optional): preflight manifest (see preflight.py); chains that did not parse are left out. Defaults to None.
+            return_arrays (bool, optional): return (res, x, src, dst, w) arrays instead of graphs, for collate_arrays(). Defaults to False.
+            max_residues (int, optional): crop longer chains to this many residues (ResidueCrop), at random for training
+                and deterministically otherwise. Defaults to None (no cropping).
+            crop_spatial (float, optional): probability of a spatial instead of a contiguous crop. Defaults to 0.5.
+            index_dir (str, optional): directory of the class and chain indices of the data files, outside the data tree.
+                Defaults to None (kept in memory).
         """
         self.file_path = file_path
         self.mode = mode
         self.class_idx = class_idx
+        self.store_dir = store_dir
+        self.cache_size = cache_size
+        self.fast_reader = fast_reader
+        self.index_dir = index_dir
+        self.manifest_file = manifest
+        self.return_arrays = return_arrays
         print(f'Protein function index -> {class_idx}')
 
         self.dis_cut = dis_cut
@@ -367,6 +721,7 @@ class ProtFunctDatasetBinary(Dataset):
         self.bond2idx = {'covalent':0, 'neighbor<{dis_cut[0]}':1, 'neighbor<{dis_cut[1]}': 2}
 
         self.transform = RandomRotation() if if_transform else None
+        self.crop = ResidueCrop(max_residues, crop_spatial, deterministic=mode != 'train') if max_residues else None
         
         self.__load_data()
         self.len = self.inputs.shape[0]
@@ -379,16 +734,25 @@ class ProtFunctDatasetBinary(Dataset):
         targets = np.array(data['target_list'])
 
         # split positive and negative samples
-        mask = targets == self.class_idx
+        mask = np.zeros(len(inputs), dtype=bool)
+        mask[ClassIndex.load(self.file_path, self.mode, targets, self.index_dir).samples(self.class_idx)] = True
         self.inputs = inputs[mask]
         self.inputs_ns = inputs[~mask]
+
+        self.manifest = preflight.load_manifest(self.manifest_file) if self.manifest_file else None
+        if self.manifest:
+            mask, mask_ns = preflight.usable(self.manifest, self.inputs), preflight.usable(self.manifest, self.inputs_ns)
+            print(f'Preflight manifest -> {(~mask).sum() + (~mask_ns).sum()} of {len(inputs)} samples left out')
+            self.inputs = self.inputs[mask]
+            self.inputs_ns = self.inputs_ns[mask_ns]
         print(f'Data summary -> {self.inputs.shape[0]} positive and {self.inputs_ns.shape[0]} negative samples')
 
         # initial negative sample list
         self.__init_ns_list__()
 
         # initial PDB parser
-        self.parser = PDBParser()
+        self.parser = StructureCache(pdb_io.StructureParser(), self.cache_size) if self.cache_size else pdb_io.StructureParser()
+        self.store = GraphStore(self.store_dir, self.dis_cut, residue2idx) if self.store_dir else None
 
     def __init_ns_list__(self):
         ns = self.inputs_ns.copy()
@@ -403,51 +767,79 @@ class ProtFunctDatasetBinary(Dataset):
         one_hot[np.arange(len(data)),data] = 1
         return one_hot
 
+    def sized(self, pdbs):
+        """Boolean mask of the chains `pdbs` whose size is known to size_manifest()."""
+        if self.store is not None:
+            return np.array([pdb in self.store for pdb in pdbs], dtype=bool)
+        assert self.manifest is not None, 'chain sizes need a graph store (store_dir) or a preflight manifest (manifest)'
+        return preflight.usable(self.manifest, pdbs)
+
+    def drop_unsized(self):
+        """Leave out the chains missing from the graph store or the preflight manifest, before size_manifest()."""
+        mask, mask_ns = self.sized(self.inputs), self.sized(self.inputs_ns)
+        print(f'Chain sizes -> {(~mask).sum() + (~mask_ns).sum()} of {len(mask) + len(mask_ns)} samples left out')
+        self.inputs = self.inputs[mask]
+        self.inputs_ns = self.inputs_ns[mask_ns]
+        self.__init_ns_list__()
+        self.len = self.inputs.shape[0]
+
+    def size_manifest(self, pdbs):
+        """[N, 2] number of nodes and edges of the chains `pdbs`, from the graph store or else the preflight manifest."""
+        if self.store is not None:
+            sizes = self.store.size_manifest(pdbs)
+        else:
+            assert self.manifest is not None, 'chain sizes need a graph store (store_dir) or a preflight manifest (manifest)'
+            sizes = preflight.size_manifest(self.manifest, pdbs, self.dis_cut)
+        return self.crop.sizes(sizes) if self.crop else sizes
+
     def __prepare_item__(self, pdb):
 
-        # parse protein structure
-        p, c = pdb.split('.')           # pdb ID and chain ID
-        ProtProcess.download_pdb(p, f'{data_dir}/pdb/{p}.pdb')
-        structure = self.parser.get_structure('a', f'{data_dir}/pdb/{p}.pdb')
-        chain = structure[0][c]
+        # residue indices, coordinates and labelled edges, read from the graph store if possible
+        if self.store is not None and pdb in self.store:
+            res, x, src, dst, w = self.store.get(pdb)
+        else:
+            res, x, src, dst, w = ProtProcess.get_chain_arrays(self.parser, pdb, self.dis_cut, self.fast_reader, self.index_dir)
 
-        # generate node features
-        try:
-            res, x = ProtProcess.get_residue_feature(chain)
-        except:
-            print('error pdb: ', pdb)
-        num_residues = res.shape[0]
-        res = self.to_one_hot(res, len(residue2idx))[...,None]
+        # bound the size of very long chains
+        if self.crop:
+            res, x, src, dst, w = self.crop(res, x, src, dst, w, pdb)
 
         # augmentation on the coordinates(
         if self.transform:
             x = self.transform(x).astype(DTYPE)
 
-        # generate edge features
-        src, dst, w = self.__connect_partially([i for i in chain.get_atoms()], num_residues)
-        w = self.to_one_hot(w, self.num_bonds).astype(DTYPE)
+        # plain arrays are cheaper to send from the workers, the graph is built by collate_arrays()
+        if self.return_arrays:
+            return res.astype(np.int16), x.astype(DTYPE), src.astype(IDTYPE), dst.astype(IDTYPE), w.astype(np.int8)
 
         # create protein representation graph
         G = dgl.DGLGraph((src, dst))
         # add node feature
         x = torch.Tensor(x)
         G.ndata['x'] = x
-        G.ndata['f'] = torch.Tensor(res)
+        G.ndata['f'] = torch.from_numpy(res.astype(np.int16))    # residue indices, one-hot on device (models.expand_features)
         # add edge feature
         G.edata['d'] = x[dst] - x[src]
-        G.edata['w'] = torch.Tensor(w)
+        G.edata['w'] = torch.from_numpy(w.astype(np.int8))      # bond types, one-hot on device
+        G.edata['rev'] = torch.from_numpy(reverse_halves(src, dst))
     
         return G
 
     def __getitem__(self, idx):
+        # (positive, negative) pairs come from samplers.NegativePairSampler, otherwise negatives are drawn here
+        if isinstance(idx, tuple):
+            idx, idx_ns = idx
+            pdb_ns = self.inputs_ns[idx_ns]
+        else:
+            if not len(self.ns_list):
+                self.__init_ns_list__()
+            pdb_ns = self.ns_list.pop()
+
         # positive sample
         pdb = self.inputs[idx]
         G = self.__prepare_item__(pdb)
 
         # negative sample
-        if not len(self.ns_list):
-            self.__init_ns_list__()
-        pdb_ns = self.ns_list.pop()
         G_ns = self.__prepare_item__(pdb_ns) 
     
         return G, 1, pdb, G_ns, 0, pdb_ns
@@ -464,28 +856,181 @@ class ProtFunctDatasetBinary(Dataset):
         return x
 
 
-    def __connect_partially(self, atom_list, num_residues):
-        # initialize edges satisfy the different distance cutoffs
-        adjacency = {}
-        for c in range(1, self.num_bonds):
-            for i, j in ProtProcess.get_edge_set(self.dis_cut[-c], num_residues, atom_list):
-                adjacency[(i, j)] = self.num_bonds - c
-                adjacency[(j, i)] = self.num_bonds - c
-        
-        # add covalent bonds
-        for i in range(1, num_residues):
-            adjacency[(i-1, i)] = 0
-            adjacency[(i, i-1)] = 0
+#%%
+class ProtFunctStream(IterableDataset):
+    """Stream one split of a graph store (see graph_store.py) shard by shard.
+
+    Shards are dealt round-robin to the DataLoader workers of every rank, so
+    no two workers read the same sample, and samples are shuffled through a
+    bounded buffer. Memory per worker depends on the shard and buffer sizes
+    only, not on the size of the dataset.
+
+    Every rank yields ceil(len / world_size) samples, as DistributedSampler:
+    ranks whose shards hold more are truncated, the others repeat samples, so
+    collective ops of distributed training stay in step. The shard order only
+    changes with set_epoch(), which must be called before every epoch (with the
+    same epoch on every rank): DataLoader workers iterate a copy of the dataset.
+    """
+    atom_feature_size = len(residue2idx)
 
-        # convert to numpy arrays
-        src, dst, w = [], [], []
-        for edge, bond in adjacency.items():
-            src.append(edge[0])
-            dst.append(edge[1])
-            w.append(bond)
+    def __init__(self, store_dir, mode: str='train', if_transform: bool=True, dis_cut: list=[3.0, 3.5], use_classes: list=None, shuffle: bool=True, shuffle_buffer: int=1024, seed: int=0, return_arrays: bool=False, max_residues: int=None, crop_spatial: float=0.5):
+        """Create a streaming dataset object
 
-        return np.array(src).astype(IDTYPE), np.array(dst).astype(IDTYPE), np.array(w)
-  
+        Args:
+            store_dir (str): graph store built by graph_store.py, including its split lists
+            mode (str, optional): {train/test/valid}. Defaults to 'train'.
+            if_transform (bool, optional): if applying data augmentation function. Defaults to True.
+            use_classes (list, optional): keep the samples of these classes only. Defaults to None.
+            shuffle (bool, optional): shuffle the shard order and the samples every epoch. Defaults to True.
+            shuffle_buffer (int, optional): number of samples held per worker for shuffling. Defaults to 1024.
+            seed (int, optional): base random seed, combined with the epoch. Defaults to 0.
+            return_arrays (bool, optional): return (res, x, src, dst, w) arrays instead of graphs, for collate_arrays(). Defaults to False.
+            max_residues (int, optional): crop longer chains to this many residues (ResidueCrop), at random for training
+                and deterministically otherwise. Defaults to None (no cropping).
+            crop_spatial (float, optional): probability of a spatial instead of a contiguous crop. Defaults to 0.5.
+        """
+        self.mode = mode
+        self.dis_cut = dis_cut
+        self.num_bonds = len(dis_cut) + 1
+
+        self.transform = RandomRotation() if if_transform else None
+        self.crop = ResidueCrop(max_residues, crop_spatial, deterministic=mode != 'train') if max_residues else None
+        self.use_classes = use_classes
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.return_arrays = return_arrays
+        self.epoch = 0
+
+        self.split = StoreSplit(store_dir, dis_cut, residue2idx, mode)
+        # samples of every shard of the split that pass use_classes, from the memory-mapped targets
+        targets = self.split.rows['target']
+        self.shard_len = np.array([np.isin(targets[start:end], use_classes).sum() if use_classes else end - start
+                                   for _, start, end in self.split.shards], dtype=np.int64)
+        self.len = int(self.shard_len.sum())
+
+        print(f'Data summary -> {len(use_classes) if use_classes else 384} protein classes, and {self.len} protein samples in {len(self.split.shards)} shards')
+
+    def set_epoch(self, epoch: int):
+        """Shuffle for `epoch`; iterating does not advance the epoch."""
+        self.epoch = epoch
+
+    def __len__(self):
+        # samples of this rank, the same on every rank
+        _, world_size = self.__rank()
+        return -(-self.len // world_size)
+
+    def __rank(self):
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def __order(self):
+        """Shard order of the epoch, the same permutation on every rank and worker."""
+        order = np.arange(len(self.split.shards))
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(order)
+        return order
+
+    def __shards(self, rank, world_size, worker_id, num_workers):
+        """Shards of one worker: dealt to the ranks first, so they get as even a share as the shards allow, then to their workers."""
+        return self.__order()[rank::world_size][worker_id::num_workers]
+
+    def __quota(self, rank, world_size, worker_id, num_workers):
+        """Number of samples one worker yields, so that the workers of every rank yield len(self) together."""
+        counts = [int(self.shard_len[self.__shards(rank, world_size, w, num_workers)].sum()) for w in range(num_workers)]
+        target = -(-self.len // world_size)
+        padding = target - sum(counts)
+        if padding >= 0:
+            return counts[worker_id] + padding // num_workers + int(worker_id < padding % num_workers)
+        # truncated: the first workers keep their samples
+        return min(max(target - sum(counts[:worker_id]), 0), counts[worker_id])
+
+    def __assign_shards(self):
+        """Shards of this worker, its number of samples and its random state for the epoch."""
+        rank, world_size = self.__rank()
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        return (self.__shards(rank, world_size, worker_id, num_workers), self.__quota(rank, world_size, worker_id, num_workers),
+                np.random.RandomState([self.seed, self.epoch, rank, worker_id]))
+
+    def __prepare_item__(self, pdb, res, x, src, dst, w):
+
+        # bound the size of very long chains
+        if self.crop:
+            res, x, src, dst, w = self.crop(res, x, src, dst, w, pdb)
+
+        # augmentation on the coordinates(
+        if self.transform:
+            x = self.transform(x).astype(DTYPE)
+
+        # plain arrays are cheaper to send from the workers, the graph is built by collate_arrays()
+        if self.return_arrays:
+            return res.astype(np.int16), x.astype(DTYPE), src.astype(IDTYPE), dst.astype(IDTYPE), w.astype(np.int8)
+
+        # create protein representation graph
+        G = dgl.DGLGraph((src, dst))
+        # add node feature
+        x = torch.Tensor(x)
+        G.ndata['x'] = x
+        G.ndata['f'] = torch.from_numpy(res.astype(np.int16))    # residue indices, one-hot on device (models.expand_features)
+        # add edge feature
+        G.edata['d'] = x[dst] - x[src]
+        G.edata['w'] = torch.from_numpy(w.astype(np.int8))      # bond types, one-hot on device
+        G.edata['rev'] = torch.from_numpy(reverse_halves(src, dst))
+
+        return G
+
+    def __samples(self, shards):
+        for k in shards:
+            for pdb, y, *arrays in self.split.read_shard(k):
+                if self.use_classes and y not in self.use_classes:
+                    continue
+                yield pdb, y, arrays
+
+    def __shuffled(self, shards, rng):
+        # bounded shuffle: fill the buffer, then emit a random slot for every incoming sample
+        buffer = []
+        for sample in self.__samples(shards):
+            if not self.shuffle:
+                yield sample
+            elif len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+            else:
+                i = rng.randint(len(buffer))
+                yield buffer[i]
+                buffer[i] = sample
+
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+    def __padding(self):
+        # samples repeated by ranks with fewer than len(self), from the start of the epoch's shard order
+        while True:
+            yield from self.__samples(self.__order())
+
+    def __iter__(self):
+        shards, quota, rng = self.__assign_shards()
+        for sample in itertools.islice(itertools.chain(self.__shuffled(shards, rng), self.__padding()), quota):
+            yield self.__output(sample)
+
+    def __output(self, sample):
+        pdb, y, arrays = sample
+        return self.__prepare_item__(pdb, *arrays), y, pdb
+
+
+def reverse_halves(src, dst):
+    """Index of the reverse of every edge, for edges whose reverses follow at offset len(src)//2.
+
+    Stored as `edata['rev']`, it lets get_basis_and_r() compute the basis of one
+    direction of every edge pair (equivariant_attention.modules.reverse_edges()).
+    The layout is checked: the harmonics of a wrong pairing would be silently wrong.
+    """
+    num_edges, half = len(src), len(src) // 2
+    assert num_edges % 2 == 0, f'{num_edges} edges, not every edge has a reverse'
+    assert np.array_equal(src[:half], dst[half:]) and np.array_equal(src[half:], dst[:half]), \
+        f'edges are not in the layout {EDGE_LAYOUT} of graph_store.EDGE_LAYOUT, rebuild the graph store'
+    return ((np.arange(num_edges) + half) % max(num_edges, 1)).astype(IDTYPE)
 
 def collate(samples): 
     graphs, y, pdb = map(list, zip(*samples))
@@ -497,12 +1042,101 @@ def collate_ns(samples):
     batched_graph = dgl.batch(graphs+graphs_ns)
     return batched_graph, torch.tensor(y+y_ns), pdb+pdb_ns
 
+def batch_arrays(arrays):
+    """Build one batched graph from per-sample (res, x, src, dst, w) arrays.
+
+    The arrays are copied once into buffers of the batch size, node indices
+    offset by the nodes of the preceding samples, and the graph is created
+    once with its batch sizes set, instead of building a graph per sample and
+    concatenating them with dgl.batch.
+    """
+    num_nodes = np.array([len(a[0]) for a in arrays], dtype=np.int64)
+    num_edges = np.array([len(a[2]) for a in arrays], dtype=np.int64)
+    node_offsets = np.r_[0, np.cumsum(num_nodes)]
+    edge_offsets = np.r_[0, np.cumsum(num_edges)]
+
+    res = np.empty(node_offsets[-1], dtype=np.int16)
+    x = np.empty((node_offsets[-1], 3), dtype=DTYPE)
+    src = np.empty(edge_offsets[-1], dtype=np.int64)
+    dst = np.empty(edge_offsets[-1], dtype=np.int64)
+    w = np.empty(edge_offsets[-1], dtype=np.int8)
+    rev = np.empty(edge_offsets[-1], dtype=IDTYPE)
+    for k, (r, xk, s, d, wk) in enumerate(arrays):
+        n0, n1, e0, e1 = node_offsets[k], node_offsets[k+1], edge_offsets[k], edge_offsets[k+1]
+        res[n0:n1] = r
+        x[n0:n1] = xk
+        np.add(s, n0, out=src[e0:e1])
+        np.add(d, n0, out=dst[e0:e1])
+        w[e0:e1] = wk
+        rev[e0:e1] = reverse_halves(s, d)
+
+    x, src, dst = torch.from_numpy(x), torch.from_numpy(src), torch.from_numpy(dst)
+    G = dgl.graph((src, dst), num_nodes=int(node_offsets[-1]))
+    G.ndata['x'] = x
+    G.ndata['f'] = torch.from_numpy(res)
+    G.edata['d'] = x[dst] - x[src]
+    G.edata['w'] = torch.from_numpy(w)
+    G.edata['rev'] = torch.from_numpy(rev)                      # within each graph, as after dgl.batch
+    G.set_batch_num_nodes(torch.from_numpy(num_nodes))
+    G.set_batch_num_edges(torch.from_numpy(num_edges))
+    return G
+
+def collate_arrays(samples):
+    arrays, y, pdb = map(list, zip(*samples))
+    return batch_arrays(arrays), torch.tensor(y), pdb
+
+def collate_arrays_ns(samples):
+    arrays, y, pdb, arrays_ns, y_ns, pdb_ns = map(list, zip(*samples))
+    return batch_arrays(arrays+arrays_ns), torch.tensor(y+y_ns), pdb+pdb_ns
+
+def benchmark_collate(batch_sizes=(2, 4, 8, 16, 32, 64), num_batches: int=20, seed: int=0):
+    """Time collate() against collate_arrays() on random chains of 50-500 residues.
+
+    Both include pickling the samples, as they are sent from the DataLoader workers.
+    """
+    import time
+    import pickle
+
+    rng = np.random.RandomState(seed)
+    def sample():
+        n = rng.randint(50, 500)
+        i = rng.randint(0, n, 4*n)
+        j = (i + rng.randint(1, n, 4*n)) % n
+        src, dst = np.r_[i, j].astype(IDTYPE), np.r_[j, i].astype(IDTYPE)
+        return rng.randint(0, 20, n).astype(np.int16), rng.randn(n, 3).astype(DTYPE), src, dst, rng.randint(0, 3, len(src)).astype(np.int8)
+
+    def graph(res, x, src, dst, w):
+        G = dgl.DGLGraph((src, dst))
+        x = torch.from_numpy(x)
+        G.ndata['x'] = x
+        G.ndata['f'] = torch.from_numpy(res)
+        G.edata['d'] = x[dst] - x[src]
+        G.edata['w'] = torch.from_numpy(w)
+        return G
+
+    for batch_size in batch_sizes:
+        batches = [[(sample(), 0, 'pdb') for _ in range(batch_size)] for _ in range(num_batches)]
+        timing = {}
+        for name, fn, prepare in [('dgl.batch', collate, lambda s: (graph(*s[0]), *s[1:])), ('arrays', collate_arrays, lambda s: s)]:
+            samples = [[prepare(s) for s in b] for b in batches]
+            start = time.time()
+            for b in samples:
+                fn(pickle.loads(pickle.dumps(b)))
+            timing[name] = (time.time() - start) / num_batches
+        print(f'batch size {batch_size:3d} -> ' + ', '.join(f'{k}: {v*1e3:.2f} ms' for k, v in timing.items())
+              + f' ({timing["dgl.batch"]/timing["arrays"]:.1f}x)')
+
 def to_np(x):
     return x.cpu().detach().numpy()
 
 #%%
 # test
 if __name__ == '__main__':
+    import sys
+    if '--benchmark_collate' in sys.argv:
+        benchmark_collate()
+        sys.exit()
+
     try:
         for mode in ['train', 'test', 'valid']:
             dataset = ProtFunctDatasetBinary('../data/ProtFunct.pt', mode='test', class_idx=0)
@@ -74,20 +74,95 @@ def x_to_alpha_beta(x):
 # [x, y, z]
 
 
+_wigner_coefficients = {}
+
+def _wigner_recursion(l):
+    """
+    index and coefficient tables of the recursion step l-1 -> l of wigner_D_all()
+    rows index the padded [-(l+1), l+1] rows of the P matrices, see there
+    """
+    if l not in _wigner_coefficients:
+        m, n = np.arange(-l, l+1)[:, None], np.arange(-l, l+1)[None, :]
+        d = np.where(np.abs(n) < l, (l + n) * (l - n), (2*l) * (2*l - 1)).astype(np.float64)
+        am = np.abs(m)
+        u = np.sqrt((l + m) * (l - m) / d)
+        v = 0.5 * np.sqrt((1 + (m == 0)) * (am + l - 1) * (am + l) / d) * (1 - 2 * (m == 0))
+        w = -0.5 * np.sqrt(np.maximum((l - am - 1) * (l - am), 0) / d) * (m != 0)
+
+        m = m[:, 0]
+        row = lambda a: a + l + 1
+        # V = c1 * P_1[i1] + c2 * P_-1[i2], W = c3 * P_1[i3] + c4 * P_-1[i4]
+        i1 = row(np.where(m == 0, 1, np.where(m > 0, m - 1, m + 1)))
+        c1 = np.where(m == 0, 1., np.where(m > 0, np.sqrt(1. + (m == 1)), 1. - (m == -1)))
+        i2 = row(np.where(m == 0, -1, np.where(m > 0, -m + 1, -m - 1)))
+        c2 = np.where(m == 0, 1., np.where(m > 0, -(1. - (m == 1)), np.sqrt(1. + (m == -1))))
+        i3 = row(np.where(m > 0, m + 1, m - 1))
+        c3 = np.where(m == 0, 0., 1.)
+        i4 = row(np.where(m > 0, -m - 1, -m + 1))
+        c4 = np.where(m == 0, 0., np.where(m > 0, 1., -1.))
+        _wigner_coefficients[l] = (u, v, w, row(m), i1, c1, i2, c2, i3, c3, i4, c4)
+    return _wigner_coefficients[l]
+
+
+def wigner_D_all(max_order, R):
+    """
+    real Wigner D matrices of all orders up to max_order, batched, in torch
+    - D^1 is R itself in the (y, z, x) basis, D^l follows by the recursion of
+      Ivanic and Ruedenberg (J. Phys. Chem. 1996, 100, 6342; erratum 1998)
+    - wigner_D(l, rot(alpha, beta, gamma)) == irr_repr(l, alpha, beta, gamma)
+
+    :param max_order: highest order
+    :param R: rotation matrices [..., 3, 3]
+    :return: list of [..., 2l+1, 2l+1] for l = 0, ..., max_order
+    """
+    perm = [1, 2, 0]
+    R1 = R[..., perm, :][..., :, perm]
+    Ds = [torch.ones(*R.shape[:-2], 1, 1, dtype=R.dtype, device=R.device), R1]
+    for l in range(2, max_order+1):
+        u, v, w, iu, i1, c1, i2, c2, i3, c3, i4, c4 = [torch.as_tensor(t, device=R.device) for t in _wigner_recursion(l)]
+        D_prev = Ds[-1]
+
+        # P_i[a, b] for a in [-(l-1), l-1], b in [-l, l], rows padded with zeros to [-(l+1), l+1]
+        def P(i):
+            r = lambda j: R1[..., i+1, j+1, None, None]
+            P_i = torch.cat([r(1) * D_prev[..., :, :1] + r(-1) * D_prev[..., :, -1:],
+                             r(0) * D_prev,
+                             r(1) * D_prev[..., :, -1:] - r(-1) * D_prev[..., :, :1]], -1)
+            pad = P_i.new_zeros(*P_i.shape[:-2], 2, 2*l+1)
+            return torch.cat([pad, P_i, pad], -2)
+        P0, P1, Pm1 = P(0), P(1), P(-1)
+
+        U = P0[..., iu, :]
+        V = c1[:, None].to(R.dtype) * P1[..., i1, :] + c2[:, None].to(R.dtype) * Pm1[..., i2, :]
+        W = c3[:, None].to(R.dtype) * P1[..., i3, :] + c4[:, None].to(R.dtype) * Pm1[..., i4, :]
+        Ds.append(u.to(R.dtype) * U + v.to(R.dtype) * V + w.to(R.dtype) * W)
+    return Ds[:max_order+1]
+
+
+def wigner_D(order, R):
+    """
+    real Wigner D matrix of one order, batched, see wigner_D_all()
+    """
+    return wigner_D_all(order, R)[order]
+
+
 def irr_repr(order, alpha, beta, gamma, dtype=None):
     """
     irreducible representation of SO3
     - compatible with compose and spherical_harmonics
+    - same matrices as lie_learn's wigner_D_matrix, computed in torch, see wigner_D_all()
     """
-    # from from_lielearn_SO3.wigner_d import wigner_D_matrix
-    from lie_learn.representations.SO3.wigner_d import wigner_D_matrix
-    # if order == 1:
-    #     # change of basis to have vector_field[x, y, z] = [vx, vy, vz]
-    #     A = np.array([[0, 0, 1], [1, 0, 0], [0, 1, 0]])
-    #     return A @ wigner_D_matrix(1, alpha, beta, gamma) @ A.T
+    with torch_default_dtype(torch.float64):
+        R = rot(*[torch.as_tensor(x, dtype=torch.float64) for x in (alpha, beta, gamma)])
+    return wigner_D(order, R).to(torch.get_default_dtype() if dtype is None else dtype)
 
-    # TODO (non-essential): try to do everything in torch
-    # return torch.tensor(wigner_D_matrix(torch.tensor(order), alpha, beta, gamma), dtype=torch.get_default_dtype() if dtype is None else dtype)
+
+def irr_repr_lie_learn(order, alpha, beta, gamma, dtype=None):
+    """
+    irr_repr computed by lie_learn
+    - equal to irr_repr up to rounding, but the sign of the Q_J solved from these bits is the one of the trained models
+    """
+    from lie_learn.representations.SO3.wigner_d import wigner_D_matrix
     return torch.tensor(wigner_D_matrix(order, np.array(alpha), np.array(beta), np.array(gamma)), dtype=torch.get_default_dtype() if dtype is None else dtype)
 
 
@@ -259,7 +334,7 @@ def _test_change_basis_wigner_to_rot():
 
         a, b, c = torch.rand(3)
 
-        r1 = A.t() @ torch.tensor(wigner_D_matrix(1, a, b, c), dtype=torch.float64) @ A
+        r1 = A.t() @ torch.tensor(wigner_D_matrix(1, a.item(), b.item(), c.item()), dtype=torch.float64) @ A
         r2 = rot(a, b, c)
 
         d = (r1 - r2).abs().max()
@@ -267,6 +342,21 @@ def _test_change_basis_wigner_to_rot():
         assert d < 1e-10
 
 
+def _test_wigner_D_lie_learn(order):
+    """
+    irr_repr (torch) gives the matrices of lie_learn's wigner_D_matrix, also batched
+    """
+    from lie_learn.representations.SO3.wigner_d import wigner_D_matrix
+
+    with torch_default_dtype(torch.float64):
+        abc = torch.rand(4, 3) * 2 * math.pi
+        D = wigner_D(order, torch.stack([rot(*x) for x in abc]))
+        for x, D_x in zip(abc, D):
+            d = (D_x - torch.tensor(wigner_D_matrix(order, *x.tolist()))).abs().max()
+            print(d.item())
+            assert d < 1e-10
+
+
 if __name__ == "__main__":
     from functools import partial
 
@@ -280,6 +370,10 @@ if __name__ == "__main__":
     _test_change_basis_wigner_to_rot()
     _test_change_basis_wigner_to_rot()
 
+    print("Irreducible repr match lie_learn")
+    for l in range(11):
+        _test_wigner_D_lie_learn(l)
+
     print("Spherical harmonics are solution of Y(rx) = D(r) Y(x)")
     for l in range(7):
         _test_spherical_harmonics(l)
@@ -10,6 +10,7 @@ import copy
 from typing import Dict, List, Tuple
 
 from equivariant_attention.from_se3cnn import utils_steerable
+from equivariant_attention.from_se3cnn.SO3 import wigner_D_all
 from equivariant_attention import fibers
 from equivariant_attention.fibers import Fiber, get_fiber_dict, fiber2tensor, fiber2head
 
@@ -20,38 +21,175 @@ from dgl.nn.pytorch.glob import AvgPooling, MaxPooling
 
 ### Equivariant basis construction
 
+_basis_banks = {}
+
+def get_basis_bank(max_degree, device, dtype=torch.float32):
+    """All Q_J matrices up to `max_degree`, packed into one matrix.
+
+    Row J**2 + k is component k of the spherical harmonics of order J (the
+    layout of the stacked harmonics, see stack_sh()), and every (d_in, d_out)
+    pair owns a column block of (2*d_out+1) * (2*d_in+1) * (2*min(d_in,d_out)+1)
+    columns, ordered (m_out, m_in, J) as the basis tensors. The bank is built
+    once per max_degree, device and dtype.
+
+    Args:
+        max_degree: non-negative int for degree of highest feature type
+        device: device of the bank
+        dtype: dtype of the bank
+    Returns:
+        bank [(2*max_degree+1)**2, total], dict of '<d_in>,<d_out>' -> column slice
+    """
+    key = (max_degree, str(device), dtype)
+    if key not in _basis_banks:
+        blocks, slices, start = [], {}, 0
+        for d_in in range(max_degree+1):
+            for d_out in range(max_degree+1):
+                Js = list(range(abs(d_in-d_out), d_in+d_out+1))
+                block = torch.zeros((2*max_degree+1)**2, (2*d_out+1)*(2*d_in+1), len(Js), dtype=torch.float64)
+                for j, J in enumerate(Js):
+                    # Spherical harmonic projection matrices
+                    block[J**2:(J+1)**2, :, j] = utils_steerable._basis_transformation_Q_J(J, d_in, d_out).T
+                blocks.append(block.flatten(1))
+                slices[f'{d_in},{d_out}'] = slice(start, start + blocks[-1].shape[1])
+                start += blocks[-1].shape[1]
+        _basis_banks[key] = (torch.cat(blocks, 1).to(device=device, dtype=dtype), slices)
+    return _basis_banks[key]
+
+
+def stack_sh(Y, max_J):
+    """Spherical harmonics dict of precompute_sh() as one [..., (max_J+1)**2] tensor."""
+    return torch.cat([Y[J] for J in range(max_J+1)], -1)
+
+
+def sh_parity(max_J, device, dtype=torch.float32):
+    """(-1)**J of every component of the stacked harmonics, the sign they take under x -> -x."""
+    return torch.tensor([(-1.)**J for J in range(max_J+1) for _ in range(2*J+1)], device=device, dtype=dtype)
+
+
+def reverse_edges(G):
+    """Edges with a reverse edge of a higher index, and the index of that reverse edge.
+
+    `edata['rev']` holds the index of the reverse of every edge within its graph,
+    as emitted by the datasets, e.g. datasets.reverse_halves(). It must pair
+    every edge with another one: self-loops have no reverse.
+    """
+    num_edges = G.batch_num_edges().to(G.edata['rev'].device)
+    offsets = torch.repeat_interleave(torch.cumsum(num_edges, 0) - num_edges, num_edges)
+    rev = G.edata['rev'].long() + offsets
+    fwd = torch.nonzero(torch.arange(len(rev), device=rev.device) < rev, as_tuple=True)[0]
+    return fwd, rev[fwd]
+
+
+def get_edge_sh(G, max_J):
+    """Spherical harmonics of the relative positions `edata['d']`, stacked to [E, (max_J+1)**2].
+
+    With reverse edges marked (`edata['rev']`) they are evaluated for one
+    direction of every edge pair only, Y_J(-x) = (-1)^J Y_J(x) gives the other.
+    This saves harmonics compute only: get_basis() still makes the basis of
+    every edge, as the layers consume one per edge, so its memory is unchanged.
+    """
+    d = G.edata['d']
+    with torch.no_grad():
+        if 'rev' not in G.edata:
+            return utils_steerable.precompute_sh_cartesian(d, max_J)
+
+        fwd, rev = reverse_edges(G)
+        Y_fwd = utils_steerable.precompute_sh_cartesian(d[fwd], max_J)
+        Y = Y_fwd.new_empty(len(d), Y_fwd.shape[1])
+        Y.index_copy_(0, fwd, Y_fwd)
+        Y.index_copy_(0, rev, Y_fwd.mul_(sh_parity(max_J, Y.device, Y.dtype)))
+        return Y
+
+
 @profile
-def get_basis(Y, max_degree):
+def get_basis(Y, max_degree, flat: bool=False):
     """Precompute the SE(3)-equivariant weight basis.
 
-    This is called by get_basis_and_r().
+    This is called by get_basis_and_r(). All bases come out of one product of
+    the stacked spherical harmonics with the Q_J bank (get_basis_bank()), and
+    are views into its output.
 
     Args:
-        Y: spherical harmonic dict, returned by utils_steerable.precompute_sh()
+        Y: spherical harmonic dict, returned by utils_steerable.precompute_sh(),
+            or the harmonics stacked to [..., (2*max_degree+1)**2], see stack_sh()
+            and utils_steerable.precompute_sh_cartesian()
         max_degree: non-negative int for degree of highest feature type
+        flat: return the product [E, total] itself, see split_basis()
     Returns:
         dict of equivariant bases, keys are in form '<d_in><d_out>'
     """
-    device = Y[0].device
     # No need to backprop through the basis construction
     with torch.no_grad():
-        basis = {}
-        for d_in in range(max_degree+1):
-            for d_out in range(max_degree+1):
-                K_Js = []
-                for J in range(abs(d_in-d_out), d_in+d_out+1):
-                    # Get spherical harmonic projection matrices
-                    Q_J = utils_steerable._basis_transformation_Q_J(J, d_in, d_out)
-                    Q_J = Q_J.float().T.to(device)
+        if isinstance(Y, dict):
+            Y = stack_sh(Y, 2*max_degree)
+        bank, _ = get_basis_bank(max_degree, Y.device, Y.dtype)
+
+        # Create kernels from spherical harmonics, all (d_in, d_out, J) at once
+        K = torch.matmul(Y.reshape(-1, Y.shape[-1]), bank)
+        return K if flat else split_basis(K, max_degree)
+
+
+def split_basis(K, max_degree):
+    """Bases of all (d_in, d_out) pairs, views into the product K of get_basis(flat=True)."""
+    _, slices = get_basis_bank(max_degree, K.device, K.dtype)
 
-                    # Create kernel from spherical harmonics
-                    K_J = torch.matmul(Y[J], Q_J)
-                    K_Js.append(K_J)
+    # Reshape so can take linear combinations with a dot product
+    basis = {}
+    for d_in in range(max_degree+1):
+        for d_out in range(max_degree+1):
+            size = (-1, 1, 2*d_out+1, 1, 2*d_in+1, 2*min(d_in,d_out)+1)
+            basis[f'{d_in},{d_out}'] = K[:, slices[f'{d_in},{d_out}']].view(*size)
+    return basis
 
-                # Reshape so can take linear combinations with a dot product
-                size = (-1, 1, 2*d_out+1, 1, 2*d_in+1, 2*min(d_in,d_out)+1)
-                basis[f'{d_in},{d_out}'] = torch.stack(K_Js, -1).view(*size)
-        return basis
+
+def sh_rotation(Q, max_J):
+    """Wigner D matrices of the stacked harmonics for rotated positions, x -> x @ Q.
+
+    Y_J(x @ Q) = D^J Y_J(x) for the harmonics of precompute_sh_cartesian(),
+    the rotations Q as drawn by datasets.BatchedRandomRotation.
+
+    Args:
+        Q: rotation matrices [..., 3, 3]
+        max_J: maximum order
+    Returns:
+        list of D^J [..., 2J+1, 2J+1] for J = 0, ..., max_J
+    """
+    # harmonics of order 1 are -x, they turn with Q^T; the D matrices take rotations in the (y, z, x) basis of irr_repr
+    A = torch.tensor([[0, 1, 0], [0, 0, 1], [1, 0, 0]], dtype=Q.dtype, device=Q.device)
+    return wigner_D_all(max_J, A.t() @ Q.transpose(-1, -2) @ A)
+
+
+def rotate_sh(Y, Ds, num_edges):
+    """Harmonics of rotated positions from the harmonics of the positions, one rotation per graph.
+
+    Args:
+        Y: stacked harmonics [E, (max_J+1)**2] of precompute_sh_cartesian(), edges grouped by graph
+        Ds: D matrices of sh_rotation(), [B, 2J+1, 2J+1] per order
+        num_edges: number of edges of every graph
+    Returns:
+        stacked harmonics [E, (max_J+1)**2]
+    """
+    # all orders at once: one block diagonal matrix per graph
+    D = Y.new_zeros(len(num_edges), Y.shape[-1], Y.shape[-1])
+    for J, D_J in enumerate(Ds):
+        D[:, J*J:(J+1)**2, J*J:(J+1)**2] = D_J
+
+    rotated = torch.empty_like(Y)
+    start = 0
+    for g, n in enumerate(num_edges):
+        torch.mm(Y[start:start+n], D[g].t(), out=rotated[start:start+n])
+        start += n
+    return rotated
+
+
+def get_r(d):
+    """Internodal distances of get_basis_and_r(), from the relative positions d [E, 3].
+
+    As the radial functions were trained with: the norm of the spherical
+    coordinates (radius, alpha, beta), not the radius alone.
+    """
+    r_ij = utils_steerable.get_spherical_from_cartesian_torch(d)
+    return torch.sqrt(torch.sum(r_ij**2, -1, keepdim=True))
 
 
 def get_basis_and_r(G, max_degree):
@@ -70,14 +208,12 @@ def get_basis_and_r(G, max_degree):
         dict of equivariant bases, keys are in form '<d_in><d_out>'
         vector of relative distances, ordered according to edge ordering of G
     """
-    # Relative positional encodings (vector)
-    r_ij = utils_steerable.get_spherical_from_cartesian_torch(G.edata['d'])
-    # Spherical harmonic basis
-    Y = utils_steerable.precompute_sh(r_ij, 2*max_degree)
+    # Spherical harmonic basis, all orders stacked
+    Y = get_edge_sh(G, 2*max_degree)
     # Equivariant basis (dict['d_in><d_out>'])
     basis = get_basis(Y, max_degree)
     # Relative distances (scalar)
-    r = torch.sqrt(torch.sum(r_ij**2, -1, keepdim=True))
+    r = get_r(G.edata['d'])
     return basis, r
 
 
@@ -657,3 +793,66 @@ class GMaxPooling(nn.Module):
         return self.pool(G, h)
 
 
+if __name__ == '__main__':
+    import time
+    import dgl
+
+    def get_basis_loop(Y, max_degree):
+        # reference: the former per-(d_in, d_out, J) get_basis
+        device = Y.device
+        Y = {J: Y[..., J*J:(J+1)**2] for J in range(2*max_degree+1)}
+        with torch.no_grad():
+            basis = {}
+            for d_in in range(max_degree+1):
+                for d_out in range(max_degree+1):
+                    K_Js = []
+                    for J in range(abs(d_in-d_out), d_in+d_out+1):
+                        Q_J = utils_steerable._basis_transformation_Q_J(J, d_in, d_out)
+                        Q_J = Q_J.float().T.to(device)
+                        K_J = torch.matmul(Y[J], Q_J)
+                        K_Js.append(K_J)
+                    size = (-1, 1, 2*d_out+1, 1, 2*d_in+1, 2*min(d_in,d_out)+1)
+                    basis[f'{d_in},{d_out}'] = torch.stack(K_Js, -1).view(*size)
+            return basis
+
+    def timed(fn, repeat=20):
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeat):
+            fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return (time.time() - start) / repeat
+
+    # edge vectors of a batch of proteins, e.g. 8 chains of 300 residues with 16 edges each
+    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    d = torch.randn(38400, 3, device=device)
+    for num_degrees in range(2, 6):
+        max_degree = num_degrees - 1
+        Y = utils_steerable.precompute_sh_cartesian(d, 2*max_degree)
+
+        ref, out = get_basis_loop(Y, max_degree), get_basis(Y, max_degree)
+        assert all(torch.allclose(ref[k], out[k], atol=1e-5) for k in ref)
+
+        loop, fused = timed(lambda: get_basis_loop(Y, max_degree)), timed(lambda: get_basis(Y, max_degree))
+        print(f'num_degrees {num_degrees} -> loop: {loop*1e3:.2f} ms, fused: {fused*1e3:.2f} ms ({loop/fused:.1f}x)')
+
+    # both directions of every edge: harmonics of the reverse edges by parity
+    x = torch.randn(2400, 3, device=device)
+    src = torch.randint(0, len(x), (19200,), device=device)
+    dst = (src + torch.randint(1, len(x), src.shape, device=device)) % len(x)
+    src, dst = torch.cat([src, dst]), torch.cat([dst, src])
+    G = dgl.graph((src, dst), num_nodes=len(x))
+    G.edata['d'] = x[dst] - x[src]
+    rev = (torch.arange(len(src), device=device) + len(src)//2) % len(src)
+    for num_degrees in range(2, 6):
+        max_J = 2*(num_degrees - 1)
+        ref = get_edge_sh(G, max_J)
+        full = timed(lambda: get_edge_sh(G, max_J))
+        G.edata['rev'] = rev
+        assert torch.allclose(ref, get_edge_sh(G, max_J), atol=1e-6)
+        paired = timed(lambda: get_edge_sh(G, max_J))
+        del G.edata['rev']
+        print(f'num_degrees {num_degrees} -> harmonics of all edges: {full*1e3:.2f} ms, reverse edges by parity: {paired*1e3:.2f} ms ({full/paired:.1f}x)')
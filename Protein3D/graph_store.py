@@ -0,0 +1,378 @@
+#%%
+"""Sharded, memory-mapped store of preprocessed ProtFunct chain graphs.
+
+Every chain listed in `ProtFunct.pt` is parsed once and its residue indices,
+residue centroids and labelled edge lists (src/dst/bond type) are appended to
+flat per-shard arrays. An index maps `pdbid.chain` to its shard and to the
+node/edge offsets inside that shard, so reading a sample is a few array slices.
+
+Stores are grouped under a signature computed from the distance cutoffs, the
+residue vocabulary and the edge layout (EDGE_LAYOUT): changing any of them
+makes a fresh, empty store, and stale entries are never read back.
+
+For streaming (datasets.ProtFunctStream), every shard also lists its chains
+and their offsets, and every split lists its samples shard by shard with their
+targets (`split_<mode>/`). Streaming a split never loads the global index.
+
+    python graph_store.py --data_address ../data/ProtFunct.pt --store_dir ../data/graph_store --distance_cutoff 3 3.5
+"""
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+
+from multiprocessing import Pool
+
+DTYPE = np.float32
+IDTYPE = np.int32
+
+# per-shard arrays: name -> dtype, node arrays are sliced by node offsets, the others by edge offsets
+NODE_FIELDS = {'res': np.int16, 'x': DTYPE}
+EDGE_FIELDS = {'src': IDTYPE, 'dst': IDTYPE, 'w': np.int8}
+
+# order of the edges of a chain: one direction of every pair, then their reverses in the same order
+# (datasets.reverse_halves()); bump it whenever that order changes
+EDGE_LAYOUT = 1
+
+
+def store_signature(dis_cut, vocab):
+    """Hash of the settings and the edge layout a stored graph depends on.
+
+    Args:
+        dis_cut (list): distance cutoffs of the non-covalent bonds
+        vocab (dict): residue name -> index
+    Returns:
+        short hex digest
+    """
+    key = json.dumps({'dis_cut': [float(d) for d in dis_cut],
+                      'vocab': sorted((k, int(v)) for k, v in vocab.items()),
+                      'edge_layout': EDGE_LAYOUT})
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+class GraphStore(object):
+    """Read-only view of a graph store.
+
+    Shards are memory-mapped lazily, so a store created in the main process can
+    be shared with forked DataLoader workers without copying any array data.
+    """
+    def __init__(self, store_dir, dis_cut, vocab):
+        """Open the store matching `dis_cut` and `vocab`.
+
+        Args:
+            store_dir (str): root directory of the store
+            dis_cut (list): distance cutoffs of the non-covalent bonds
+            vocab (dict): residue name -> index
+        """
+        self.signature = store_signature(dis_cut, vocab)
+        self.path = os.path.join(store_dir, self.signature)
+        self.index = load_index(self.path, self.signature)
+        self.entries = self.index['entries']
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, pdb):
+        return pdb in self.entries
+
+    def _shard(self, k):
+        if k not in self._shards:
+            shard_dir = os.path.join(self.path, self.index['shards'][k])
+            self._shards[k] = {name: np.load(os.path.join(shard_dir, f'{name}.npy'), mmap_mode='r')
+                               for name in {**NODE_FIELDS, **EDGE_FIELDS}}
+        return self._shards[k]
+
+    def sizes(self, pdb):
+        """Return (num_nodes, num_edges) of a stored chain."""
+        _, _, num_nodes, _, num_edges = self.entries[pdb]
+        return num_nodes, num_edges
+
+    def size_manifest(self, pdbs):
+        """[N, 2] number of nodes and edges of the chains `pdbs`, e.g. for samplers.EdgeBudgetBatchSampler.
+
+        Raises:
+            KeyError if a chain is not in the store
+        """
+        return np.array([self.sizes(pdb) for pdb in pdbs], dtype=np.int64).reshape(-1, 2)
+
+    def get(self, pdb):
+        """Read one chain.
+
+        Args:
+            pdb (str): pdb ID and chain ID, e.g. '1abc.A'
+        Returns:
+            residue indices, residue coordinates, edge sources, edge destinations, bond types
+        """
+        k, n0, nn, e0, ne = self.entries[pdb]
+        shard = self._shard(k)
+
+        res = np.array(shard['res'][n0:n0+nn])
+        x = np.array(shard['x'][n0:n0+nn])
+        src = np.array(shard['src'][e0:e0+ne])
+        dst = np.array(shard['dst'][e0:e0+ne])
+        w = np.array(shard['w'][e0:e0+ne])
+
+        return res, x, src, dst, w
+
+
+class GraphStoreWriter(object):
+    """Append chains to a graph store, one shard per `shard_size` chains."""
+    def __init__(self, store_dir, dis_cut, vocab, shard_size: int=4096):
+        """Open (or create) the store matching `dis_cut` and `vocab` for writing.
+
+        Args:
+            store_dir (str): root directory of the store
+            dis_cut (list): distance cutoffs of the non-covalent bonds
+            vocab (dict): residue name -> index
+            shard_size (int, optional): number of chains per shard. Defaults to 4096.
+        """
+        self.signature = store_signature(dis_cut, vocab)
+        self.path = os.path.join(store_dir, self.signature)
+        self.shard_size = shard_size
+        os.makedirs(self.path, exist_ok=True)
+
+        self.index = load_index(self.path, self.signature)
+        self.index['dis_cut'] = list(dis_cut)
+        self.__reset_buffer()
+
+    def __reset_buffer(self):
+        self.buffer = {name: [] for name in {**NODE_FIELDS, **EDGE_FIELDS}}
+        self.pending = {}
+        self.num_nodes = 0
+        self.num_edges = 0
+
+    def __contains__(self, pdb):
+        return pdb in self.index['entries'] or pdb in self.pending
+
+    def add(self, pdb, res, x, src, dst, w):
+        """Buffer one chain, flushing a shard once it is full."""
+        k = len(self.index['shards'])
+        self.pending[pdb] = (k, self.num_nodes, len(res), self.num_edges, len(src))
+        for name, v in zip(['res', 'x', 'src', 'dst', 'w'], [res, x, src, dst, w]):
+            self.buffer[name].append(v)
+        self.num_nodes += len(res)
+        self.num_edges += len(src)
+
+        if len(self.pending) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered chains as a new shard and commit them to the index."""
+        if not self.pending:
+            return
+
+        name = f'shard_{len(self.index["shards"]):05d}'
+        shard_dir = os.path.join(self.path, name)
+        os.makedirs(shard_dir, exist_ok=True)
+        for field, dtype in {**NODE_FIELDS, **EDGE_FIELDS}.items():
+            empty = np.zeros((0, 3) if field == 'x' else 0, dtype=dtype)
+            np.save(os.path.join(shard_dir, f'{field}.npy'), np.concatenate(self.buffer[field] or [empty]).astype(dtype))
+
+        save_shard_table(shard_dir, self.pending)
+
+        self.index['shards'].append(name)
+        self.index['entries'].update(self.pending)
+        save_index(self.path, self.index)
+        self.__reset_buffer()
+
+    def close(self):
+        self.flush()
+
+
+def save_shard_table(shard_dir, entries):
+    """Chain names and (n0, nn, e0, ne) offsets of one shard, in shard order."""
+    np.save(os.path.join(shard_dir, 'names.npy'), np.array(list(entries), dtype=np.bytes_))
+    np.save(os.path.join(shard_dir, 'offsets.npy'), np.array([v[1:] for v in entries.values()], dtype=np.int64).reshape(-1, 4))
+
+
+def write_splits(store_dir, dis_cut, vocab, data, modes=('train', 'valid', 'test')):
+    """Write the sample lists of the splits for streaming.
+
+    Each split is stored as `split_<mode>/{shard,pos,target}.npy`, sorted by
+    shard and by position within the shard, plus `shards.npy` with the row
+    range [shard, start, end) of every shard. Chains missing from the store are
+    left out.
+
+    Args:
+        store_dir (str): root directory of the store
+        dis_cut (list): distance cutoffs of the non-covalent bonds
+        vocab (dict): residue name -> index
+        data (dict): content of ProtFunct.pt
+        modes (tuple, optional): splits to write. Defaults to all.
+    """
+    store = GraphStore(store_dir, dis_cut, vocab)
+
+    # position of every chain in its shard; shard tables of stores built before they existed are filled in
+    shard_entries = [{} for _ in store.index['shards']]
+    for pdb, v in store.entries.items():
+        shard_entries[v[0]][pdb] = v
+    position = {}
+    for k, entries in enumerate(shard_entries):
+        shard_dir = os.path.join(store.path, store.index['shards'][k])
+        if not os.path.exists(os.path.join(shard_dir, 'names.npy')):
+            save_shard_table(shard_dir, entries)
+        position.update((pdb, (k, i)) for i, pdb in enumerate(entries))
+
+    for mode in modes:
+        rows = [(*position[pdb], y) for pdb, y in zip(data[mode]['input_list'], data[mode]['target_list']) if pdb in position]
+        rows = np.array(sorted(rows), dtype=np.int64).reshape(-1, 3)
+
+        split_dir = os.path.join(store.path, f'split_{mode}')
+        os.makedirs(split_dir, exist_ok=True)
+        for k, name in enumerate(['shard', 'pos', 'target']):
+            np.save(os.path.join(split_dir, f'{name}.npy'), rows[:,k].astype(IDTYPE))
+
+        shards, start = np.unique(rows[:,0], return_index=True)
+        end = np.r_[start[1:], len(rows)]
+        np.save(os.path.join(split_dir, 'shards.npy'), np.stack([shards, start, end], -1).astype(np.int64))
+        print(f'Split {mode} -> {len(rows)} of {len(data[mode]["input_list"])} samples in {len(shards)} shards')
+
+
+class StoreSplit(object):
+    """Samples of one split of a graph store, read shard by shard.
+
+    Only the per-shard row ranges are held in memory; the sample lists and the
+    shards are memory-mapped, so memory does not grow with the dataset.
+    """
+    def __init__(self, store_dir, dis_cut, vocab, mode: str='train'):
+        """Open the split written by write_splits().
+
+        Args:
+            store_dir (str): root directory of the store
+            dis_cut (list): distance cutoffs of the non-covalent bonds
+            vocab (dict): residue name -> index
+            mode (str, optional): {train/test/valid}. Defaults to 'train'.
+        """
+        self.path = os.path.join(store_dir, store_signature(dis_cut, vocab))
+        split_dir = os.path.join(self.path, f'split_{mode}')
+        assert os.path.exists(split_dir), f'no {mode} split in {self.path}, run graph_store.py first'
+
+        self.shards = np.load(os.path.join(split_dir, 'shards.npy'))
+        self.rows = {name: np.load(os.path.join(split_dir, f'{name}.npy'), mmap_mode='r') for name in ['pos', 'target']}
+
+    def __len__(self):
+        return len(self.rows['pos'])
+
+    def read_shard(self, k):
+        """Yield (pdb, target, res, x, src, dst, w) of the samples in the k-th shard of the split."""
+        shard, start, end = self.shards[k]
+        shard_dir = os.path.join(self.path, f'shard_{shard:05d}')
+        names = np.load(os.path.join(shard_dir, 'names.npy'))
+        offsets = np.load(os.path.join(shard_dir, 'offsets.npy'))
+        arrays = {name: np.load(os.path.join(shard_dir, f'{name}.npy'), mmap_mode='r')
+                  for name in {**NODE_FIELDS, **EDGE_FIELDS}}
+
+        for pos, target in zip(self.rows['pos'][start:end], self.rows['target'][start:end]):
+            n0, nn, e0, ne = offsets[pos]
+            yield (names[pos].decode(), int(target),
+                   *[np.array(arrays[name][n0:n0+nn]) for name in NODE_FIELDS],
+                   *[np.array(arrays[name][e0:e0+ne]) for name in EDGE_FIELDS])
+
+
+def load_index(path, signature):
+    index_file = os.path.join(path, 'index.pt')
+    if not os.path.exists(index_file):
+        return {'signature': signature, 'shards': [], 'entries': {}}
+
+    index = torch.load(index_file)
+    assert index['signature'] == signature, f'graph store at {path} was built with other settings'
+    return index
+
+
+def save_index(path, index):
+    # write-then-rename so readers never see a half written index
+    tmp_file = os.path.join(path, f'index.pt.{os.getpid()}.tmp')
+    torch.save(index, tmp_file)
+    os.replace(tmp_file, os.path.join(path, 'index.pt'))
+
+
+#%%
+# preprocessing
+_parser = None
+_dis_cut = None
+
+def _init_worker(dis_cut):
+    from pdb_io import StructureParser
+
+    global _parser, _dis_cut
+    _parser = StructureParser()
+    _dis_cut = dis_cut
+
+def _process_entry(pdb):
+    from datasets import ProtProcess
+
+    try:
+        return pdb, ProtProcess.get_chain_arrays(_parser, pdb, _dis_cut)
+    except Exception as e:
+        return pdb, e
+
+def build_graph_store(data_address, store_dir, dis_cut, modes=('train', 'valid', 'test'), num_workers: int=4, shard_size: int=4096):
+    """Preprocess every chain of `data_address` into the graph store at `store_dir`.
+
+    Chains already present in the store are skipped, so the command can be
+    re-run to resume an interrupted build or to add new splits. The sample
+    lists of the splits are (re)written at the end, see write_splits().
+
+    Args:
+        data_address (str): path to ProtFunct.pt
+        store_dir (str): root directory of the store
+        dis_cut (list): distance cutoffs of the non-covalent bonds
+        modes (tuple, optional): splits to preprocess. Defaults to all.
+        num_workers (int, optional): number of parsing processes. Defaults to 4.
+        shard_size (int, optional): number of chains per shard. Defaults to 4096.
+    Returns:
+        list of the pdb chains that failed to parse
+    """
+    from datasets import residue2idx
+
+    data = torch.load(data_address)
+    writer = GraphStoreWriter(store_dir, dis_cut, residue2idx, shard_size=shard_size)
+
+    todo = []
+    for mode in modes:
+        todo += [pdb for pdb in data[mode]['input_list'] if pdb not in writer]
+    todo = list(dict.fromkeys(todo))
+    print(f'Graph store {writer.path} -> {len(writer.index["entries"])} stored, {len(todo)} to preprocess')
+
+    failed = []
+    with Pool(num_workers, initializer=_init_worker, initargs=(dis_cut,)) as pool:
+        for i, (pdb, out) in enumerate(pool.imap(_process_entry, todo, chunksize=8)):
+            if isinstance(out, Exception):
+                print('error pdb: ', pdb, out)
+                failed.append(pdb)
+            else:
+                writer.add(pdb, *out)
+
+            if not (i+1) % 1000:
+                print(f'{i+1}/{len(todo)}')
+    writer.close()
+    write_splits(store_dir, dis_cut, residue2idx, data, modes)
+
+    print(f'Done -> {len(writer.index["entries"])} stored, {len(failed)} failed')
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--data_address', type=str, default='../data/ProtFunct.pt',
+            help="Address to the ProtFunct splits")
+    parser.add_argument('--store_dir', type=str, default='../data/graph_store',
+            help="Root directory of the graph store")
+    parser.add_argument('--distance_cutoff', type=float, nargs='+', default=[3.0, 3.5],
+            help="Distance cutoffs of the non-covalent bonds")
+    parser.add_argument('--modes', type=str, nargs='+', default=['train', 'valid', 'test'],
+            help="Splits to preprocess")
+    parser.add_argument('--shard_size', type=int, default=4096,
+            help="Number of chains per shard")
+    parser.add_argument('--num_workers', type=int, default=4,
+            help="Number of parsing processes")
+
+    FLAGS = parser.parse_args()
+
+    build_graph_store(FLAGS.data_address, FLAGS.store_dir, FLAGS.distance_cutoff,
+                      modes=FLAGS.modes, num_workers=FLAGS.num_workers, shard_size=FLAGS.shard_size)
@@ -11,14 +11,70 @@ import pytorch_lightning as pl
 import torchmetrics as tm
 
 from datasets import *
+from samplers import ChainGroupSampler, ClassBalancedSampler, EdgeBudgetBatchSampler, NegativePairSampler, PairedBatchSampler
+from batch_cache import cached_loader
+from graph_store import store_signature
+from basis_cache import BasisCache
+from unordered_loader import UnorderedLoader
 
 EPS = 1e-13
 
+
+def expand_features(G, atom_feature_size: int, edge_dim: int):
+    """One-hot encode compact residue and bond type indices on the device of G.
+
+    The ProtFunct datasets ship integer indices (int16 residues in G.ndata['f'],
+    int8 bond types in G.edata['w']) instead of dense one-hot tensors; the
+    equivariant layers see the same [N, atom_feature_size, 1] and [E, edge_dim]
+    float features as before. Float features are left unchanged.
+    """
+    if not G.ndata['f'].is_floating_point():
+        G.ndata['f'] = F.one_hot(G.ndata['f'].long(), atom_feature_size).float()[...,None]
+    if not G.edata['w'].is_floating_point():
+        G.edata['w'] = F.one_hot(G.edata['w'].long(), edge_dim).float()
+
+
+def data_files(setting, mode: str, stream: bool=False):
+    """Files the samples of split `mode` are read from, for the batch cache key.
+
+    The split file (ProtFunct.pt), the preflight manifest and the graph store
+    index; a stream reads its split from the store instead of the split file.
+    """
+    files = [] if stream else [setting.data_address]
+    if setting.manifest:
+        files.append(setting.manifest)
+    if setting.store_dir:
+        store_path = os.path.join(setting.store_dir, store_signature(setting.distance_cutoff, residue2idx))
+        files.append(os.path.join(store_path, 'index.pt'))
+        if stream:
+            files.append(os.path.join(store_path, f'split_{mode}', 'shards.npy'))
+    return files
+
 # ##################### Hyperpremeter Setting #########################
 class ExpSetting(object):
-    def __init__(self, distance_cutoff=[3, 3.5], data_address='../data/ProtFunct.pt', log_file=None, log_dir = 'log/', batch_size=4, lr=1e-3, num_epochs=2, num_workers=4, num_layers=2, num_degrees=3, num_channels=20, num_nlayers=0, pooling='avg', head=1, div=4, seed=0, num_class=384, use_classes=None, hyperparameter=None, decoder_mid_dim=60): 
+    def __init__(self, distance_cutoff=[3, 3.5], data_address='../data/ProtFunct.pt', log_file=None, log_dir = 'log/', batch_size=4, lr=1e-3, num_epochs=2, num_workers=4, num_layers=2, num_degrees=3, num_channels=20, num_nlayers=0, pooling='avg', head=1, div=4, seed=0, num_class=384, use_classes=None, hyperparameter=None, decoder_mid_dim=60, store_dir=None, cache_size=32, group_chains=False, fast_reader=True, stream=False, shuffle_buffer=1024, max_edges=None, max_nodes=None, batch_rotation=False, eval_cache_dir=None, manifest=None, class_balance=None, fast_collate=False, max_residues=None, crop_spatial=0.5, unordered=False, max_reorder=None, basis_cache_bytes=None, basis_cache_dir=None, rotate_basis=False, index_dir=None): 
         self.distance_cutoff = distance_cutoff
         self.data_address = data_address
+        self.store_dir = store_dir        # preprocessed graph store, see graph_store.py
+        self.cache_size = cache_size      # Bio.PDB structures cached per data loader worker, i.e. with fast_reader=False or for the files the fast reader leaves to Bio.PDB
+        self.group_chains = group_chains  # load chains of the same PDB entry together: hits of the cache_size cache, and with fast_reader of its last mmCIF/BinaryCIF file (plain PDB chains are read alone)
+        self.fast_reader = fast_reader    # columnar PDB reader instead of Bio.PDB, see pdb_io.py
+        self.index_dir = index_dir        # keep the chain and class indices of the data files in this directory instead of in memory only
+        self.manifest = manifest          # preflight manifest: skip chains that do not parse, see preflight.py
+        self.stream = stream              # stream the graph store shards (ProtFunctStream), needs store_dir
+        self.shuffle_buffer = shuffle_buffer  # samples per worker in the streaming shuffle buffer
+        self.max_edges = max_edges        # edges per batch instead of a fixed batch_size, needs store_dir or manifest
+        self.max_nodes = max_nodes        # optional nodes per batch with max_edges
+        self.max_residues = max_residues  # crop longer chains to this many residues (datasets.ResidueCrop)
+        self.crop_spatial = crop_spatial  # probability of a spatial instead of a contiguous crop
+        self.batch_rotation = batch_rotation  # rotate whole batches on device instead of samples in the workers (opt-in, rotations differ from the per-sample ones)
+        self.fast_collate = fast_collate  # workers return arrays, collate builds one batched graph (collate_arrays), opt-in
+        self.unordered = unordered        # deliver batches as workers complete them, see unordered_loader.py
+        self.max_reorder = max_reorder    # how far a batch may overtake the oldest one still loading
+        self.eval_cache_dir = eval_cache_dir  # collate valid/test batches once and replay them, see batch_cache.py; valid/test chains are then not rotated per sample, with batch_rotation per batch
+        self.basis_cache_bytes = basis_cache_bytes  # keep valid/test bases per chain, see basis_cache.py; valid/test chains are then not rotated
+        self.basis_cache_dir = basis_cache_dir  # spill evicted bases of the basis cache to this directory
+        self.rotate_basis = rotate_basis  # training bases from cached ones by Wigner D rotation, needs basis_cache_bytes and batch_rotation
         self.log_file = log_file
         self.log_dir = log_dir
         self.hyperparameter = hyperparameter
@@ -39,6 +95,7 @@ class ExpSetting(object):
 
         self.num_class = num_class        # number of class in multi-class decoder
         self.use_classes = use_classes
+        self.class_balance = class_balance  # draw training classes ~ count**class_balance, 0 for uniform (ClassBalancedSampler)
 
         self.seed = seed                  # random seed for both numpy and pytorch
 
@@ -91,6 +148,8 @@ class TFN(nn.Module):
         return nn.ModuleList(block0), nn.ModuleList(block1), nn.ModuleList(block2)
 
     def forward(self, G):
+        expand_features(G, self.fibers['in'].n_features, self.edge_dim)
+
         # Compute equivariant weight basis from relative positions
         basis, r = get_basis_and_r(G, self.num_degrees-1)
 
@@ -161,6 +220,8 @@ class SE3Transformer(nn.Module):
         return nn.ModuleList(Gblock), nn.ModuleList(FCblock)
 
     def forward(self, G):
+        expand_features(G, self.fibers['in'].n_features, self.edge_dim)
+
         # Compute equivariant weight basis from relative positions
         basis, r = get_basis_and_r(G, self.num_degrees-1)
 
@@ -217,9 +278,12 @@ class SE3TransformerEncoder(nn.Module):
 
         return nn.ModuleList(Gblock)
 
-    def forward(self, G):
-        # Compute equivariant weight basis from relative positions
-        basis, r = get_basis_and_r(G, self.num_degrees-1)
+    def forward(self, G, basis=None, r=None):
+        expand_features(G, self.fibers['in'].n_features, self.edge_dim)
+
+        # Compute equivariant weight basis from relative positions, unless given (basis_cache.BasisCache)
+        if basis is None:
+            basis, r = get_basis_and_r(G, self.num_degrees-1)
 
         # encoder (equivariant layers)
         h = {'0': G.ndata['f']}
@@ -482,6 +546,10 @@ class ProtMultClass(pl.LightningModule):
         self.__setup_loss()
 
         self.model = self.__build_model()
+        self.stream_datasets = {}         # streaming datasets by mode, see _load_data()
+        self.batch_samplers = {}          # edge budget batch samplers by mode, see _load_data()
+        self.rotation = BatchedRandomRotation() if setting.batch_rotation else None
+        self.basis_cache = BasisCache(setting.num_degrees-1, setting.basis_cache_bytes, setting.basis_cache_dir) if setting.basis_cache_bytes else None
 
     def __setup_loss(self):
         # self.loss_function = torch.nn.NLLLoss()
@@ -535,10 +603,10 @@ class ProtMultClass(pl.LightningModule):
 
         return prob
 
-    def _run_step(self, g, if_sigmoid=True):
+    def _run_step(self, g, if_sigmoid=True, **kwargs):
         """compute forward"""
-        z = g
-        for layer in self.model:
+        z = self.model[0](g, **kwargs)
+        for layer in self.model[1:]:
             z = layer(z)
         if if_sigmoid:
             z = torch.sigmoid(z)
@@ -555,11 +623,41 @@ class ProtMultClass(pl.LightningModule):
 
         return outputs
 
+    def __rotate(self, g, pdb, mode):
+        """Randomly rotated batch, and its basis and r if they come from the basis cache."""
+        if self.basis_cache is not None and mode != 'train':
+            # the encoder is rotation invariant: cached evaluation bases are of the chains as loaded
+            basis, r = self.basis_cache.get_basis_and_r(g, pdb)
+            return g, {'basis': basis, 'r': r}
+        if self.rotation is None:
+            return g, {}
+        if self.basis_cache is None or not self.setting.rotate_basis:
+            return self.rotation(g), {}
+
+        # bases of the rotated chains from the cached ones of the chains as loaded
+        Q = self.rotation.sample(g)
+        basis, r = self.basis_cache.get_basis_and_r(g, pdb, rotation=Q)
+        return self.rotation(g, Q), {'basis': basis, 'r': r}
+
+    def __log_basis_cache(self, mode):
+        if self.basis_cache is None:
+            return
+        self.log(f'{mode}_basis_hit_rate', self.basis_cache.hit_rate)
+        print(f'{mode} --> {self.basis_cache}')
+        self.basis_cache.reset_stats()
+
+    def __log_batch_efficiency(self, mode):
+        sampler = self.batch_samplers.get(mode)
+        if sampler is None or sampler.stats is None:
+            return
+        self.log_dict({f'{mode}_{k}': float(v) for k, v in sampler.stats.items()})
+
     def step(self, batch, mode='train'):
         # print(batch_idx)
         g, targets, pdb = batch
-        
-        preds = self._run_step(g)
+        g, basis = self.__rotate(g, pdb, mode)
+
+        preds = self._run_step(g, **basis)
 
         loss = self.loss_function(preds, targets)
 
@@ -583,6 +681,11 @@ class ProtMultClass(pl.LightningModule):
         self.write_to_epoch_log(f",{epoch_loss:.4f}, {outputs['train_Accuracy']:.4f}, 0\n")
         # self.write_to_epoch_log(f",{epoch_loss:.4f}, {outputs['train_Accuracy']:.4f}, {outputs['train_AUROC']:.4f}\n")
         print(f"train --> loss: {epoch_loss:.4f}, acc: {outputs['train_Accuracy']:.4f}")
+        self.__log_batch_efficiency('train')
+
+        # DataLoader workers copy the dataset, so the next shuffle order is set here
+        if 'train' in self.stream_datasets:
+            self.stream_datasets['train'].set_epoch(self.current_epoch + 1)
 
 
     def validation_step(self, batch, batch_idx):
@@ -597,6 +700,8 @@ class ProtMultClass(pl.LightningModule):
     def validation_epoch_end(self, outputs: list) -> None:
         epoch_loss = torch.stack(outputs).mean()
         outputs = self.__compute_epoch_metrics('valid')
+        self.__log_basis_cache('valid')
+        self.__log_batch_efficiency('valid')
         print(f"valid --> loss: {epoch_loss:.4f}, acc: {outputs['valid_Accuracy']:.4f}")
 
         self.write_to_epoch_log(f",{epoch_loss:.4f}, {outputs['valid_Accuracy']:.4f}, 0")
@@ -612,26 +717,103 @@ class ProtMultClass(pl.LightningModule):
     def test_epoch_end(self, outputs: list) -> None:
         epoch_loss = torch.stack(outputs).mean()
         outputs = self.__compute_epoch_metrics('test')
+        self.__log_basis_cache('test')
+        self.__log_batch_efficiency('test')
 
         self.write_to_test_log(f"{epoch_loss:.4f}, {outputs['test_Accuracy']:.4f}, 0\n")
         # self.write_to_test_log(f"{epoch_loss:.4f}, {outputs['test_Accuracy']:.4f}, {outputs['test_AUROC']:.4f}\n")
 
     def _load_data(self, mode='train'):
+        if self.setting.stream:
+            dataset = ProtFunctStream(
+                self.setting.store_dir,
+                mode=mode,
+                if_transform=self._if_transform(mode),
+                dis_cut=self.setting.distance_cutoff,
+                use_classes=self.setting.use_classes,
+                shuffle=mode == 'train',
+                shuffle_buffer=self.setting.shuffle_buffer,
+                seed=self.setting.seed,
+                return_arrays=self.setting.fast_collate,
+                max_residues=self.setting.max_residues,
+                crop_spatial=self.setting.crop_spatial)
+            self.stream_datasets[mode] = dataset
+
+            return DataLoader(
+                dataset,
+                batch_size=self.setting.batch_size,
+                collate_fn=collate_arrays if self.setting.fast_collate else collate,
+                num_workers=self.setting.num_workers)
+
         dataset = ProtFunctDatasetMultiClass(
             self.setting.data_address, 
             mode=mode, 
-            if_transform=True, 
+            if_transform=self._if_transform(mode), 
             dis_cut=self.setting.distance_cutoff,
-            use_classes=self.setting.use_classes)
+            use_classes=self.setting.use_classes,
+            store_dir=self.setting.store_dir,
+            cache_size=self.setting.cache_size,
+            fast_reader=self.setting.fast_reader,
+            index_dir=self.setting.index_dir,
+            manifest=self.setting.manifest,
+            return_arrays=self.setting.fast_collate,
+            max_residues=self.setting.max_residues,
+            crop_spatial=self.setting.crop_spatial)
+
+        if self.setting.max_edges:
+            # batches packed by size, from the graph store or the preflight manifest
+            dataset.drop_unsized()
+            batch_sampler = EdgeBudgetBatchSampler(
+                dataset.size_manifest(dataset.inputs),
+                self.setting.max_edges,
+                self.setting.max_nodes,
+                shuffle=mode == 'train',
+                seed=self.setting.seed)
+            self.batch_samplers[mode] = batch_sampler
+
+            loader = DataLoader(
+                dataset,
+                batch_sampler=batch_sampler,
+                collate_fn=collate_arrays if self.setting.fast_collate else collate,
+                num_workers=self.setting.num_workers)
+
+            return self._unordered(loader)
+
+        sampler = ChainGroupSampler(dataset.inputs, seed=self.setting.seed) if self.setting.group_chains else None
+        if self.setting.class_balance is not None and mode == 'train':
+            sampler = ClassBalancedSampler(ClassIndex.from_targets(dataset.targets), power=self.setting.class_balance, seed=self.setting.seed)
 
         loader = DataLoader(
             dataset, 
             batch_size=self.setting.batch_size, 
             shuffle=False, 
-            collate_fn=collate, 
+            sampler=sampler,
+            collate_fn=collate_arrays if self.setting.fast_collate else collate, 
             num_workers=self.setting.num_workers)
 
-        return loader
+        return self._unordered(loader)
+
+    def _unordered(self, loader):
+        if not self.setting.unordered:
+            return loader
+        return UnorderedLoader.from_loader(loader, self.setting.max_reorder, self.setting.seed)
+
+    def _if_transform(self, mode):
+        # cached batches are stored un-rotated, cached bases are of un-rotated chains
+        return not self.setting.batch_rotation and not (mode != 'train' and (self.setting.eval_cache_dir or self.setting.basis_cache_bytes))
+
+    def _load_eval_data(self, mode):
+        if not self.setting.eval_cache_dir:
+            return self._load_data(mode)
+
+        settings = {'mode': mode, 'data_address': self.setting.data_address, 'store_dir': self.setting.store_dir,
+                    'stream': self.setting.stream,
+                    'distance_cutoff': self.setting.distance_cutoff, 'use_classes': self.setting.use_classes,
+                    'batch_size': self.setting.batch_size, 'max_edges': self.setting.max_edges, 'max_nodes': self.setting.max_nodes,
+                    'manifest': self.setting.manifest, 'max_residues': self.setting.max_residues, 'crop_spatial': self.setting.crop_spatial,
+                    'edge_layout': EDGE_LAYOUT}
+        return cached_loader(lambda: self._load_data(mode), os.path.join(self.setting.eval_cache_dir, f'multiclass_{mode}'), settings,
+                             files=data_files(self.setting, mode, self.setting.stream))
 
     def train_dataloader(self):
 
@@ -639,11 +821,11 @@ class ProtMultClass(pl.LightningModule):
 
     def val_dataloader(self):
 
-        return self._load_data(mode='valid')
+        return self._load_eval_data(mode='valid')
 
     def test_dataloader(self):
 
-        return self._load_data(mode='test')
+        return self._load_eval_data(mode='test')
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), self.setting.lr)
@@ -683,6 +865,9 @@ class ProtBinaryClass(pl.LightningModule):
         self.__setup_matrices()
 
         self.model = self.__build_model()
+        self.batch_samplers = {}          # edge budget batch samplers by mode, see _load_data()
+        self.rotation = BatchedRandomRotation() if setting.batch_rotation else None
+        self.basis_cache = BasisCache(setting.num_degrees-1, setting.basis_cache_bytes, setting.basis_cache_dir) if setting.basis_cache_bytes else None
         # print(self.model)
 
     def __setup_matrices(self):
@@ -725,10 +910,10 @@ class ProtBinaryClass(pl.LightningModule):
 
         return prob
 
-    def _run_step(self, g):
+    def _run_step(self, g, **kwargs):
         """compute forward"""
-        z = g
-        for layer in self.model:
+        z = self.model[0](g, **kwargs)
+        for layer in self.model[1:]:
             z = layer(z)
 
         return torch.sigmoid(z)
@@ -755,9 +940,39 @@ class ProtBinaryClass(pl.LightningModule):
 
         return outputs
 
+    def __rotate(self, g, pdb, mode):
+        """Randomly rotated batch, and its basis and r if they come from the basis cache."""
+        if self.basis_cache is not None and mode != 'train':
+            # the encoder is rotation invariant: cached evaluation bases are of the chains as loaded
+            basis, r = self.basis_cache.get_basis_and_r(g, pdb)
+            return g, {'basis': basis, 'r': r}
+        if self.rotation is None:
+            return g, {}
+        if self.basis_cache is None or not self.setting.rotate_basis:
+            return self.rotation(g), {}
+
+        # bases of the rotated chains from the cached ones of the chains as loaded
+        Q = self.rotation.sample(g)
+        basis, r = self.basis_cache.get_basis_and_r(g, pdb, rotation=Q)
+        return self.rotation(g, Q), {'basis': basis, 'r': r}
+
+    def __log_basis_cache(self, mode):
+        if self.basis_cache is None:
+            return
+        self.log(f'{mode}_basis_hit_rate', self.basis_cache.hit_rate)
+        print(f'{mode} --> {self.basis_cache}')
+        self.basis_cache.reset_stats()
+
+    def __log_batch_efficiency(self, mode):
+        sampler = self.batch_samplers.get(mode)
+        if sampler is None or sampler.stats is None:
+            return
+        self.log_dict({f'{mode}_{k}': float(v) for k, v in sampler.stats.items()})
+
     def step(self, batch, mode='train'):
         g, targets, pdb = batch
-        preds = self._run_step(g).flatten()
+        g, basis = self.__rotate(g, pdb, mode)
+        preds = self._run_step(g, **basis).flatten()
 
         loss = self.compute_loss(preds)
 
@@ -781,6 +996,7 @@ class ProtBinaryClass(pl.LightningModule):
         outputs = self.__compute_epoch_metrics('train')
 
         self.write_to_epoch_log(f",{epoch_loss:.4f}, {outputs['train_Accuracy']:.4f}, {outputs['train_AUROC']:.4f}\n")
+        self.__log_batch_efficiency('train')
 
     def validation_step(self, batch, batch_idx):
         loss, outputs = self.step(batch, 'valid')
@@ -793,6 +1009,8 @@ class ProtBinaryClass(pl.LightningModule):
     def validation_epoch_end(self, outputs: list) -> None:
         epoch_loss = torch.stack(outputs).mean()
         outputs = self.__compute_epoch_metrics('valid')
+        self.__log_basis_cache('valid')
+        self.__log_batch_efficiency('valid')
 
         self.write_to_epoch_log(f",{epoch_loss:.4f}, {outputs['valid_Accuracy']:.4f}, {outputs['valid_AUROC']:.4f}")
 
@@ -806,6 +1024,8 @@ class ProtBinaryClass(pl.LightningModule):
     def test_epoch_end(self, outputs: list) -> None:
         epoch_loss = torch.stack(outputs).mean()
         outputs = self.__compute_epoch_metrics('test')
+        self.__log_basis_cache('test')
+        self.__log_batch_efficiency('test')
 
         self.write_to_test_log(f"{epoch_loss:.4f}, {outputs['test_Accuracy']:.4f}, {outputs['test_AUROC']:.4f}\n")
 
@@ -813,18 +1033,78 @@ class ProtBinaryClass(pl.LightningModule):
         dataset = ProtFunctDatasetBinary(
             self.setting.data_address, 
             mode=mode, 
-            if_transform=True, 
+            if_transform=self._if_transform(mode), 
             dis_cut=self.setting.distance_cutoff,
-            class_idx=self.class_idx)
+            class_idx=self.class_idx,
+            store_dir=self.setting.store_dir,
+            cache_size=self.setting.cache_size,
+            fast_reader=self.setting.fast_reader,
+            index_dir=self.setting.index_dir,
+            manifest=self.setting.manifest,
+            return_arrays=self.setting.fast_collate,
+            max_residues=self.setting.max_residues,
+            crop_spatial=self.setting.crop_spatial)
+
+        if self.setting.max_edges:
+            # every sample comes with a random negative: budget its mean size
+            dataset.drop_unsized()
+            sizes = dataset.size_manifest(dataset.inputs) + dataset.size_manifest(dataset.inputs_ns).mean(0)
+            batch_sampler = EdgeBudgetBatchSampler(
+                sizes.round().astype(np.int64),
+                self.setting.max_edges,
+                self.setting.max_nodes,
+                shuffle=mode == 'train',
+                seed=self.setting.seed)
+            self.batch_samplers[mode] = batch_sampler
+            # negatives paired with the positives in the main process, as with NegativePairSampler
+            batch_sampler = PairedBatchSampler(
+                batch_sampler,
+                NegativePairSampler(len(dataset.inputs), len(dataset.inputs_ns), seed=self.setting.seed))
+
+            loader = DataLoader(
+                dataset,
+                batch_sampler=batch_sampler,
+                collate_fn=collate_arrays_ns if self.setting.fast_collate else collate_ns,
+                num_workers=self.setting.num_workers)
+
+            return self._unordered(loader)
+
+        # negatives are paired with positives globally and deterministically per epoch
+        if self.setting.group_chains:
+            sampler = ChainGroupSampler(dataset.inputs, seed=self.setting.seed)
+        else:
+            sampler = NegativePairSampler(len(dataset.inputs), len(dataset.inputs_ns), seed=self.setting.seed)
 
         loader = DataLoader(
             dataset, 
             batch_size=self.setting.batch_size, 
             shuffle=False, 
-            collate_fn=collate_ns, 
+            sampler=sampler,
+            collate_fn=collate_arrays_ns if self.setting.fast_collate else collate_ns, 
             num_workers=self.setting.num_workers)
 
-        return loader
+        return self._unordered(loader)
+
+    def _unordered(self, loader):
+        if not self.setting.unordered:
+            return loader
+        return UnorderedLoader.from_loader(loader, self.setting.max_reorder, self.setting.seed)
+
+    def _if_transform(self, mode):
+        # cached batches are stored un-rotated, cached bases are of un-rotated chains
+        return not self.setting.batch_rotation and not (mode != 'train' and (self.setting.eval_cache_dir or self.setting.basis_cache_bytes))
+
+    def _load_eval_data(self, mode):
+        if not self.setting.eval_cache_dir:
+            return self._load_data(mode)
+
+        settings = {'mode': mode, 'data_address': self.setting.data_address, 'store_dir': self.setting.store_dir,
+                    'distance_cutoff': self.setting.distance_cutoff, 'use_classes': self.setting.use_classes,
+                    'batch_size': self.setting.batch_size, 'max_edges': self.setting.max_edges, 'max_nodes': self.setting.max_nodes,
+                    'manifest': self.setting.manifest, 'max_residues': self.setting.max_residues, 'crop_spatial': self.setting.crop_spatial,
+                    'class_idx': self.class_idx, 'seed': self.setting.seed, 'edge_layout': EDGE_LAYOUT}
+        return cached_loader(lambda: self._load_data(mode), os.path.join(self.setting.eval_cache_dir, f'binary{self.class_idx}_{mode}'), settings,
+                             files=data_files(self.setting, mode))
 
     def train_dataloader(self):
 
@@ -832,11 +1112,11 @@ class ProtBinaryClass(pl.LightningModule):
 
     def val_dataloader(self):
 
-        return self._load_data(mode='valid')
+        return self._load_eval_data(mode='valid')
 
     def test_dataloader(self):
 
-        return self._load_data(mode='test')
+        return self._load_eval_data(mode='test')
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), self.setting.lr)
@@ -0,0 +1,683 @@
+#%%
+"""Columnar reader for the ATOM/HETATM records of one chain.
+
+Bio.PDB builds an object per model, chain, residue and atom before we pull a
+handful of numbers back out of them. `read_chain` instead parses the fixed
+PDB columns of a single model/chain straight into NumPy arrays, and
+`get_residue_feature` computes every residue centroid at once with a segment
+reduction.
+
+Both reproduce the Bio.PDB path (PDBParser + ProtProcess.get_residue_feature /
+get_atom_arrays) exactly: same altloc selection (highest occupancy, first on
+ties), same residue order and the same float32 centroids. Files with records
+whose Bio.PDB handling is irregular (point mutations, duplicated atoms mixing
+blank and non-blank altlocs, unparsable fields) are not handled here:
+`read_chain` returns None and callers fall back to Bio.PDB.
+
+A chain index of byte ranges per (model, chain) is built once per file
+(`chain_index`), so reading a chain seeks straight to its records and parse
+time scales with the chain rather than with the whole entry. It is kept in
+memory, and in an index directory outside the data tree if one is given.
+
+Besides PDB files, the atom sites of mmCIF and BinaryCIF files are read into
+the same per-atom fields, all of them plain or gzip-compressed (FORMATS), and
+`StructureParser` is the matching Bio.PDB parser used as fallback.
+
+    python pdb_io.py ../data/pdb/1abc.pdb ../data/pdb/1abc.cif.gz ...    # check and read throughput per format
+"""
+import os
+import re
+import gzip
+import json
+import hashlib
+
+import numpy as np
+
+from Bio.PDB import PDBParser, MMCIFParser
+from Bio.PDB.StructureBuilder import StructureBuilder
+
+DTYPE = np.float32
+IDTYPE = np.int32
+
+RECORD_WIDTH = 80
+
+# file extensions in order of preference: plain PDB files have a chain index
+FORMATS = ['.pdb', '.pdb.gz', '.bcif', '.bcif.gz', '.cif', '.cif.gz']
+
+
+def structure_format(path):
+    """'pdb', 'cif' or 'bcif', regardless of gzip compression."""
+    name = path[:-3] if path.endswith('.gz') else path
+    fmt = os.path.splitext(name)[1][1:]
+    if fmt not in ('pdb', 'ent', 'cif', 'bcif'):
+        raise ValueError(f'unknown structure format: {path}')
+    return 'pdb' if fmt == 'ent' else fmt
+
+
+def find_structure(pdb_dir, pdb_id, formats=FORMATS):
+    """Path of the first file of `pdb_id` found in `pdb_dir`, None if there is none."""
+    for ext in formats:
+        path = os.path.join(pdb_dir, f'{pdb_id}{ext}')
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def open_structure(path):
+    """Binary handle of a structure file, decompressing gzip files as they are read."""
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def _model_chain_lines(lines, chain_id, model: int=0):
+    """Select the ATOM/HETATM lines of one model and chain.
+
+    Models are counted as Bio.PDB does: every MODEL record, and every atom
+    outside of an open model, starts a new one. END and CONECT stop parsing.
+
+    Returns:
+        list of lines and, for each, whether the previous atom line of the model
+        belonged to another chain (Bio.PDB then starts a new residue)
+    """
+    chain_id = chain_id.encode()
+    out, chain_switch = [], []
+    model_idx, model_open, prev_chain = -1, False, None
+    for line in lines:
+        rec = line[:6]
+        if rec == b'ATOM  ' or rec == b'HETATM':
+            if not model_open:
+                model_idx += 1
+                model_open, prev_chain = True, None
+            if model_idx > model:
+                break
+
+            c = line[21:22]
+            if model_idx == model and c == chain_id:
+                out.append(line)
+                chain_switch.append(prev_chain != c)
+            prev_chain = c
+        elif rec == b'MODEL ':
+            model_idx += 1
+            model_open, prev_chain = True, None
+            if model_idx > model:
+                break
+        elif rec == b'ENDMDL':
+            model_open, prev_chain = False, None
+        elif rec == b'END   ' or rec == b'CONECT':
+            break
+
+    return out, np.array(chain_switch, dtype=bool)
+
+
+def _columns(lines):
+    """Fixed-width view of the records: [num_lines, RECORD_WIDTH] uint8."""
+    buf = b''.join(line[:RECORD_WIDTH].ljust(RECORD_WIDTH) for line in lines)
+    return np.frombuffer(buf, dtype=np.uint8).reshape(len(lines), RECORD_WIDTH)
+
+
+def _field(cols, start, end):
+    return cols[:, start:end].copy().view(f'S{end-start}').ravel()
+
+
+def parse_records(lines, chain_switch):
+    """Turn the ATOM/HETATM lines of one chain into atom and residue arrays.
+
+    Args:
+        lines (list): ATOM/HETATM records of one model and chain, in file order
+        chain_switch (ndarray): True where Bio.PDB starts a new residue because the chain changed
+    Returns:
+        dict of arrays (see read_chain), or None if Bio.PDB handling is irregular
+    """
+    if not lines:
+        return None
+    cols = _columns(lines)
+
+    try:
+        coo = np.stack([_field(cols, s, s+8).astype(np.float64) for s in (30, 38, 46)], -1).astype(DTYPE)
+        occupancy = _field(cols, 54, 60).astype(np.float64)
+        resseq = _field(cols, 22, 26).astype(np.int64)
+    except ValueError:
+        return None
+
+    fields = {'coo': coo,
+              'occupancy': occupancy,
+              'resseq': resseq,
+              'hetatm': _field(cols, 0, 6) == b'HETATM',
+              'resname': _field(cols, 17, 20),
+              'icode': _field(cols, 26, 27),
+              'altloc': _field(cols, 16, 17),
+              'fullname': _field(cols, 12, 16)}
+    return parse_fields(fields, chain_switch)
+
+
+def parse_fields(fields, chain_switch):
+    """Group the atoms of one chain into residues, resolving altlocs as Bio.PDB does.
+
+    Args:
+        fields (dict): per atom 'coo' [A, 3] (float32), 'occupancy', 'resseq',
+            'hetatm' (bool) and the byte strings 'resname', 'icode', 'altloc', 'fullname'
+        chain_switch (ndarray): True where Bio.PDB starts a new residue because the chain changed
+    Returns:
+        dict of arrays (see read_chain), or None if Bio.PDB handling is irregular
+    """
+    coo, occupancy, resseq = fields['coo'], fields['occupancy'], fields['resseq']
+    hetatm, resname, icode = fields['hetatm'], fields['resname'], fields['icode']
+    altloc, fullname = fields['altloc'], fields['fullname']
+    water = hetatm & ((resname == b'HOH') | (resname == b'WAT'))
+
+    # residue runs: Bio.PDB starts a residue when (hetflag, resseq, icode) or the name changes
+    flag = np.where(water, 2, np.where(hetatm, 1, 0))
+    start = chain_switch.copy()
+    start[0] = True
+    start[1:] |= (flag[1:] != flag[:-1]) | (resseq[1:] != resseq[:-1]) | (icode[1:] != icode[:-1]) | (resname[1:] != resname[:-1])
+    run_starts = np.flatnonzero(start)
+    run = np.cumsum(start) - 1
+
+    # map runs to residues; repeated residue ids reuse (ATOM) or orphan (HETATM) their atoms
+    residues, res_ids, res_names = {}, [], []
+    run_res = np.empty(len(run_starts), dtype=np.int64)
+    for k, i in enumerate(run_starts):
+        name = resname[i].decode()
+        het = ' ' if flag[i] == 0 else ('W' if flag[i] == 2 else 'H_' + name)
+        res_id = (het, int(resseq[i]), icode[i].decode() or ' ')
+        if res_id not in residues:
+            residues[res_id] = len(res_ids)
+            res_ids.append(res_id)
+            res_names.append(name)
+            run_res[k] = residues[res_id]
+        elif het == ' ' and res_names[residues[res_id]] == name:
+            run_res[k] = residues[res_id]
+        elif het == ' ':
+            return None                                     # point mutation (DisorderedResidue)
+        else:
+            run_res[k] = -1                                 # atoms go to a detached residue
+    atom_res = run_res[run]
+
+    # atoms sharing a name within a residue: altlocs or duplicates
+    name = np.char.strip(fullname)
+    names, name_key = np.unique(name, return_inverse=True)
+    key = atom_res * len(names) + name_key.ravel()
+    _, inverse, counts = np.unique(key, return_inverse=True, return_counts=True)
+    keep = atom_res >= 0
+    coo = coo.copy()
+    for g in np.flatnonzero(counts > 1):
+        rows = np.flatnonzero(inverse.ravel() == g)
+        if atom_res[rows[0]] < 0:
+            continue
+        if len(set(fullname[rows].tolist())) > 1:
+            return None                                     # names differing only in spaces
+        blank = altloc[rows] == b' '
+        if blank.all():
+            keep[rows[1:]] = False                          # atom defined twice: later ones dropped
+        elif blank.any():
+            return None                                     # blank and non-blank altlocs mixed
+        else:
+            # DisorderedAtom: first highest occupancy is selected, kept in place of the first altloc
+            coo[rows[0]] = coo[rows[np.argmax(occupancy[rows])]]
+            keep[rows[1:]] = False
+
+    # group atoms by residue, keeping file order within a residue
+    coo, atom_res = coo[keep], atom_res[keep]
+    order = np.argsort(atom_res, kind='stable')
+    coo, atom_res = coo[order], atom_res[order]
+
+    res_order = np.empty(len(res_ids), dtype=np.int64)
+    res_order[sorted(range(len(res_ids)), key=lambda k: res_ids[k])] = np.arange(len(res_ids))
+
+    return {'coo': coo,
+            'atom_res': atom_res,
+            'res_name': np.array(res_names),
+            'res_seq': np.array([i[1] for i in res_ids], dtype=np.int64),
+            'res_order': res_order}
+
+
+#%%
+# mmCIF / BinaryCIF
+_CIF_TOKEN = re.compile(rb"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
+
+def _cif_tokens(line):
+    if b"'" not in line and b'"' not in line:
+        return line.split()
+    return [a or b or c for a, b, c in _CIF_TOKEN.findall(line)]
+
+
+def _read_cif_atom_site(f):
+    """Columns of the `_atom_site` loop of an mmCIF file.
+
+    Lines are tokenized as they are read and reading stops at the end of the
+    loop, so the rest of the file is never decompressed.
+
+    Returns:
+        dict of item name (without `_atom_site.`) -> byte string array, None if
+        the file has no `_atom_site` loop or values spanning several lines
+    """
+    names, tokens = [], []
+    in_loop = False
+    for line in f:
+        line = line.strip()
+        if tokens or (names and line[:1] != b'_'):
+            # atom_site rows, up to the next category
+            if not line:
+                continue
+            if line[:1] in (b'#', b'_') or line.startswith((b'loop_', b'data_')):
+                break
+            if line[:1] == b';':
+                return None                                 # multi-line text value
+            tokens += _cif_tokens(line)
+        elif line.startswith(b'loop_'):
+            in_loop = True
+        elif in_loop and line.startswith(b'_atom_site.'):
+            names.append(line[11:].split()[0].decode())
+        elif line[:1] == b'_':
+            in_loop = False
+
+    if not names or not tokens or len(tokens) % len(names):
+        return None
+    table = np.array(tokens).reshape(-1, len(names))
+    return {name: table[:,k] for k, name in enumerate(names)}
+
+
+_BCIF_DTYPES = {1: '<i1', 2: '<i2', 3: '<i4', 4: '<u1', 5: '<u2', 6: '<u4', 32: '<f4', 33: '<f8'}
+
+def _unpack_integers(values, encoding):
+    # values at the limits of the packed type continue into the next one
+    info = np.iinfo(values.dtype)
+    values = values.astype(np.int64)
+    more = values == info.max
+    if not encoding['isUnsigned']:
+        more |= values == info.min
+    starts = np.flatnonzero(np.r_[True, ~more[:-1]])
+    return np.add.reduceat(values, starts).astype('<u4' if encoding['isUnsigned'] else '<i4')
+
+def _bcif_decode(data):
+    """Decode one BinaryCIF data block, applying its encodings last to first."""
+    values = data['data']
+    for encoding in reversed(data['encoding']):
+        kind = encoding['kind']
+        if kind == 'ByteArray':
+            values = np.frombuffer(values, _BCIF_DTYPES[encoding['type']])
+        elif kind == 'FixedPoint':
+            values = np.divide(values, encoding['factor'], dtype=_BCIF_DTYPES[encoding['srcType']])
+        elif kind == 'IntervalQuantization':
+            step = (encoding['max'] - encoding['min']) / (encoding['numSteps'] - 1)
+            values = (encoding['min'] + step * values).astype(_BCIF_DTYPES[encoding['srcType']])
+        elif kind == 'RunLength':
+            values = np.repeat(values[0::2].astype(_BCIF_DTYPES[encoding['srcType']]), values[1::2])
+        elif kind == 'Delta':
+            values = values.astype(_BCIF_DTYPES[encoding['srcType']])
+            values[0] += encoding['origin']
+            values = np.cumsum(values, dtype=values.dtype)
+        elif kind == 'IntegerPacking':
+            values = _unpack_integers(values, encoding)
+        elif kind == 'StringArray':
+            offsets = _bcif_decode({'data': encoding['offsets'], 'encoding': encoding['offsetEncoding']})
+            index = _bcif_decode({'data': values, 'encoding': encoding['dataEncoding']})
+            strings = encoding['stringData']
+            unique = np.array([strings[a:b].encode() for a, b in zip(offsets[:-1], offsets[1:])] + [b''])
+            values = unique[np.where(index < 0, len(unique) - 1, index)]
+        else:
+            raise ValueError(f'unknown BinaryCIF encoding: {kind}')
+    return values
+
+def _read_bcif_atom_site(f):
+    """Columns of the `_atom_site` category of a BinaryCIF file, as _read_cif_atom_site()."""
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError('reading BinaryCIF files requires msgpack (pip install msgpack)') from None
+
+    data = msgpack.unpack(f, raw=False)
+    for block in data['dataBlocks']:
+        for category in block['categories']:
+            if category['name'] != '_atom_site':
+                continue
+
+            columns = {}
+            for column in category['columns']:
+                values = _bcif_decode(column['data'])
+                if column.get('mask') is not None:
+                    mask = _bcif_decode(column['mask'])
+                    if mask.any():
+                        values = values.astype('S')                 # '.' and '?' as in mmCIF text
+                        values[mask == 1] = b'.'
+                        values[mask == 2] = b'?'
+                columns[column['name']] = values
+            return columns
+    return None
+
+
+_atom_sites = {}
+
+def read_atom_site(path):
+    """Atom site columns of an mmCIF or BinaryCIF file.
+
+    The columns of the last file read are kept, as the chains of one entry are
+    usually read one after the other.
+    """
+    version = os.path.getmtime(path)
+    if path not in _atom_sites or _atom_sites[path][0] != version:
+        with open_structure(path) as f:
+            columns = _read_bcif_atom_site(f) if structure_format(path) == 'bcif' else _read_cif_atom_site(f)
+        _atom_sites.clear()
+        _atom_sites[path] = (version, columns)
+    return _atom_sites[path][1]
+
+
+def _unassigned(values):
+    return np.where((values == b'.') | (values == b'?') | (values == b''), b' ', values)
+
+def cif_chain_fields(columns, chain_id, model: int=0):
+    """Select the atom sites of one model and chain, as MMCIFParser does.
+
+    Chains are the author chain IDs (`auth_asym_id`), which are the chain IDs
+    of the PDB format, and residues are numbered by `auth_seq_id`.
+
+    Returns:
+        per atom fields and chain switches (see parse_fields()), None if the
+        columns are incomplete or unparsable
+    Raises:
+        KeyError if the chain is not in the model
+    """
+    if columns is None or 'pdbx_PDB_model_num' not in columns or 'auth_asym_id' not in columns:
+        return None
+    seq = columns['auth_seq_id'] if 'auth_seq_id' in columns else columns['label_seq_id']
+    rows = np.flatnonzero(seq != b'.')                               # MMCIFParser skips these sites
+
+    # models start whenever the model number changes
+    model_num = columns['pdbx_PDB_model_num'][rows]
+    model_idx = np.cumsum(np.r_[True, model_num[1:] != model_num[:-1]]) - 1
+    rows = rows[model_idx == model]
+
+    chain = columns['auth_asym_id'][rows]
+    chain_switch = np.r_[True, chain[1:] != chain[:-1]]
+    mine = chain == (chain_id.encode() if chain.dtype.kind == 'S' else chain_id)
+    if not mine.any():
+        raise KeyError(chain_id)
+    rows, chain_switch = rows[mine], chain_switch[mine]
+
+    try:
+        fields = {'coo': np.stack([columns[k][rows].astype(np.float64) for k in ('Cartn_x', 'Cartn_y', 'Cartn_z')], -1).astype(DTYPE),
+                  'occupancy': columns['occupancy'][rows].astype(np.float64),
+                  'resseq': seq[rows].astype(np.int64),
+                  'hetatm': columns['group_PDB'][rows] == b'HETATM',
+                  'resname': columns['label_comp_id'][rows],
+                  'icode': _unassigned(columns['pdbx_PDB_ins_code'][rows]),
+                  'altloc': _unassigned(columns['label_alt_id'][rows]),
+                  'fullname': columns['label_atom_id'][rows]}
+    except (KeyError, ValueError):
+        return None
+    return fields, chain_switch
+
+
+class StructureParser(object):
+    """Bio.PDB parser for every supported format, plain or gzip-compressed.
+
+    PDB files go through PDBParser and mmCIF files through MMCIFParser.
+    BinaryCIF structures are built from the decoded atom sites with the same
+    author chain IDs (Bio.PDB's BinaryCIFParser uses `label_asym_id`).
+    """
+    def __init__(self):
+        self.pdb_parser = PDBParser(QUIET=True)
+        self.cif_parser = MMCIFParser(QUIET=True)
+
+    def get_structure(self, id, file):
+        fmt = structure_format(file)
+        if fmt == 'pdb' and not file.endswith('.gz'):
+            return self.pdb_parser.get_structure(id, file)
+        if fmt != 'bcif':
+            with gzip.open(file, 'rt') if file.endswith('.gz') else open(file) as f:
+                parser = self.pdb_parser if fmt == 'pdb' else self.cif_parser
+                return parser.get_structure(id, f)
+
+        columns = read_atom_site(file)
+        seq = columns['auth_seq_id']
+        builder = StructureBuilder()
+        builder.init_structure(id)
+        builder.init_seg(' ')
+        model, chain, residue = None, None, None
+        for i in np.flatnonzero(seq != b'.') if seq.dtype.kind == 'S' else range(len(seq)):
+            if columns['pdbx_PDB_model_num'][i] != model:
+                model, chain = columns['pdbx_PDB_model_num'][i], None
+                builder.init_model(len(builder.structure), int(model))
+            if columns['auth_asym_id'][i] != chain:
+                chain, residue = columns['auth_asym_id'][i], None
+                builder.init_chain(chain.decode())
+
+            resname = columns['label_comp_id'][i].decode()
+            field = ' ' if columns['group_PDB'][i] != b'HETATM' else ('W' if resname in ('HOH', 'WAT') else 'H')
+            icode = _unassigned(columns['pdbx_PDB_ins_code'][i:i+1])[0].decode()
+            if (field, seq[i], icode, resname) != residue:
+                residue = (field, seq[i], icode, resname)
+                builder.init_residue(resname, field, int(seq[i]), icode)
+
+            name = columns['label_atom_id'][i].decode()
+            coord = np.array([columns[k][i] for k in ('Cartn_x', 'Cartn_y', 'Cartn_z')], np.float64).astype(DTYPE)
+            builder.init_atom(name, coord, float(columns['B_iso_or_equiv'][i]), float(columns['occupancy'][i]),
+                              _unassigned(columns['label_alt_id'][i:i+1])[0].decode(), name,
+                              serial_number=int(columns['id'][i]), element=columns['type_symbol'][i].decode().upper())
+        return builder.get_structure()
+
+
+def build_chain_index(path):
+    """Byte ranges of every (model, chain) block of a PDB file.
+
+    A chain usually is one ATOM block plus one HETATM block after the TER
+    record, so every (model, chain) maps to a list of [start, end) ranges,
+    each beginning at an atom line that follows another chain (or a model
+    start). Models and the END/CONECT stop follow _model_chain_lines().
+
+    Returns:
+        dict of '<model>:<chain>' -> list of [start, end] byte ranges
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    ranges = {}
+    model_idx, model_open, prev_chain = -1, False, None
+    offset = 0
+    for line in data.splitlines(keepends=True):
+        rec = line[:6]
+        if rec == b'ATOM  ' or rec == b'HETATM':
+            if not model_open:
+                model_idx += 1
+                model_open, prev_chain = True, None
+
+            c = line[21:22]
+            key = f'{model_idx}:{c.decode()}'
+            if prev_chain == c:
+                ranges[key][-1][1] = offset + len(line)
+            else:
+                ranges.setdefault(key, []).append([offset, offset + len(line)])
+            prev_chain = c
+        elif rec == b'MODEL ':
+            model_idx += 1
+            model_open, prev_chain = True, None
+        elif rec == b'ENDMDL':
+            model_open, prev_chain = False, None
+        elif rec == b'END   ' or rec == b'CONECT':
+            break
+        offset += len(line)
+
+    return ranges
+
+
+def index_path(path, index_dir, suffix):
+    """File of an index of the data file `path` in `index_dir`.
+
+    Named after the file and a hash of its absolute path, so files of the same
+    name in different data directories do not share an index.
+    """
+    h = hashlib.blake2b(os.path.abspath(path).encode(), digest_size=8).hexdigest()
+    return os.path.join(index_dir, f'{os.path.basename(path)}.{h}{suffix}')
+
+
+_chain_indices = {}
+
+def chain_index(path, index_dir: str=None):
+    """Chain index of a PDB file, kept in memory and, with an `index_dir`, in a file there.
+
+    The index is rebuilt when the size or modification time of the file changes.
+    Nothing is written next to the data; if the index directory is not writable
+    the index is kept in memory only.
+    """
+    stat = os.stat(path)
+    version = [stat.st_size, stat.st_mtime_ns]
+    if path in _chain_indices and _chain_indices[path][0] == version:
+        return _chain_indices[path][1]
+
+    index_file = index_path(path, index_dir, '.chains') if index_dir else None
+    index = None
+    if index_file and os.path.exists(index_file):
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+        if index is not None and index.get('version') != version:
+            index = None
+
+    if index is None:
+        index = {'version': version, 'ranges': build_chain_index(path)}
+        if index_file:
+            tmp_file = f'{index_file}.{os.getpid()}.tmp'
+            try:
+                os.makedirs(index_dir, exist_ok=True)
+                with open(tmp_file, 'w') as f:
+                    json.dump(index, f)
+                os.replace(tmp_file, index_file)
+            except OSError:
+                pass                                        # keep it in memory
+
+    _chain_indices[path] = (version, index['ranges'])
+    return index['ranges']
+
+
+def read_chain(path, chain_id, model: int=0, use_index: bool=True, index_dir: str=None):
+    """Read one chain of a structure file into columnar arrays.
+
+    PDB, mmCIF and BinaryCIF files are read, each plain or gzip-compressed
+    (see FORMATS). Compressed files are decompressed as a stream and only up
+    to the end of the requested model (PDB) or of the atom sites (mmCIF).
+
+    Args:
+        path (str): structure file
+        chain_id (str): chain ID
+        model (int, optional): model index. Defaults to 0.
+        use_index (bool, optional): seek to the chain through the file's chain
+            index instead of scanning the whole file (plain PDB files only). Defaults to True.
+        index_dir (str, optional): directory the chain indices are kept in, see chain_index(). Defaults to None (in memory).
+    Returns:
+        dict with atom coordinates 'coo' [A, 3] (float32, grouped by residue),
+        'atom_res' [A], and per residue 'res_name', 'res_seq' and 'res_order'
+        (rank in Bio.PDB residue order) [R]; None if the chain needs Bio.PDB
+    Raises:
+        KeyError if the chain is not in the model
+    """
+    if structure_format(path) != 'pdb':
+        selected = cif_chain_fields(read_atom_site(path), chain_id, model)
+        return None if selected is None else parse_fields(*selected)
+
+    if not use_index or path.endswith('.gz'):
+        with open_structure(path) as f:
+            lines, chain_switch = _model_chain_lines((l.rstrip(b'\r\n') for l in f), chain_id, model)
+        if not lines:
+            raise KeyError(chain_id)
+        return parse_records(lines, chain_switch)
+
+    lines, chain_switch = [], []
+    with open(path, 'rb') as f:
+        for start, end in chain_index(path, index_dir)[f'{model}:{chain_id}']:
+            f.seek(start)
+            block = [l for l in f.read(end - start).splitlines() if l[:6] == b'ATOM  ' or l[:6] == b'HETATM']
+            lines += block
+            chain_switch += [True] + [False] * (len(block) - 1)
+
+    return parse_records(lines, np.array(chain_switch, dtype=bool))
+
+
+def get_atom_arrays(atoms):
+    """Atom arrays in the layout of ProtProcess.get_atom_arrays()."""
+    return atoms['coo'].astype(np.float64), atoms['atom_res'], atoms['res_order'], atoms['res_seq']
+
+
+def get_residue_feature(atoms, residue2idx):
+    """Residue indices and centroids, as ProtProcess.get_residue_feature().
+
+    Waters and residues outside `residue2idx` are skipped.
+
+    Args:
+        atoms (dict): output of read_chain()
+        residue2idx (dict): residue name -> index
+    Returns:
+        residue indices [N], residue centroids [N, 3]
+    """
+    res_name = atoms['res_name']
+    keep = np.array([n != 'HOH' and n in residue2idx for n in res_name], dtype=bool)
+    if not keep.any():
+        raise ValueError('no residues in chain')
+
+    # segment sums over the residue-grouped atoms, accumulated atom by atom in
+    # file order (as ndarray.mean does) so the float32 results are identical
+    starts = np.flatnonzero(np.r_[True, atoms['atom_res'][1:] != atoms['atom_res'][:-1]])
+    counts = np.diff(np.r_[starts, len(atoms['atom_res'])])
+    coo = atoms['coo'][starts].copy()
+    for k in range(1, counts.max()):
+        seg = np.flatnonzero(counts > k)
+        coo[seg] += atoms['coo'][starts[seg] + k]
+    coo = coo / counts[:,None].astype(DTYPE)
+
+    res = np.array([residue2idx[n] for n in res_name[keep]]).astype(IDTYPE)
+    return res, coo[keep]
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import warnings
+    warnings.filterwarnings("ignore")
+
+    from datasets import ProtProcess, residue2idx
+
+    # per format: files, bytes on disk, seconds per reader
+    parser = StructureParser()
+    stats = {}
+    for path in sys.argv[1:]:
+        fmt = next(ext for ext in sorted(FORMATS, key=len, reverse=True) if path.endswith(ext))
+        readers = {'columnar': True, 'columnar, full scan': False} if fmt == '.pdb' else {'columnar': True}
+        stat = stats.setdefault(fmt, {'files': 0, 'bytes': 0, 'Bio.PDB': 0})
+        stat['files'] += 1
+        stat['bytes'] += os.path.getsize(path)
+
+        start = time.time()
+        structure = parser.get_structure('a', path)
+        bio = {}
+        for c in structure[0]:
+            try:
+                bio[c.id] = (ProtProcess.get_residue_feature(c), ProtProcess.get_atom_arrays(c))
+            except ValueError:
+                continue                                    # no residues of the vocabulary
+        stat['Bio.PDB'] += time.time() - start
+
+        if fmt == '.pdb':
+            chain_index(path)                               # built once per file
+        for name, use_index in readers.items():
+            _atom_sites.clear()
+            start = time.time()
+            col = {}
+            for c in bio:
+                atoms = read_chain(path, c, use_index=use_index)
+                col[c] = None if atoms is None else (get_residue_feature(atoms, residue2idx), get_atom_arrays(atoms))
+            stat[name] = stat.get(name, 0) + time.time() - start
+
+            for c, ((res, x), arrays) in bio.items():
+                if col[c] is None:
+                    print(f'{path} {c}: falls back to Bio.PDB')
+                    continue
+                (res_c, x_c), arrays_c = col[c]
+                assert np.array_equal(res, res_c) and np.array_equal(x, x_c), (path, c)
+                assert all(np.array_equal(a, b) for a, b in zip(arrays, arrays_c)), (path, c)
+
+    # read throughput in MB of file on disk per second
+    for fmt, stat in stats.items():
+        files, size = stat.pop('files'), stat.pop('bytes') / 2**20
+        times = ', '.join(f'{k}: {v:.3f}s ({size/max(v, 1e-9):.1f} MB/s)' for k, v in stat.items())
+        print(f'{fmt:9s} {files} files, {size:.1f} MB -> {times}')
@@ -0,0 +1,259 @@
+#%%
+"""Bulk PDB prefetcher.
+
+Downloads every PDB entry referenced by a `training.txt` style ID list or by
+`ProtFunct.pt` ahead of training, so DataLoader workers never block on the
+network. Files are fetched gzip-compressed through pooled HTTP sessions,
+retried with exponential backoff, and written atomically (download to a
+temporary file, then rename), so a crash never leaves a truncated `.pdb`
+behind. A manifest in the output directory records which entries are present
+and which the server does not have; it is saved as the download goes, and a
+rerun skips both.
+
+Entries too large for the PDB format only exist as mmCIF: formats are tried
+in order, PDB first. With `--compress` files are kept gzip-compressed on
+disk; pdb_io.read_chain() reads every format, plain or compressed.
+
+    python prefetch.py --id_list ../data/ProtFunct.pt --out_dir ../data/pdb
+    python prefetch.py --base_url https://models.rcsb.org --formats bcif --compress
+"""
+import os
+import gzip
+import json
+import time
+import argparse
+import threading
+
+import requests
+
+import pdb_io
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
+RCSB_URL = 'https://files.rcsb.org/download'
+FORMATS = ('pdb', 'cif')
+MANIFEST = 'manifest.json'
+
+
+def load_pdb_ids(id_list):
+    """Read the unique pdb IDs of a list of `pdbid.chain` entries.
+
+    Args:
+        id_list (str): `ProtFunct.pt` or a text file with one `pdbid.chain` per line
+    Returns:
+        list of pdb IDs, in order of first appearance
+    """
+    if id_list.endswith('.pt'):
+        import torch
+        data = torch.load(id_list)
+        entries = [pdb for mode in data.values() for pdb in mode['input_list']]
+    else:
+        with open(id_list) as f:
+            entries = [line.split(',')[0].strip() for line in f if line.strip()]
+
+    return list(dict.fromkeys(pdb.split('.')[0] for pdb in entries))
+
+
+def write_atomic(outfile, data: bytes):
+    """Write `data` to `outfile` through a temporary file in the same directory."""
+    tmp_file = f'{outfile}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, outfile)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+class PDBPrefetcher(object):
+    """Concurrent PDB downloader with per-thread pooled sessions."""
+    def __init__(self, out_dir, base_url: str=RCSB_URL, num_workers: int=16, retries: int=4, backoff: float=0.5, timeout: float=30.,
+                 formats=FORMATS, compress: bool=False):
+        """Create a prefetcher.
+
+        Args:
+            out_dir (str): directory of the structure files
+            base_url (str, optional): server serving `{pdb_id}.{format}.gz`. Defaults to RCSB.
+            num_workers (int, optional): number of concurrent downloads. Defaults to 16.
+            retries (int, optional): attempts per entry after the first one. Defaults to 4.
+            backoff (float, optional): initial retry delay in seconds, doubled every attempt. Defaults to 0.5.
+            timeout (float, optional): per request timeout in seconds. Defaults to 30.
+            formats (tuple, optional): 'pdb', 'cif' and/or 'bcif', tried in order. Defaults to PDB, then mmCIF.
+            compress (bool, optional): keep the files gzip-compressed on disk. Defaults to False.
+        """
+        self.out_dir = out_dir
+        self.base_url = base_url.rstrip('/')
+        self.num_workers = num_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.formats = formats
+        self.compress = compress
+
+        self._local = threading.local()
+        os.makedirs(out_dir, exist_ok=True)
+
+    @property
+    def session(self):
+        # requests sessions are not thread safe: keep one pooled session per thread
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return self._local.session
+
+    def path(self, pdb_id, fmt='pdb'):
+        return os.path.join(self.out_dir, f'{pdb_id}.{fmt}.gz' if self.compress else f'{pdb_id}.{fmt}')
+
+    def get(self, url):
+        """Download and decompress one gzip file.
+
+        Returns:
+            compressed and decompressed content, None if the server has no such file
+        Raises:
+            the last error once all retries are exhausted
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                req = self.session.get(url, timeout=self.timeout)
+                if req.status_code == 404:
+                    return None
+                req.raise_for_status()
+
+                # a truncated transfer fails here rather than on disk
+                return req.content, gzip.decompress(req.content)
+            except (requests.RequestException, OSError, EOFError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2**attempt)
+
+    def fetch_one(self, pdb_id):
+        """Download one entry unless it is already present, in any format.
+
+        Returns:
+            'present', 'downloaded' or 'missing' (the server has no such entry)
+        Raises:
+            the last error once all retries are exhausted
+        """
+        if pdb_io.find_structure(self.out_dir, pdb_id) is not None:
+            return 'present'
+
+        for fmt in self.formats:
+            content = self.get(f'{self.base_url}/{pdb_id}.{fmt}.gz')
+            if content is None:
+                continue                                    # e.g. mmCIF-only entries have no PDB file
+
+            write_atomic(self.path(pdb_id, fmt), content[0] if self.compress else content[1])
+            return 'downloaded'
+        return 'missing'
+
+    def fetch(self, pdb_ids):
+        """Download all entries concurrently and update the manifest.
+
+        Entries the manifest records as missing on the server are not requested again.
+
+        Args:
+            pdb_ids (list): pdb IDs to download
+        Returns:
+            dict of pdb ID -> 'present'/'downloaded'/'missing'/'error'
+        """
+        missing = set(self.load_manifest()['missing'])
+        status = {p: 'missing' for p in pdb_ids if p in missing}
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            futures = {pool.submit(self.fetch_one, p): p for p in pdb_ids if p not in missing}
+            for i, future in enumerate(as_completed(futures)):
+                p = futures[future]
+                try:
+                    status[p] = future.result()
+                except Exception as e:
+                    print('error pdb: ', p, e)
+                    status[p] = 'error'
+
+                if not (i+1) % 1000:
+                    print(f'{i+1}/{len(futures)}')
+                    self.update_manifest(status)            # an interrupted run resumes from here
+
+        self.update_manifest(status)
+        return status
+
+    def load_manifest(self):
+        manifest_file = os.path.join(self.out_dir, MANIFEST)
+        if not os.path.exists(manifest_file):
+            return {'present': [], 'missing': []}
+        with open(manifest_file) as f:
+            return json.load(f)
+
+    def update_manifest(self, status):
+        """Record which entries are on disk and which the server does not have."""
+        manifest = self.load_manifest()
+        present = set(manifest['present'])
+        missing = set(manifest['missing'])
+        for p, s in status.items():
+            if s in ('present', 'downloaded'):
+                present.add(p)
+                missing.discard(p)
+            elif s == 'missing':
+                missing.add(p)
+
+        manifest = {'present': sorted(present), 'missing': sorted(missing)}
+        write_atomic(os.path.join(self.out_dir, MANIFEST), json.dumps(manifest, indent=1).encode())
+
+
+_prefetchers = {}
+
+def download(pdb_id, outfile):
+    """Download a single entry next to `outfile`, reusing a pooled session per output directory.
+
+    Entries without a PDB file are downloaded as mmCIF (`{pdb_id}.cif`).
+
+    Returns:
+        1 if the file is present afterwards, 0 otherwise
+    """
+    out_dir = os.path.dirname(outfile) or '.'
+    if out_dir not in _prefetchers:
+        _prefetchers[out_dir] = PDBPrefetcher(out_dir, num_workers=1)
+    prefetcher = _prefetchers[out_dir]
+
+    try:
+        status = prefetcher.fetch_one(pdb_id)
+    except Exception as e:
+        print('error pdb: ', pdb_id, e)
+        return 0
+    return int(status != 'missing' and pdb_io.find_structure(out_dir, pdb_id) is not None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--id_list', type=str, default='../data/ProtFunct.pt',
+            help="ProtFunct.pt or a text file of pdbid.chain entries, e.g. training.txt")
+    parser.add_argument('--out_dir', type=str, default='../data/pdb',
+            help="Directory of the downloaded .pdb files")
+    parser.add_argument('--base_url', type=str, default=RCSB_URL,
+            help="Server serving {pdb_id}.pdb.gz files")
+    parser.add_argument('--num_workers', type=int, default=16,
+            help="Number of concurrent downloads")
+    parser.add_argument('--retries', type=int, default=4,
+            help="Retries per entry")
+    parser.add_argument('--formats', type=str, nargs='+', default=list(FORMATS), choices=['pdb', 'cif', 'bcif'],
+            help="Formats to try, in order")
+    parser.add_argument('--compress', action='store_true',
+            help="Keep the downloaded files gzip-compressed")
+
+    FLAGS = parser.parse_args()
+
+    pdb_ids = load_pdb_ids(FLAGS.id_list)
+    prefetcher = PDBPrefetcher(FLAGS.out_dir, base_url=FLAGS.base_url, num_workers=FLAGS.num_workers, retries=FLAGS.retries,
+                               formats=FLAGS.formats, compress=FLAGS.compress)
+    status = prefetcher.fetch(pdb_ids)
+
+    counts = {}
+    for s in status.values():
+        counts[s] = counts.get(s, 0) + 1
+    print(f'Done -> {counts}')
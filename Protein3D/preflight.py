@@ -0,0 +1,192 @@
+#%%
+"""Preflight check of the ProtFunct splits.
+
+Every chain of `ProtFunct.pt` is parsed once by a process pool, before
+training, and the outcome is recorded in a JSON manifest: parse status, number
+of residues, number of edges under every distance cutoff, and size and
+modification time of the structure file. The datasets drop chains that did not
+parse (`manifest=`), and the sizes feed size-aware batching
+(samplers.EdgeBudgetBatchSampler) without a graph store.
+
+Structure files are not downloaded here, run prefetch.py first: entries
+without a file are recorded as 'missing'. Re-running the command only checks
+chains that are new or whose file changed.
+
+    python preflight.py --data_address ../data/ProtFunct.pt --manifest ../data/preflight.json --distance_cutoff 3 3.5
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+import torch
+
+import pdb_io
+
+from multiprocessing import Pool
+
+
+def load_manifest(manifest_file):
+    """Read a manifest, {'dis_cut': [...], 'entries': {pdb: record}}."""
+    if not os.path.exists(manifest_file):
+        return {'dis_cut': None, 'entries': {}}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_file, manifest):
+    # write-then-rename so readers never see a half written manifest
+    tmp_file = f'{manifest_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+
+
+def usable(manifest, pdbs):
+    """Boolean mask of the chains `pdbs` that parsed without error."""
+    entries = manifest['entries']
+    return np.array([entries.get(pdb, {}).get('status') == 'ok' for pdb in pdbs], dtype=bool)
+
+
+def size_manifest(manifest, pdbs, dis_cut):
+    """[N, 2] number of nodes and edges of the chains `pdbs`, e.g. for samplers.EdgeBudgetBatchSampler.
+
+    Raises:
+        KeyError if a chain is not in the manifest or did not parse
+    """
+    assert [float(d) for d in dis_cut] == manifest['dis_cut'], f'manifest was built with distance cutoffs {manifest["dis_cut"]}'
+    entries = manifest['entries']
+    sizes = []
+    for pdb in pdbs:
+        record = entries[pdb]
+        if record['status'] != 'ok':
+            raise KeyError(f'{pdb}: {record["status"]}')
+        sizes.append((record['num_residues'], record['num_edges'][-1]))
+    return np.array(sizes, dtype=np.int64).reshape(-1, 2)
+
+
+#%%
+_parser = None
+_dis_cut = None
+
+def _init_worker(dis_cut):
+    global _parser, _dis_cut
+    _parser = pdb_io.StructureParser()
+    _dis_cut = dis_cut
+
+def _check_entry(pdb):
+    import datasets
+
+    path = pdb_io.find_structure(f'{datasets.data_dir}/pdb', pdb.split('.')[0])
+    if path is None:
+        return pdb, {'status': 'missing'}
+    stat = os.stat(path)
+    record = {'status': 'ok', 'file': os.path.basename(path), 'file_size': stat.st_size, 'file_mtime_ns': stat.st_mtime_ns}
+
+    try:
+        res, x, src, dst, w = datasets.ProtProcess.get_chain_arrays(_parser, pdb, _dis_cut)
+    except Exception as e:
+        record['status'] = f'error: {type(e).__name__}: {e}'
+        return pdb, record
+    if not len(res):
+        record['status'] = 'empty'
+        return pdb, record
+
+    # bond type k is the tightest cutoff an edge satisfies: edges under cutoff k are the cumulative count
+    record['num_residues'] = int(len(res))
+    record['num_edges'] = np.cumsum(np.bincount(w, minlength=len(_dis_cut) + 1))[1:].tolist()
+    return pdb, record
+
+
+def run_preflight(data_address, manifest_file, dis_cut, modes=('train', 'valid', 'test'), num_workers: int=4):
+    """Check every chain of the splits and update the manifest at `manifest_file`.
+
+    Args:
+        data_address (str): path to ProtFunct.pt
+        manifest_file (str): path of the JSON manifest
+        dis_cut (list): distance cutoffs of the non-covalent bonds
+        modes (tuple, optional): splits to check. Defaults to all.
+        num_workers (int, optional): number of parsing processes. Defaults to 4.
+    Returns:
+        the manifest
+    """
+    import datasets
+
+    dis_cut = [float(d) for d in dis_cut]
+    data = torch.load(data_address)
+    manifest = load_manifest(manifest_file)
+    if manifest['dis_cut'] != dis_cut:
+        manifest = {'dis_cut': dis_cut, 'entries': {}}           # edge counts depend on the cutoffs
+    entries = manifest['entries']
+
+    def unchanged(pdb):
+        # same size and modification time: a re-downloaded file of the same size is checked again
+        record = entries.get(pdb)
+        if record is None or 'file' not in record:
+            return False
+        path = os.path.join(f'{datasets.data_dir}/pdb', record['file'])
+        if not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        return stat.st_size == record['file_size'] and stat.st_mtime_ns == record.get('file_mtime_ns')
+
+    todo = list(dict.fromkeys(pdb for mode in modes for pdb in data[mode]['input_list']))
+    todo = [pdb for pdb in todo if not unchanged(pdb)]
+    print(f'Preflight {manifest_file} -> {len(entries)} recorded, {len(todo)} to check')
+
+    with Pool(num_workers, initializer=_init_worker, initargs=(dis_cut,)) as pool:
+        for i, (pdb, record) in enumerate(pool.imap_unordered(_check_entry, todo, chunksize=8)):
+            entries[pdb] = record
+            if not (i+1) % 1000:
+                print(f'{i+1}/{len(todo)}')
+    save_manifest(manifest_file, manifest)
+
+    for mode in modes:
+        summarize(manifest, data[mode]['input_list'], mode)
+    return manifest
+
+
+def summarize(manifest, pdbs, mode):
+    """Print parse outcomes and size statistics of one split."""
+    records = [manifest['entries'].get(pdb, {'status': 'unchecked'}) for pdb in pdbs]
+    status = {}
+    for r in records:
+        s = r['status'].split(':')[0]
+        status[s] = status.get(s, 0) + 1
+
+    ok = [r for r in records if r['status'] == 'ok']
+    if ok:
+        nodes = np.array([r['num_residues'] for r in ok])
+        edges = np.array([r['num_edges'][-1] for r in ok])
+        megabytes = sum(r['file_size'] for r in ok) / 2**20
+        print(f'{mode} -> {status}, residues p50/p99/max {np.percentile(nodes, 50):.0f}/{np.percentile(nodes, 99):.0f}/{nodes.max()}, '
+              f'edges p50/p99/max {np.percentile(edges, 50):.0f}/{np.percentile(edges, 99):.0f}/{edges.max()}, '
+              f'{nodes.sum()} residues, {edges.sum()} edges, {megabytes:.1f} MB of structures')
+    else:
+        print(f'{mode} -> {status}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--data_address', type=str, default='../data/ProtFunct.pt',
+            help="Address to the ProtFunct splits")
+    parser.add_argument('--manifest', type=str, default='../data/preflight.json',
+            help="Path of the manifest")
+    parser.add_argument('--data_dir', type=str, default=None,
+            help="Directory holding pdb/, defaults to datasets.data_dir")
+    parser.add_argument('--distance_cutoff', type=float, nargs='+', default=[3.0, 3.5],
+            help="Distance cutoffs of the non-covalent bonds")
+    parser.add_argument('--modes', type=str, nargs='+', default=['train', 'valid', 'test'],
+            help="Splits to check")
+    parser.add_argument('--num_workers', type=int, default=4,
+            help="Number of parsing processes")
+
+    FLAGS = parser.parse_args()
+
+    if FLAGS.data_dir:
+        import datasets
+        datasets.data_dir = FLAGS.data_dir
+
+    run_preflight(FLAGS.data_address, FLAGS.manifest, FLAGS.distance_cutoff,
+                  modes=FLAGS.modes, num_workers=FLAGS.num_workers)
@@ -0,0 +1,271 @@
+#%%
+"""Samplers for the ProtFunct datasets."""
+import numpy as np
+
+from torch.utils.data import Sampler
+
+
+class ChainGroupSampler(Sampler):
+    """Yield the chains of one PDB entry at neighbouring positions.
+
+    With per-process structure caches (datasets.StructureCache for Bio.PDB,
+    the last mmCIF/BinaryCIF file of pdb_io.read_atom_site() for the fast
+    reader), chains of the same entry that are loaded by the same worker reuse
+    one parse. Keeping them adjacent puts them into the same batch, and hence
+    the same worker. Plain PDB files are read chain by chain by the fast
+    reader and do not need it.
+    """
+    def __init__(self, inputs, shuffle: bool=False, seed: int=0):
+        """Group samples by PDB entry.
+
+        Args:
+            inputs (list): `pdbid.chain` of every sample, e.g. dataset.inputs
+            shuffle (bool, optional): shuffle the order of the entries (and of the chains within one) every epoch. Defaults to False.
+            seed (int, optional): base random seed, combined with the epoch. Defaults to 0.
+        """
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        groups = {}
+        for idx, pdb in enumerate(inputs):
+            groups.setdefault(pdb.split('.')[0], []).append(idx)
+        self.groups = [np.array(g) for g in groups.values()]
+        self.len = len(inputs)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        groups = self.groups
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            groups = [rng.permutation(groups[k]) for k in rng.permutation(len(groups))]
+            self.epoch += 1
+
+        for g in groups:
+            yield from g.tolist()
+
+
+class NegativePairSampler(Sampler):
+    """Yield (positive, negative) index pairs for ProtFunctDatasetBinary.
+
+    Negatives are drawn in the main process from one global stream, the
+    concatenation of per-cycle permutations of all negatives, so every
+    negative is used once before any repeats. A sampler runs in the main
+    process, so DataLoader workers receive disjoint pairs rather than each
+    drawing from its own shuffled copy. The pairs of an epoch depend only on the
+    seed and the epoch.
+    """
+    def __init__(self, num_pos: int, num_neg: int, shuffle: bool=False, seed: int=0):
+        """Create a pair sampler.
+
+        Args:
+            num_pos (int): number of positive samples, e.g. len(dataset.inputs)
+            num_neg (int): number of negative samples, e.g. len(dataset.inputs_ns)
+            shuffle (bool, optional): shuffle the positives every epoch. Defaults to False.
+            seed (int, optional): base random seed. Defaults to 0.
+        """
+        self.num_pos = num_pos
+        self.num_neg = num_neg
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_pos
+
+    def negatives(self, epoch: int):
+        """Negatives of one epoch: positions [epoch * num_pos, (epoch + 1) * num_pos) of the global stream."""
+        start, end = epoch * self.num_pos, (epoch + 1) * self.num_pos
+        neg = [np.random.RandomState([self.seed, cycle]).permutation(self.num_neg)
+               for cycle in range(start // self.num_neg, (end - 1) // self.num_neg + 1)]
+        offset = start - start // self.num_neg * self.num_neg
+        return np.concatenate(neg)[offset:offset + self.num_pos]
+
+    def __iter__(self):
+        pos = np.arange(self.num_pos)
+        if self.shuffle:
+            pos = np.random.RandomState([self.seed, self.epoch]).permutation(pos)
+        neg = self.negatives(self.epoch) if self.num_pos else pos
+        self.epoch += 1
+
+        yield from zip(pos.tolist(), neg.tolist())
+
+
+class PairedBatchSampler(Sampler):
+    """Pair the positives of a batch sampler with negatives of a NegativePairSampler.
+
+    Positive `p` of an epoch gets the negative at position `p` of the
+    sampler's global stream for that epoch, NegativePairSampler.negatives(),
+    so batches of e.g. EdgeBudgetBatchSampler yield (positive, negative)
+    pairs drawn in the main process, as NegativePairSampler does for a fixed
+    batch size.
+    """
+    def __init__(self, batch_sampler, pair_sampler):
+        """Wrap a batch sampler.
+
+        Args:
+            batch_sampler (Sampler): yields the positive indices of every batch, each positive once per epoch
+            pair_sampler (NegativePairSampler): draws the negatives
+        """
+        self.batch_sampler = batch_sampler
+        self.pair_sampler = pair_sampler
+
+    def set_epoch(self, epoch: int):
+        self.pair_sampler.set_epoch(epoch)
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        sampler = self.pair_sampler
+        neg = sampler.negatives(sampler.epoch).tolist() if sampler.num_pos else []
+        sampler.epoch += 1
+
+        for batch in self.batch_sampler:
+            yield [(idx, neg[idx]) for idx in batch]
+
+
+class ClassBalancedSampler(Sampler):
+    """Draw samples with class frequencies flattened towards uniform.
+
+    A class is drawn first, with probability proportional to its number of
+    samples to the power `power`, then one of its samples uniformly, with
+    replacement. `power=0` makes every class equally likely, `power=1` is the
+    natural class distribution. Classes and samples are looked up in a
+    datasets.ClassIndex, so a draw costs O(1).
+    """
+    def __init__(self, class_index, num_samples: int=None, power: float=0., seed: int=0):
+        """Create a class-balanced sampler.
+
+        Args:
+            class_index (ClassIndex): class -> sample indices of the dataset, e.g. ClassIndex.from_targets(dataset.targets)
+            num_samples (int, optional): samples per epoch. Defaults to the number of samples in the index.
+            power (float, optional): exponent of the class counts. Defaults to 0 (uniform over classes).
+            seed (int, optional): base random seed, combined with the epoch. Defaults to 0.
+        """
+        self.class_index = class_index
+        self.num_samples = num_samples or len(class_index.order)
+        self.seed = seed
+        self.epoch = 0
+
+        counts = class_index.counts
+        self.classes = np.flatnonzero(counts)
+        weights = counts[self.classes] ** float(power)
+        self.probs = weights / weights.sum()
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+
+        classes = self.classes[rng.choice(len(self.classes), self.num_samples, p=self.probs)]
+        offsets = self.class_index.offsets
+        pos = offsets[classes] + (rng.random_sample(self.num_samples) * (offsets[classes+1] - offsets[classes])).astype(np.int64)
+        yield from self.class_index.order[pos].tolist()
+
+
+class EdgeBudgetBatchSampler(Sampler):
+    """Pack samples into batches bounded by their total number of edges.
+
+    A fixed batch size is sized for the largest proteins, so batches of small
+    chains waste memory and a few large chains still cause spikes. Here every
+    batch holds as many samples as fit into `max_edges` (and `max_nodes`).
+    Samples are bucketed by size first, so each batch holds proteins of
+    similar size. A sample larger than the budget makes a batch of its own.
+
+    Use as the `batch_sampler` of a DataLoader with `collate` or `collate_ns`.
+    """
+    def __init__(self, sizes, max_edges: int, max_nodes: int=None, bucket_size: int=1024, shuffle: bool=False, seed: int=0, verbose: bool=False):
+        """Create a batch sampler.
+
+        Args:
+            sizes (ndarray): [N, 2] number of nodes and edges of every sample, e.g. GraphStore.size_manifest()
+            max_edges (int): maximum total number of edges per batch
+            max_nodes (int, optional): maximum total number of nodes per batch. Defaults to None.
+            bucket_size (int, optional): number of consecutive samples sorted by size before packing. Defaults to 1024.
+            shuffle (bool, optional): shuffle the samples and the batches every epoch. Defaults to False.
+            seed (int, optional): base random seed, combined with the epoch. Defaults to 0.
+            verbose (bool, optional): print the efficiency() of every epoch. Defaults to False.
+        """
+        self.sizes = np.asarray(sizes).reshape(-1, 2)
+        self.max_edges = max_edges
+        self.max_nodes = max_nodes
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.verbose = verbose
+        self.epoch = 0
+        self.stats = None                 # efficiency() of the epoch iterated last
+        self._batches = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def batches(self):
+        """Batches of the current epoch, as lists of sample indices."""
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1]
+
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.sizes)) if self.shuffle else np.arange(len(self.sizes))
+
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.sizes[bucket, 1], kind='stable')]
+
+            batch, num_nodes, num_edges = [], 0, 0
+            for idx in bucket.tolist():
+                nn, ne = self.sizes[idx]
+                full = num_edges + ne > self.max_edges or (self.max_nodes is not None and num_nodes + nn > self.max_nodes)
+                if batch and full:
+                    batches.append(batch)
+                    batch, num_nodes, num_edges = [], 0, 0
+                batch.append(idx)
+                num_nodes += nn
+                num_edges += ne
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[k] for k in rng.permutation(len(batches))]
+        self._batches = (self.epoch, batches)
+        return batches
+
+    def efficiency(self):
+        """Fraction of the edge (and node) budget used by the batches of the current epoch."""
+        batches = self.batches()
+        stats = {'batches': len(batches),
+                 'mean_batch_size': len(self.sizes) / max(len(batches), 1),
+                 'edge_efficiency': self.sizes[:,1].sum() / max(len(batches) * self.max_edges, 1)}
+        if self.max_nodes is not None:
+            stats['node_efficiency'] = self.sizes[:,0].sum() / max(len(batches) * self.max_nodes, 1)
+        return stats
+
+    def __len__(self):
+        return len(self.batches())
+
+    def __iter__(self):
+        batches = self.batches()
+        self.stats = self.efficiency()
+        if self.verbose:
+            print(f'Edge budget batches -> ' + ', '.join(f'{k}: {v:.3f}' if isinstance(v, float) else f'{k}: {v}' for k, v in self.stats.items()))
+
+        if self.shuffle:
+            self.epoch += 1
+        yield from batches
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+import torch
+
+dgl = pytest.importorskip('dgl')
+
+from batch_cache import cached_loader, file_stamps
+
+
+def make_loader(calls, scale):
+    """Two batches of two small graphs, counting how often it is collated."""
+    def make():
+        calls.append(scale)
+        batches = []
+        for b in range(2):
+            graphs = []
+            for n in [3, 4]:
+                G = dgl.graph((torch.arange(n), (torch.arange(n) + 1) % n), num_nodes=n)
+                G.ndata['x'] = torch.full((n, 3), float(scale * (b + 1)))
+                G.edata['w'] = torch.arange(n, dtype=torch.int8)
+                graphs.append(G)
+            batches.append((dgl.batch(graphs), torch.tensor([b, b]), (f'{b}a', f'{b}b')))
+        return batches
+    return make
+
+
+def test_stale_data_file_rebuilds_the_cache(tmp_path):
+    data_file, cache_dir = tmp_path / 'ProtFunct.pt', str(tmp_path / 'cache')
+    data_file.write_bytes(b'split v1')
+    settings, calls = {'mode': 'valid'}, []
+
+    first = [G.ndata['x'][0,0].item() for G, _, _ in cached_loader(make_loader(calls, 1), cache_dir, settings, files=[str(data_file)])]
+    replay = [G.ndata['x'][0,0].item() for G, _, _ in cached_loader(make_loader(calls, 2), cache_dir, settings, files=[str(data_file)])]
+    assert calls == [1] and first == replay == [1., 2.]
+
+    # same settings, other data file: not replayed
+    data_file.write_bytes(b'split v2, longer')
+    os.utime(data_file, ns=(0, 1))
+    rebuilt = [G.ndata['x'][0,0].item() for G, _, _ in cached_loader(make_loader(calls, 2), cache_dir, settings, files=[str(data_file)])]
+    assert calls == [1, 2] and rebuilt == [2., 4.]
+
+
+def test_file_stamps(tmp_path):
+    path = tmp_path / 'a'
+    path.write_bytes(b'abc')
+    os.utime(path, ns=(0, 5))
+    assert file_stamps([str(path), str(tmp_path / 'missing')]) == {str(path): [3, 5], str(tmp_path / 'missing'): None}
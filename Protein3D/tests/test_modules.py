@@ -0,0 +1,39 @@
+import pytest
+import torch
+
+dgl = pytest.importorskip('dgl')
+
+from equivariant_attention.modules import get_basis_and_r, get_edge_sh
+
+
+def chain_graph(num_nodes, num_pairs, generator, rev: bool):
+    """Random graph in the edge layout of the chains: one direction of every pair, then the reverses."""
+    src = torch.randint(num_nodes, (num_pairs,), generator=generator)
+    dst = (src + torch.randint(1, num_nodes, (num_pairs,), generator=generator)) % num_nodes
+    src, dst = torch.cat([src, dst]), torch.cat([dst, src])
+    x = torch.randn(num_nodes, 3, generator=generator)
+
+    G = dgl.graph((src, dst), num_nodes=num_nodes)
+    G.edata['d'] = x[dst] - x[src]
+    if rev:
+        G.edata['rev'] = (torch.arange(2*num_pairs) + num_pairs) % (2*num_pairs)
+    return G
+
+
+def batched(rev: bool):
+    generator = torch.Generator().manual_seed(0)
+    return dgl.batch([chain_graph(n, e, generator, rev) for n, e in [(12, 30), (7, 9), (20, 55)]])
+
+
+@pytest.mark.parametrize('max_degree', [1, 2, 3])
+def test_reverse_edges_by_parity(max_degree):
+    G, G_direct = batched(rev=True), batched(rev=False)
+
+    assert torch.allclose(get_edge_sh(G, 2*max_degree), get_edge_sh(G_direct, 2*max_degree), atol=1e-6)
+
+    basis, r = get_basis_and_r(G, max_degree)
+    basis_direct, r_direct = get_basis_and_r(G_direct, max_degree)
+    assert torch.equal(r, r_direct)
+    assert basis.keys() == basis_direct.keys()
+    for k in basis:
+        assert torch.allclose(basis[k], basis_direct[k], atol=1e-6), k
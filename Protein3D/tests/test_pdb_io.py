@@ -0,0 +1,150 @@
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+import pdb_io
+
+AA = ['ALA', 'GLY', 'SER', 'LEU', 'LYS', 'ASP']
+RESIDUE2IDX = {name: i for i, name in enumerate(AA + ['LIG'])}
+
+
+def atom_line(rec, serial, name, altloc, res_name, chain, res_seq, icode, xyz, occupancy=1.0):
+    name = name if len(name) == 4 else ' ' + name.ljust(3)
+    return (f'{rec:<6}{serial:>5} {name}{altloc}{res_name:>3} {chain}{res_seq:>4}{icode}   '
+            f'{xyz[0]:>8.3f}{xyz[1]:>8.3f}{xyz[2]:>8.3f}{occupancy:>6.2f}{20.0:>6.2f}           C\n')
+
+
+def write_pdb(path, num_models=2, seed=0):
+    """Chains A and B in every model, with altlocs, insertion codes, waters and a ligand after TER."""
+    rng = np.random.RandomState(seed)
+    lines, serial = ['HEADER    SYNTHETIC\n'], 1
+    for model in range(num_models):
+        lines.append(f'MODEL     {model+1:>4}\n')
+        for c, num_residues in [('A', 14), ('B', 6)]:
+            xyz = rng.normal(size=3) * 5
+            for k in range(num_residues):
+                res_name = AA[k % len(AA)]
+                # 10, 10A, 10B, 11: insertion codes; 20 after 13: a gap in numbering
+                res_seq, icode = [(k + 1, ' '), (10, 'A'), (10, 'B'), (11, ' ')][k - 9] if 9 <= k <= 12 else (k + 1 + 7 * (k > 12), ' ')
+                xyz = xyz + rng.normal(size=3) * 2
+                for name in ['N', 'CA', 'C', 'O', 'CB'][:3 + k % 3]:
+                    atom = xyz + rng.normal(size=3)
+                    if name == 'CB' and k % 4 == 1:
+                        # altlocs, the second one more occupied
+                        lines.append(atom_line('ATOM', serial, name, 'A', res_name, c, res_seq, icode, atom, 0.4))
+                        lines.append(atom_line('ATOM', serial + 1, name, 'B', res_name, c, res_seq, icode, atom + 0.7, 0.6))
+                        serial += 2
+                    elif name == 'CB' and k % 4 == 3:
+                        # altlocs of equal occupancy: the first one
+                        lines.append(atom_line('ATOM', serial, name, 'A', res_name, c, res_seq, icode, atom, 0.5))
+                        lines.append(atom_line('ATOM', serial + 1, name, 'B', res_name, c, res_seq, icode, atom - 0.7, 0.5))
+                        serial += 2
+                    else:
+                        lines.append(atom_line('ATOM', serial, name, ' ', res_name, c, res_seq, icode, atom))
+                        serial += 1
+            lines.append(f'TER   {serial:>5}      {res_name} {c}{res_seq:>4}\n')
+            serial += 1
+        for c in 'AB':
+            for k in range(3):
+                lines.append(atom_line('HETATM', serial, 'O', ' ', 'HOH', c, 100 + k, ' ', rng.normal(size=3) * 6))
+                serial += 1
+            # a ligand numbered as a residue of the chain: another Bio.PDB residue (hetero flag)
+            for name in ['C1', 'C2', 'O3']:
+                lines.append(atom_line('HETATM', serial, name, ' ', 'LIG', c, 3, ' ', rng.normal(size=3) * 4))
+                serial += 1
+        lines.append('ENDMDL\n')
+    lines.append('END\n')
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    return path
+
+
+def bio_arrays(chain):
+    """Atom and residue arrays of a Bio.PDB chain, as datasets.ProtProcess.get_atom_arrays() and get_residue_feature()."""
+    residues = list(chain)
+    res_ids = [r.get_id() for r in residues]
+    coo = np.array([a.get_coord() for a in chain.get_atoms()], dtype=np.float64).reshape((-1, 3))
+    atom_res = np.repeat(np.arange(len(residues)), [len(r) for r in residues])
+    res_order = np.empty(len(residues), dtype=np.int64)
+    res_order[sorted(range(len(residues)), key=lambda k: res_ids[k])] = np.arange(len(residues))
+    res_seq = np.array([i[1] for i in res_ids], dtype=np.int64)
+
+    kept = [r for r in residues if r.get_resname() != 'HOH' and r.get_resname() in RESIDUE2IDX]
+    res = np.array([RESIDUE2IDX[r.get_resname()] for r in kept]).astype(pdb_io.IDTYPE)
+    x = np.concatenate([np.concatenate([a.get_coord() for a in r]).reshape((-1, 3)).mean(axis=0) for r in kept])
+    return (coo, atom_res, res_order, res_seq), (res, x.reshape((-1, 3)).astype(pdb_io.DTYPE))
+
+
+@pytest.fixture(autouse=True)
+def fresh_indices():
+    pdb_io._chain_indices.clear()
+    yield
+    pdb_io._chain_indices.clear()
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+@pytest.mark.parametrize('use_index', [True, False])
+def test_read_chain_matches_bio_pdb(tmp_path, compressed, use_index):
+    path = write_pdb(str(tmp_path / '1syn.pdb'))
+    if compressed:
+        with open(path, 'rb') as f, gzip.open(path + '.gz', 'wb') as g:
+            g.write(f.read())
+        os.remove(path)
+        path += '.gz'
+
+    structure = pdb_io.StructureParser().get_structure('a', path)
+    assert len(structure) == 2
+    assert [r.get_id()[1:] for r in structure[0]['A']][9:13] == [(10, ' '), (10, 'A'), (10, 'B'), (11, ' ')]
+    assert any(a.is_disordered() for a in structure[0]['A'].get_atoms())
+    for model in range(2):
+        for c in 'AB':
+            atoms = pdb_io.read_chain(path, c, model=model, use_index=use_index)
+            assert atoms is not None, (model, c)
+            arrays, (res, x) = bio_arrays(structure[model][c])
+
+            assert all(np.array_equal(a, b) for a, b in zip(pdb_io.get_atom_arrays(atoms), arrays)), (model, c)
+            res_c, x_c = pdb_io.get_residue_feature(atoms, RESIDUE2IDX)
+            assert np.array_equal(res_c, res) and np.array_equal(x_c, x), (model, c)
+            assert list(atoms['res_name']) == [r.get_resname() for r in structure[model][c]]
+
+    with pytest.raises(KeyError):
+        pdb_io.read_chain(path, 'Z', use_index=use_index)
+
+
+def test_chain_index_is_not_written_next_to_the_data(tmp_path):
+    data_dir, index_dir = tmp_path / 'pdb', tmp_path / 'index'
+    data_dir.mkdir()
+    path = write_pdb(str(data_dir / '1syn.pdb'))
+
+    # in memory only by default
+    pdb_io.read_chain(path, 'A')
+    assert os.listdir(data_dir) == ['1syn.pdb']
+
+    pdb_io._chain_indices.clear()
+    pdb_io.read_chain(path, 'A', index_dir=str(index_dir))
+    assert os.listdir(data_dir) == ['1syn.pdb']
+    assert os.listdir(index_dir) == [os.path.basename(pdb_io.index_path(path, str(index_dir), '.chains'))]
+
+    # an index directory that cannot be created: kept in memory
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    pdb_io._chain_indices.clear()
+    atoms = pdb_io.read_chain(path, 'B', index_dir=str(blocker / 'index'))
+    assert atoms is not None and path in pdb_io._chain_indices
+
+
+def test_chain_index_follows_file_changes(tmp_path):
+    path = write_pdb(str(tmp_path / '1syn.pdb'), seed=0)
+    index_dir = str(tmp_path / 'index')
+    first = pdb_io.read_chain(path, 'A', index_dir=index_dir)
+
+    # same name, other content: the stored index is rebuilt
+    write_pdb(path, num_models=1, seed=1)
+    os.utime(path, ns=(0, 1))
+    pdb_io._chain_indices.clear()
+    second = pdb_io.read_chain(path, 'A', index_dir=index_dir)
+    reference = pdb_io.read_chain(path, 'A', use_index=False)
+    assert not np.array_equal(first['coo'], second['coo'])
+    assert np.array_equal(second['coo'], reference['coo'])
@@ -0,0 +1,129 @@
+import gzip
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import prefetch
+
+PDB = b'ATOM      1  CA  ALA A   1      11.104  13.207   2.100  1.00 20.00           C\nEND\n'
+
+
+class Server(object):
+    """Serves scripted responses on localhost: path -> list of (status, body), the last one repeats."""
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.path)
+                queue = server.responses.get(self.path, [(404, b'')])
+                status, body = queue.pop(0) if len(queue) > 1 else queue[0]
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    s = Server()
+    yield s
+    s.close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(prefetch.time, 'sleep', delays.append)
+    return delays
+
+
+def prefetcher(server, out_dir, **kwargs):
+    return prefetch.PDBPrefetcher(str(out_dir), base_url=server.url, num_workers=2, retries=3, backoff=0.1, timeout=5., **kwargs)
+
+
+def test_retries_server_errors_with_backoff(server, sleeps, tmp_path):
+    server.responses['/1abc.pdb.gz'] = [(503, b''), (500, b''), (200, gzip.compress(PDB))]
+
+    assert prefetcher(server, tmp_path).fetch(['1abc']) == {'1abc': 'downloaded'}
+    assert server.requests == ['/1abc.pdb.gz'] * 3
+    assert sleeps == [0.1, 0.2]
+    assert (tmp_path / '1abc.pdb').read_bytes() == PDB
+
+
+def test_gives_up_after_the_retries(server, sleeps, tmp_path):
+    server.responses['/1abc.pdb.gz'] = [(502, b'')]
+
+    assert prefetcher(server, tmp_path).fetch(['1abc']) == {'1abc': 'error'}
+    assert len(server.requests) == 4
+    assert sleeps == [0.1, 0.2, 0.4]
+    assert sorted(os.listdir(tmp_path)) == [prefetch.MANIFEST]
+
+
+def test_falls_back_to_mmcif(server, sleeps, tmp_path):
+    server.responses['/2big.cif.gz'] = [(200, gzip.compress(b'data_2BIG\n'))]
+
+    assert prefetcher(server, tmp_path).fetch_one('2big') == 'downloaded'
+    assert server.requests == ['/2big.pdb.gz', '/2big.cif.gz']
+    assert (tmp_path / '2big.cif').read_bytes() == b'data_2BIG\n'
+    assert not sleeps                                       # a 404 is an answer, not an error
+
+
+def test_compressed_files_are_kept_as_served(server, sleeps, tmp_path):
+    server.responses['/1abc.pdb.gz'] = [(200, gzip.compress(PDB))]
+
+    assert prefetcher(server, tmp_path, compress=True).fetch_one('1abc') == 'downloaded'
+    assert gzip.decompress((tmp_path / '1abc.pdb.gz').read_bytes()) == PDB
+
+
+def test_truncated_transfer_leaves_no_file(server, sleeps, tmp_path):
+    server.responses['/1abc.pdb.gz'] = [(200, gzip.compress(PDB)[:-8])]
+
+    with pytest.raises(EOFError):
+        prefetcher(server, tmp_path).fetch_one('1abc')
+    assert len(server.requests) == 4
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_write_leaves_no_file(server, sleeps, tmp_path, monkeypatch):
+    server.responses['/1abc.pdb.gz'] = [(200, gzip.compress(PDB))]
+
+    def fsync(fd):
+        raise OSError('disk full')
+    monkeypatch.setattr(prefetch.os, 'fsync', fsync)
+
+    with pytest.raises(OSError):
+        prefetcher(server, tmp_path).fetch_one('1abc')
+    assert os.listdir(tmp_path) == []
+
+
+def test_resumes_from_the_manifest(server, sleeps, tmp_path):
+    server.responses['/1abc.pdb.gz'] = [(200, gzip.compress(PDB))]
+
+    assert prefetcher(server, tmp_path).fetch(['1abc', '9zzz']) == {'1abc': 'downloaded', '9zzz': 'missing'}
+    assert prefetcher(server, tmp_path).load_manifest() == {'present': ['1abc'], 'missing': ['9zzz']}
+    requests = len(server.requests)
+
+    # a rerun requests nothing: 1abc is on disk, the server has no 9zzz
+    assert prefetcher(server, tmp_path).fetch(['1abc', '9zzz']) == {'1abc': 'present', '9zzz': 'missing'}
+    assert len(server.requests) == requests
+
+    # entries removed from disk are downloaded again
+    os.remove(tmp_path / '1abc.pdb')
+    assert prefetcher(server, tmp_path).fetch(['1abc', '9zzz']) == {'1abc': 'downloaded', '9zzz': 'missing'}
+    assert server.requests[requests:] == ['/1abc.pdb.gz']
@@ -0,0 +1,43 @@
+import math
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from equivariant_attention.from_se3cnn.SO3 import irr_repr, rot, torch_default_dtype, wigner_D_all
+from equivariant_attention.from_se3cnn.utils_steerable import _basis_transformation_Q_J
+
+lie_learn_wigner_d = pytest.importorskip('lie_learn.representations.SO3.wigner_d')
+
+# Q_J of the orders up to 3 in the trans_Q cache the trained models were made with
+TRANS_Q = os.path.join(os.path.dirname(__file__), 'data', 'trans_Q.npz')
+MAX_DEGREE = 3
+
+
+@pytest.mark.parametrize('order', range(2 * MAX_DEGREE + 1))
+def test_irr_repr_matches_lie_learn(order):
+    torch.manual_seed(order)
+    for a, b, c in (torch.rand(8, 3) * 2 * math.pi).tolist():
+        D = irr_repr(order, a, b, c, dtype=torch.float64)
+        D_ref = torch.tensor(lie_learn_wigner_d.wigner_D_matrix(order, a, b, c))
+        assert torch.allclose(D, D_ref, atol=1e-10)
+
+
+def test_wigner_D_all_batched():
+    torch.manual_seed(0)
+    with torch_default_dtype(torch.float64):
+        abc = torch.rand(5, 3) * 2 * math.pi
+        Ds = wigner_D_all(2 * MAX_DEGREE, torch.stack([rot(*x) for x in abc]))
+    for order, D in enumerate(Ds):
+        for x, D_x in zip(abc.tolist(), D):
+            assert torch.allclose(D_x, torch.tensor(lie_learn_wigner_d.wigner_D_matrix(order, *x)), atol=1e-10)
+
+
+def test_basis_transformation_Q_J_matches_cached_bank():
+    # solved again, without the file cache: same bits, so the same signs, as the cached Q_J
+    solve = _basis_transformation_Q_J.__wrapped__.__wrapped__
+    bank = np.load(TRANS_Q)
+    for key in bank.files:
+        J, order_in, order_out = map(int, key.split('_'))
+        assert np.array_equal(solve(J, order_in, order_out).numpy(), bank[key]), key
@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from equivariant_attention.from_se3cnn.utils_steerable import (get_spherical_from_cartesian_torch, precompute_sh,
+                                                                 precompute_sh_cartesian)
+
+
+def edge_vectors(dtype):
+    torch.manual_seed(0)
+    # random directions and lengths, the poles, the zero vector and a vector close to it
+    special = torch.tensor([[0., 1., 0.], [0., -1., 0.], [0., 0., 0.], [1e-3, 0., 0.], [0., 0., -2.]])
+    return torch.cat([torch.randn(2000, 3) * 4, special]).to(dtype)
+
+
+@pytest.mark.parametrize('max_J', range(9))
+def test_precompute_sh_cartesian_matches_precompute_sh(max_J):
+    cartesian = edge_vectors(torch.float64)
+    Y = precompute_sh(get_spherical_from_cartesian_torch(cartesian), max_J)
+    ref = torch.cat([Y[J] for J in range(max_J+1)], -1)
+
+    assert torch.allclose(precompute_sh_cartesian(cartesian, max_J), ref, atol=1e-10)
+
+
+@pytest.mark.parametrize('max_J', [2, 8])
+def test_precompute_sh_cartesian_float32_and_out(max_J):
+    cartesian = edge_vectors(torch.float64)
+    ref = precompute_sh_cartesian(cartesian, max_J)
+
+    out = torch.empty(len(cartesian), (max_J+1)**2)
+    Y = precompute_sh_cartesian(cartesian.float().view(-1, 1, 3), max_J, out=out)
+    assert Y.shape == (len(cartesian), 1, (max_J+1)**2)
+    assert Y.data_ptr() == out.data_ptr()
+    assert torch.allclose(out.double(), ref, atol=1e-5)
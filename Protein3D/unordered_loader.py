@@ -0,0 +1,161 @@
+#%%
+"""Data loader delivering batches in completion order.
+
+A DataLoader returns batches in sampler order, so one slow batch (a giant
+chain, or a chain whose structure is downloaded on the fly) holds back every
+batch behind it, even when the other workers are done. UnorderedLoader hands
+out batches as soon as any worker has collated one. Reordering is bounded: a
+batch is only loaded while it is fewer than `max_reorder` batches ahead of the
+oldest batch still loading, which also bounds the batches held in memory.
+Every batch of the sampler is still delivered exactly once per epoch.
+
+Samplers run in the main process as with a DataLoader, so their per-epoch
+shuffles are unchanged. Time spent waiting for workers is counted in `stats`.
+"""
+import os
+import time
+import queue
+import random
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+_dataset = None
+_collate_fn = None
+
+def _init_worker(dataset, collate_fn, seed):
+    global _dataset, _collate_fn
+    _dataset, _collate_fn = dataset, collate_fn
+
+    # distinct random streams per worker, for the random rotations and crops
+    seed = (seed + os.getpid()) % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.set_num_threads(1)
+
+def _load_batch(indices):
+    return _collate_fn([_dataset[i] for i in indices])
+
+
+class UnorderedLoader(object):
+    """Iterate over the batches of a batch sampler, in the order workers complete them."""
+    def __init__(self, dataset, batch_sampler, collate_fn, num_workers: int=4, max_reorder: int=None, seed: int=0):
+        """Create a loader.
+
+        Args:
+            dataset (Dataset): map-style dataset
+            batch_sampler (Sampler): yields the sample indices of every batch
+            collate_fn (callable): merges the samples of a batch, e.g. datasets.collate
+            num_workers (int, optional): number of worker processes, 0 to load in the main process. Defaults to 4.
+            max_reorder (int, optional): how far a batch may run ahead of the oldest one still loading. Defaults to 4 per worker.
+            seed (int, optional): base random seed of the workers. Defaults to 0.
+        """
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn
+        self.num_workers = num_workers
+        self.max_reorder = max_reorder or 4 * max(num_workers, 1)
+        self.seed = seed
+        self.stats = {}
+        self._pool = None
+
+    @classmethod
+    def from_loader(cls, loader, max_reorder: int=None, seed: int=0):
+        """Loader with the dataset, batches, collate function and workers of a DataLoader."""
+        return cls(loader.dataset, loader.batch_sampler, loader.collate_fn, loader.num_workers, max_reorder, seed)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    @property
+    def pool(self):
+        # workers persist across epochs
+        if self._pool is None:
+            self._pool = mp.get_context().Pool(self.num_workers, initializer=_init_worker,
+                                               initargs=(self.dataset, self.collate_fn, self.seed))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        if not self.num_workers:
+            for indices in self.batch_sampler:
+                yield self.collate_fn([self.dataset[i] for i in indices])
+            return
+
+        # results of an abandoned epoch arrive in that epoch's queue and are dropped with it
+        done = queue.Queue()
+        batches = iter(self.batch_sampler)
+        pending, next_pos = set(), 0
+
+        def submit():
+            nonlocal next_pos
+            while not pending or next_pos < min(pending) + self.max_reorder:
+                indices = next(batches, None)
+                if indices is None:
+                    return
+                pos, next_pos = next_pos, next_pos + 1
+                pending.add(pos)
+                self.pool.apply_async(_load_batch, (indices,),
+                                      callback=lambda out, pos=pos: done.put((pos, out, None)),
+                                      error_callback=lambda e, pos=pos: done.put((pos, None, e)))
+
+        start = time.time()
+        stall, reordered = 0., 0
+        submit()
+        while pending:
+            wait = time.time()
+            pos, out, error = done.get()
+            stall += time.time() - wait
+            if error is not None:
+                raise error
+
+            reordered += pos != min(pending)
+            pending.discard(pos)
+            submit()
+            yield out
+
+        self.stats = {'batches': next_pos, 'reordered': reordered, 'stall_s': stall, 'epoch_s': time.time() - start}
+        print(f'Unordered loader -> ' + ', '.join(f'{k}: {v:.2f}' if isinstance(v, float) else f'{k}: {v}' for k, v in self.stats.items()))
+
+
+if __name__ == '__main__':
+    from torch.utils.data import BatchSampler, DataLoader, Dataset, SequentialSampler
+
+    class SlowDataset(Dataset):
+        # heavy-tailed load times, as with a few giant chains among many small ones
+        def __init__(self, n, seed=0):
+            self.delay = np.random.RandomState(seed).lognormal(np.log(2e-3), 1.2, n)
+
+        def __len__(self):
+            return len(self.delay)
+
+        def __getitem__(self, idx):
+            time.sleep(self.delay[idx])
+            return idx
+
+    def collate(samples):
+        return samples
+
+    dataset = SlowDataset(2000)
+    batch_sampler = BatchSampler(SequentialSampler(dataset), batch_size=4, drop_last=False)
+    for num_workers in [2, 4, 8]:
+        timing = {}
+        for name, loader in [('DataLoader', DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate, num_workers=num_workers)),
+                             ('UnorderedLoader', UnorderedLoader(dataset, batch_sampler, collate, num_workers))]:
+            start = time.time()
+            seen = [idx for batch in loader for idx in batch]
+            timing[name] = time.time() - start
+            assert sorted(seen) == list(range(len(dataset)))
+            if isinstance(loader, UnorderedLoader):
+                loader.close()
+        print(f'{num_workers} workers -> ' + ', '.join(f'{k}: {v:.2f} s' for k, v in timing.items())
+              + f' ({timing["DataLoader"]/timing["UnorderedLoader"]:.2f}x)')